@@ -0,0 +1,226 @@
+"""
+LLM 调用的准入控制和限流
+
+所有模型调用（agent 每一步的 model 节点）经过 AdmissionMiddleware：
+- 全局并发上限 ADMISSION_MAX_CONCURRENT，超出的调用排队等待
+- 令牌桶限制每秒请求数（LLM_RPS）和每分钟 token 数（LLM_TPM）；输入 token 调用前估算扣除，输出 token 调用后按实际用量补扣
+- 上游返回 429 时按 Retry-After（没有时按带抖动的指数退避）等待后重试，同时暂停令牌桶，其他调用一起退让
+入口（/api/external、WebSocket 聊天消息）在排队数超过 ADMISSION_MAX_QUEUE 时直接拒绝，返回 503 和 Retry-After，
+不让请求无限堆积。
+"""
+import asyncio
+import math
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from langchain.agents.middleware import AgentMiddleware
+
+import config
+from history_manager import request_tokens
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+# 被视为上游限流的状态码
+RATE_LIMIT_STATUS = {429, 529}
+
+
+class Overloaded(Exception):
+    """排队的调用过多，请求被拒绝"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"server overloaded, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """令牌桶；rate 为每秒补充的令牌数，rate <= 0 表示不限制速率（block 设置的暂停仍然生效）"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """距离可以取出 amount 个令牌还需等待的秒数；429 后的暂停（block）在不限速时同样生效"""
+        blocked = max(0.0, self.blocked_until - time.monotonic())
+        if self.rate <= 0:
+            return blocked
+        self._refill()
+        # 单次请求超过桶容量时按容量计算，避免永远等待
+        missing = min(amount, self.capacity) - self.tokens
+        return max(blocked, missing / self.rate if missing > 0 else 0.0)
+
+    def consume(self, amount: float):
+        if self.rate > 0:
+            self._refill()
+            self.tokens -= amount
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    if getattr(error, "status_code", None) in RATE_LIMIT_STATUS:
+        return True
+    return "rate limit" in str(error).lower()
+
+
+def retry_after_of(error: BaseException) -> Optional[float]:
+    """上游响应头中的 Retry-After（秒数或 HTTP 日期）"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_concurrent: int = config.ADMISSION_MAX_CONCURRENT,
+        max_queue: int = config.ADMISSION_MAX_QUEUE,
+        rps: float = config.LLM_RPS,
+        tpm: float = config.LLM_TPM,
+        retries: int = config.LLM_RATE_LIMIT_RETRIES,
+        backoff_base: float = config.LLM_BACKOFF_BASE,
+        backoff_max: float = config.LLM_BACKOFF_MAX,
+    ):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max_queue
+        self.requests = TokenBucket(rps, max(rps, 1.0))
+        self.tokens = TokenBucket(tpm / 60.0, tpm)
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        self._rate_lock = asyncio.Lock()
+        self.active = 0
+        self.waiting = 0
+        # 单次调用耗时的 EWMA，用于估算 Retry-After
+        self.avg_call_seconds = 10.0
+        self.calls = 0
+        self.shed = 0
+        self.throttled = 0
+
+    def retry_after(self) -> int:
+        """按排队长度和平均调用耗时估算的等待秒数"""
+        estimate = (self.waiting + 1) / self.max_concurrent * self.avg_call_seconds
+        return int(min(60, max(1, math.ceil(estimate))))
+
+    def check(self):
+        """入口处调用：排队的调用过多时抛出 Overloaded"""
+        if self.max_queue and self.waiting >= self.max_queue:
+            self.shed += 1
+            raise Overloaded(self.retry_after())
+
+    async def _acquire_rate(self, tokens: int):
+        while True:
+            async with self._rate_lock:
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if wait <= 0:
+                    self.requests.consume(1)
+                    self.tokens.consume(tokens)
+                    return
+            await asyncio.sleep(min(wait, 1.0))
+
+    def _backoff(self, attempt: int, error: BaseException) -> float:
+        retry_after = retry_after_of(error)
+        jittered = min(self.backoff_max, self.backoff_base * 2 ** attempt) * (0.5 + random.random())
+        return max(retry_after or 0.0, jittered)
+
+    async def call(self, fn: Callable[[], Awaitable[Any]], tokens: int = 0) -> Any:
+        """在并发和速率限制内执行一次模型调用，429 时退避重试"""
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            attempt = 0
+            while True:
+                await self._acquire_rate(tokens)
+                started = time.monotonic()
+                try:
+                    result = await fn()
+                except Exception as e:
+                    if not is_rate_limited(e) or attempt >= self.retries:
+                        raise
+                    delay = self._backoff(attempt, e)
+                    attempt += 1
+                    self.throttled += 1
+                    # 暂停令牌桶，其他调用也一起退让
+                    self.requests.block(delay)
+                    logger.warning("llm call rate limited", extra={"attempt": attempt, "retry_in": round(delay, 1)})
+                    await asyncio.sleep(delay)
+                    continue
+                self.calls += 1
+                self.avg_call_seconds = 0.8 * self.avg_call_seconds + 0.2 * (time.monotonic() - started)
+                return result
+        finally:
+            self.active -= 1
+            self._slots.release()
+
+    def record_output(self, tokens: int):
+        self.tokens.consume(tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "calls": self.calls,
+            "shed": self.shed,
+            "throttled": self.throttled,
+            "avg_call_seconds": round(self.avg_call_seconds, 2),
+        }
+
+
+def _output_tokens(response) -> int:
+    total = 0
+    for message in getattr(response, "result", None) or []:
+        usage = getattr(message, "usage_metadata", None) or {}
+        total += usage.get("output_tokens", 0)
+    return total
+
+
+class AdmissionMiddleware(AgentMiddleware):
+    """让 agent 的每次模型调用都经过 AdmissionController"""
+
+    def __init__(self, controller: AdmissionController):
+        super().__init__()
+        self.controller = controller
+
+    async def awrap_model_call(self, request, handler):
+        response = await self.controller.call(lambda: handler(request), request_tokens(request))
+        self.controller.record_output(_output_tokens(response))
+        return response
+
+
+admission = AdmissionController()
@@ -0,0 +1,202 @@
+"""
+纯文本问答的本地相似度缓存（默认关闭，ANSWER_CACHE_ENABLED=true 开启）
+
+只用于不带图片、病例数据和对话历史的独立问题：
+1. 归一化后精确匹配（全角转半角、小写、去空白和标点，保留数字中的小数点）
+2. 未命中时用字符 n-gram TF-IDF 余弦相似度在全部缓存问题中查找，超过阈值视为命中
+   向量用特征哈希映射到固定维度，整张矩阵一次 NumPy 运算完成比较；
+   相似命中还要求两个问题中的数值和否定词完全一致（"血糖7.2" 与 "血糖8.2"、"有" 与 "无" 字面很像但答案不同）
+条目按 TTL 过期、按 LRU 淘汰。NumPy 未安装时只做精确匹配。
+"""
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import config
+
+try:
+    import numpy as np
+except ImportError:  # NumPy 未安装时只做精确匹配
+    np = None
+
+# 特征哈希的维度
+HASH_DIM = 4096
+NGRAM_SIZES = (1, 2, 3)
+# 相似命中时必须一致的否定词
+NEGATION_WORDS = ("不", "无", "没", "未", "非", "否", "勿", "别")
+
+_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+
+
+def normalize_question(text: str) -> str:
+    """全角转半角、小写，只保留文字、数字和数字之间的小数点"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    kept = []
+    for i, ch in enumerate(text):
+        if ch.isalnum():
+            kept.append(ch)
+        elif ch == "." and kept and kept[-1].isdigit() and text[i + 1:i + 2].isdigit():
+            kept.append(ch)
+    return "".join(kept)
+
+
+def question_guard(key: str) -> Tuple[Tuple[str, ...], Tuple[int, ...]]:
+    """归一化问题中的数值和各否定词出现次数；相似命中要求两者完全一致"""
+    return tuple(_NUMBER_RE.findall(key)), tuple(key.count(word) for word in NEGATION_WORDS)
+
+
+def _ngram_counts(text: str) -> Dict[int, float]:
+    counts: Dict[int, float] = {}
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            bucket = zlib.crc32(text[i:i + n].encode("utf-8")) % HASH_DIM
+            counts[bucket] = counts.get(bucket, 0.0) + 1.0
+    return counts
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    created_at: float
+    slot: int
+    guard: Tuple[Tuple[str, ...], Tuple[int, ...]]
+    hits: int = 0
+
+
+class AnswerCache:
+    def __init__(
+        self,
+        max_entries: int = config.ANSWER_CACHE_MAX_ENTRIES,
+        ttl: float = config.ANSWER_CACHE_TTL,
+        threshold: float = config.ANSWER_CACHE_SIMILARITY,
+    ):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.threshold = threshold
+        # 归一化问题 -> 条目，按最近使用排序
+        self._entries: "OrderedDict[str, CachedAnswer]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._free_slots: List[int] = list(range(self.max_entries - 1, -1, -1))
+        self._slot_keys: Dict[int, str] = {}
+        # 每行是一个问题的 n-gram 词频；df 为各维度的文档频率，用于计算 IDF；首次写入时分配
+        self._tf = None
+        self._used = None
+        self._df = None
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    def get(self, question: str) -> Optional[Tuple[str, float]]:
+        """返回 (缓存的回答, 相似度)，未命中返回 None"""
+        key = normalize_question(question)
+        if not key:
+            return None
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            score = 1.0
+            if entry is None and self._tf is not None and self._entries:
+                entry, score = self._most_similar(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(self._slot_keys[entry.slot])
+            entry.hits += 1
+            if score >= 1.0:
+                self.exact_hits += 1
+            else:
+                self.similar_hits += 1
+            return entry.answer, score
+
+    def put(self, question: str, answer: str):
+        key = normalize_question(question)
+        if not key or not answer:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while len(self._entries) >= self.max_entries:
+                self._remove(next(iter(self._entries)))
+            slot = self._free_slots.pop()
+            self._entries[key] = CachedAnswer(question, answer, time.time(), slot, question_guard(key))
+            self._slot_keys[slot] = key
+            if np is not None:
+                if self._tf is None:
+                    self._tf = np.zeros((self.max_entries, HASH_DIM), dtype=np.float32)
+                    self._used = np.zeros(self.max_entries, dtype=bool)
+                    self._df = np.zeros(HASH_DIM, dtype=np.float32)
+                row = self._tf[slot]
+                row[:] = 0
+                for bucket, count in _ngram_counts(key).items():
+                    row[bucket] = count
+                self._used[slot] = True
+                self._df += row > 0
+
+    def _most_similar(self, key: str) -> Tuple[Optional[CachedAnswer], float]:
+        """超过阈值且数值、否定词一致的最相似条目"""
+        query = np.zeros(HASH_DIM, dtype=np.float32)
+        for bucket, count in _ngram_counts(key).items():
+            query[bucket] = count
+        n_docs = float(len(self._entries))
+        idf = np.log((1.0 + n_docs) / (1.0 + self._df)) + 1.0
+        query *= idf
+        matrix = self._tf * idf
+        norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1.0)
+        scores = np.where(self._used & (norms > 0), matrix @ query / np.maximum(norms, 1e-9), -1.0)
+        guard = question_guard(key)
+        for slot in np.argsort(-scores):
+            score = float(scores[slot])
+            if score < self.threshold or score <= 0:
+                break
+            entry = self._entries[self._slot_keys[int(slot)]]
+            if entry.guard == guard:
+                return entry, score
+        return None, 0.0
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        del self._slot_keys[entry.slot]
+        if self._tf is not None:
+            self._df -= self._tf[entry.slot] > 0
+            self._tf[entry.slot] = 0
+            self._used[entry.slot] = False
+        self._free_slots.append(entry.slot)
+
+    def _expire(self):
+        if not self.ttl:
+            return
+        deadline = time.time() - self.ttl
+        expired = [key for key, entry in self._entries.items() if entry.created_at < deadline]
+        for key in expired:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "enabled": config.ANSWER_CACHE_ENABLED,
+            "similarity": np is not None,
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "threshold": self.threshold,
+        }
+
+
+def split_for_stream(text: str, size: int) -> List[str]:
+    """把缓存的回答切成若干帧，按正常的 assistant_message 事件发送"""
+    size = max(1, size)
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+answer_cache = AnswerCache()
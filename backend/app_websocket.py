@@ -4,27 +4,54 @@ WebSocket 版本的 AI Chat
 支持外部触发消息并在聊天页面实时显示
 """
 import asyncio
+import json
 import os
 import re
+import time
 import uuid
 from pathlib import Path
-from typing import List, Dict, Set, Tuple, Union
+from typing import List, Dict, Optional, Set, Tuple, Union
 
 from deepagents import create_deep_agent
 from deepagents.backends import FilesystemBackend, CompositeBackend
 from deepagents_cli.config import settings
 from deepagents.middleware.skills import SkillsMiddleware
-from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, File, Request, UploadFile, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from langchain.agents.middleware import ShellToolMiddleware, HostExecutionPolicy
+from langchain.agents.middleware import HostExecutionPolicy
 from langchain_community.agent_toolkits import FileManagementToolkit
-from custom_llm import create_custom_llm
+import custom_llm
+from custom_llm import close_http_clients, create_custom_llm, create_light_llm, get_async_http_client, http_pool_stats, warm_up_llm_client
+from llm_router import run_health_checks
+from connection_manager import ConnectionManager
+from connection_jobs import ConnectionJobQueue, run_registry
+from process_cleanup import TrackedShellToolMiddleware, cleanup_after_cancel, track_run_shells
+from log_config import get_logger, setup_logging
+from stream_coalescer import StreamCoalescer, stream_stats
+from batch_engine import BatchRunner, case_id_of
+from batch_journal import RESUMABLE_STATUSES, batch_journal
+from image_store import IMAGE_REF_PREFIX, ImageStoreError, image_store, ingest_case_images, parse_image_ref
+from image_preprocess import image_preprocessor
+from upload_manager import FRAME_HEADER_SIZE, UploadError, upload_manager
+from report_extraction_cache import ReportExtractionCache, build_extraction_tools, format_extraction_context, format_extraction_hint
+from answer_cache import answer_cache, split_for_stream
+from case_memo import CaseMemo
+from history_manager import compact_history
+from admission import AdmissionMiddleware, Overloaded, admission
+from model_tiers import ModelTierMiddleware
+from thread_store import ThreadError, thread_store, validate_thread_id
+from rag_cache import rag_cache
+from rag_client import build_rag_tools, close_rag_client, rag_client_stats
+from local_index import local_index
 import config
 # from safe_skills_middleware import SafeSkillsMiddleware  # 添加这行
 
+setup_logging()
+logger = get_logger("app_websocket")
+
 app = FastAPI(title="AI Chat API - WebSocket")
 
 app.add_middleware(
@@ -42,50 +69,20 @@ project_root = os.path.dirname(backend_dir)
 static_dir = os.path.join(project_root, "frontend", "static")
 templates_dir = os.path.join(project_root, "frontend", "templates")
 
-print(f"[CONFIG] Backend dir: {backend_dir}")
-print(f"[CONFIG] Project root: {project_root}")
-print(f"[CONFIG] Static dir: {static_dir}")
-print(f"[CONFIG] Templates dir: {templates_dir}")
-print(f"[CONFIG] Static dir exists: {os.path.exists(static_dir)}")
-print(f"[CONFIG] Templates dir exists: {os.path.exists(templates_dir)}")
+logger.info("paths configured", extra={
+    "backend_dir": backend_dir,
+    "project_root": project_root,
+    "static_dir": static_dir,
+    "templates_dir": templates_dir,
+    "static_dir_exists": os.path.exists(static_dir),
+    "templates_dir_exists": os.path.exists(templates_dir),
+})
 
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 templates = Jinja2Templates(directory=templates_dir)
 jobs_db = {}
 
-# WebSocket 连接管理类
-class ConnectionManager:
-    """WebSocket连接管理器，负责连接的生命周期管理和消息广播"""
-    
-    def __init__(self):
-        """初始化连接管理器"""
-        self.active_connections: Set[WebSocket] = set()
-        # 添加对话长度监控
-        self.conversation_stats = {}
-    
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.add(websocket)
-        print(f"[WS] 新连接，当前连接数: {len(self.active_connections)}")
-    
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.discard(websocket)
-        print(f"[WS] 连接断开，当前连接数: {len(self.active_connections)}")
-    
-    async def broadcast(self, message: dict):
-        """广播消息到所有连接的客户端"""
-        dead_connections = set()
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except Exception as e:
-                print(f"[WS] 发送失败: {e}")
-                dead_connections.add(connection)
-        
-        # 清理失效连接
-        for conn in dead_connections:
-            self.disconnect(conn)
-
+# WebSocket 连接管理（每个连接独立的有界发送队列）
 manager = ConnectionManager()
 
 # 创建Deep Agent实例
@@ -107,9 +104,11 @@ project_dir_str = str(project_dir.resolve())
 settings = settings.from_environment(start_path=backend_dir_str)
 
 
-print(f"[INFO] assistant_id: {assistant_id}")
-print(f"[INFO] agent_dir: {agent_dir_str}")
-print(f"[INFO] skills_dir: {skills_dir_str}")
+logger.info("agent configured", extra={
+    "assistant_id": assistant_id,
+    "agent_dir": agent_dir_str,
+    "skills_dir": skills_dir_str,
+})
 
 
 # 读取 agent.md / system.md
@@ -127,6 +126,24 @@ def load_full_system_prompt() -> str:
 
 # ========== 2. 创建 LLM ==========
 base_llm = create_custom_llm()
+# 闲聊和技能选择使用 light 模型，评估和复杂工具调用使用 base_llm
+model_tier_middleware = ModelTierMiddleware(create_light_llm())
+
+# ========== 3. 报告提取结果缓存（随 evaluate-record 技能版本失效）==========
+evaluate_skill_dir = skills_dir / 'evaluate-record'
+extraction_cache = ReportExtractionCache(
+    skill_paths=[str(evaluate_skill_dir / 'SKILL.md'), str(evaluate_skill_dir / 'reference')]
+)
+extraction_tools = build_extraction_tools(
+    extraction_cache,
+    image_exists=lambda image_id: image_store.locate(image_id) is not None,
+) if config.REPORT_EXTRACTION_CACHE_ENABLED else []
+
+# 知识检索工具：进程内异步检索，替代通过 shell 运行 rag.py
+rag_tools = build_rag_tools()
+
+# 批量评估的整例结果记忆（随提示词、技能文件、模型和温度失效）
+case_memo = CaseMemo(prompt_paths=[str(system_prompt_path), str(agent_prompt_path), skills_dir_str])
 
 # ========== 4. 创建 Backend ==========
 # 使用本机实际路径，避免硬编码 Linux 路径导致找不到文件
@@ -138,11 +155,15 @@ def build_agent():
     agent_middleware = [
         # deepagents>=? 的 SkillsMiddleware 新签名为 (backend=..., sources=[...])
         SkillsMiddleware(backend=FilesystemBackend(root_dir=skills_dir_str), sources=["."]),
-        ShellToolMiddleware(
+        # 记录每次运行启动的 shell 会话，取消时只清理该运行自己的子进程
+        TrackedShellToolMiddleware(
             workspace_root=backend_dir_str,
             execution_policy=HostExecutionPolicy(),
             env=os.environ,
         ),
+        # 每次模型调用都经过全局并发/速率限制，429 时退避重试
+        AdmissionMiddleware(admission),
+        model_tier_middleware,
     ]
     # ========== 6. 创建 Agent（使用绑定了工具的模型 + tools 参数）==========
     return create_deep_agent(
@@ -150,18 +171,19 @@ def build_agent():
         system_prompt=load_full_system_prompt(),
         middleware=agent_middleware,
         backend=composite_backend,
-        model=base_llm
+        model=base_llm,
+        tools=extraction_tools + rag_tools
     )
 
 
 def reload_agent():
     global agent
     agent = build_agent()
-    print("[INFO] Agent reloaded to apply skill changes")
+    logger.info("agent reloaded to apply skill changes")
 
 
 agent = build_agent()
-print(f"✓ WebSocket server initialized")
+logger.info("websocket server initialized")
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -178,104 +200,428 @@ async def websocket_endpoint(websocket: WebSocket):
         websocket: WebSocket连接对象，用于与客户端进行双向通信
 
     功能说明：
-    - 建立和维护WebSocket连接
-    - 接收客户端发送的消息（支持文本、批量评估数据）
-    - 广播用户消息到所有连接的客户端
-    - 调用process_chat处理不同类型的数据输入
+    - 建立和维护WebSocket连接，并为连接分配会话ID（可通过 ?session_id= 在重连时沿用）
+    - 读循环只负责收帧：聊天消息投递到本连接的有界任务队列，由独立任务执行 agent
+    - 运行期间仍可处理新的消息和 ping，同一会话内的消息按顺序执行
+    - 事件只发送给本会话
 
     支持的数据格式：
-    - 普通聊天消息：包含message和history字段
+    - 普通聊天消息：包含message和thread_id字段（历史由服务端线程保存，见 thread_store；未带 thread_id 时使用 history 字段）
     - 批量评估数据：包含case_data、case_index、total_cases字段
+    - 批量评估：{"type": "batch_start", "cases": [...] 或 "cases_ref": "upload:<id>", "message": 可选, "force_refresh": 可选}，由服务端批量引擎并发执行
+    - 上传：upload_begin / 二进制帧 / upload_end，协议见 upload_manager
+    - 控制消息：{"type": "ping"}、{"type": "cancel", "run_id": 可选, "batch_id": 可选}
     
     Returns:
         None: 函数持续运行直到连接断开
     """
-    await manager.connect(websocket)
+    session_id = websocket.query_params.get("session_id") or uuid.uuid4().hex
+    await manager.connect(websocket, session_id)
+    await manager.send_to_connection(websocket, {"type": "session", "session_id": session_id})
+    jobs = ConnectionJobQueue(run_chat_job)
     try:
         while True:
-            # 接收客户端消息
-            data = await websocket.receive_json()
-            message = data.get("message", "")
-            history = data.get("history", [])
-            
-            # 新增JSON数据字段
-            case_data = data.get("case_data")
-            case_index = data.get("case_index")
-            total_cases = data.get("total_cases")
-        
-            if case_data:
-                print(f"[JSON] 批量处理模式 - Case {case_index}/{total_cases}")
-            
-            # 构建完整消息内容（包含图片和JSON描述）
-            full_message = message
-            
-            if case_data:
-                json_info = f"\n\n[批量评估模式] - Case {case_index}/{total_cases}"
-                if isinstance(case_data, dict):
-                    if "id" in case_data:
-                        json_info += f" (ID: {case_data['id']})"
-                    if "type" in case_data:
-                        json_info += f" (类型: {case_data['type']})"
-                full_message += json_info
+            # 接收客户端消息：文本帧是 JSON 消息，二进制帧是上传数据
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            if frame.get("bytes") is not None:
+                await receive_upload_frame(websocket, session_id, frame["bytes"])
+                continue
+            text = frame.get("text") or ""
+            try:
+                # 大的文本帧在线程中解析，不阻塞其他连接
+                if len(text) < config.WS_JSON_THREAD_THRESHOLD:
+                    data = json.loads(text)
+                else:
+                    data = await asyncio.to_thread(json.loads, text)
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                await manager.send_to_connection(websocket, {"type": "error", "content": "消息格式错误：需要 JSON 对象"})
+                continue
+            msg_type = data.get("type", "chat")
             
+            if msg_type == "ping":
+                await manager.send_to_connection(websocket, {"type": "pong"})
+                continue
+            if msg_type in ("upload_begin", "upload_end"):
+                await handle_upload_message(websocket, session_id, data)
+                continue
+            if msg_type == "batch_start":
+                cases = data.get("cases") or []
+                if data.get("cases_ref"):
+                    try:
+                        cases = await asyncio.to_thread(upload_manager.load_cases, data["cases_ref"])
+                    except UploadError as e:
+                        await manager.send_to_connection(websocket, {"type": "error", "content": f"病例文件无效: {e}"})
+                        continue
+                await start_batch(cases, data.get("message", ""), session_id, force_refresh=bool(data.get("force_refresh")))
+                continue
+            if msg_type == "cancel":
+                batch = batches.get(data.get("batch_id") or "")
+                if batch is not None and batch.session_id == session_id:
+                    batch.cancel()
+                # 未指定 run_id 时同时丢弃本连接排队中的消息
+                dropped = [] if data.get("run_id") else jobs.clear_pending()
+                # 被丢弃的消息已收到 run_queued，同样回复 cancelled，客户端不必一直等待
+                for job in dropped:
+                    await manager.send_to_session(session_id, {"type": "cancelled", "run_id": job["run_id"]})
+                cancelled = run_registry.cancel(session_id, data.get("run_id"))
+                logger.info("cancel requested", extra={"session_id": session_id, "cancelled": cancelled, "dropped": len(dropped)})
+                continue
             
-            # 发送用户消息到所有客户端
-            await manager.broadcast({
-                "type": "user_message",
-                "content": full_message
+            try:
+                admission.check()
+            except Overloaded as e:
+                await manager.send_to_connection(websocket, {
+                    "type": "error",
+                    "content": f"服务繁忙，请 {e.retry_after} 秒后重试",
+                    "retry_after": e.retry_after
+                })
+                continue
+            data["session_id"] = session_id
+            data["ordering_key"] = data.get("conversation_id") or data.get("thread_id") or session_id
+            run_id = jobs.submit(data)
+            if run_id is None:
+                await manager.send_to_connection(websocket, {
+                    "type": "error",
+                    "content": "当前排队的消息过多，请等待上一条回复完成后再发送"
+                })
+                continue
+            await manager.send_to_connection(websocket, {
+                "type": "run_queued",
+                "run_id": run_id,
+                "pending": jobs.pending
             })
             
-            # 调用process_chat处理消息
-            await process_chat(
-                message,
-                history,
-                case_data  # 传递case_data（可能是单个对象或列表）
-            )
-            
     except WebSocketDisconnect:
         manager.disconnect(websocket)
     except Exception as e:
-        print(f"[WS] 错误: {e}")
+        logger.exception("websocket error", extra={"session_id": session_id})
         manager.disconnect(websocket)
+    finally:
+        # 连接断开时取消该连接发起的运行，避免继续为无人接收的回复付费
+        await jobs.close(cancel_running=True)
+
+
+async def handle_upload_message(websocket: WebSocket, session_id: str, data: dict):
+    """处理 upload_begin / upload_end 控制消息"""
+    request_id = data.get("request_id")
+    try:
+        if data["type"] == "upload_begin":
+            upload = await asyncio.to_thread(
+                upload_manager.begin,
+                session_id,
+                data.get("kind", "image"),
+                data.get("size"),
+                data.get("sha256"),
+                data.get("upload_id"),
+            )
+            await manager.send_to_connection(websocket, {
+                "type": "upload_ready",
+                "request_id": request_id,
+                "upload_id": upload.upload_id,
+                "offset": upload.received,
+                "chunk_size": config.UPLOAD_CHUNK_SIZE,
+            })
+        else:
+            result = await asyncio.to_thread(upload_manager.finish, session_id, data.get("upload_id"))
+            logger.info("upload complete", extra={"session_id": session_id, "upload_id": data.get("upload_id"), "bytes": result["size"]})
+            await manager.send_to_connection(websocket, dict(
+                result,
+                type="upload_complete",
+                request_id=request_id,
+                upload_id=data.get("upload_id"),
+            ))
+    except ValueError as e:
+        # UploadError 以及图片格式无法识别（ImageStoreError）
+        await manager.send_to_connection(websocket, {
+            "type": "upload_error",
+            "request_id": request_id,
+            "upload_id": data.get("upload_id"),
+            "error": str(e),
+        })
+
+
+async def receive_upload_frame(websocket: WebSocket, session_id: str, frame: bytes):
+    """写入一个上传数据帧；出错时告知客户端应从哪个偏移量续传"""
+    try:
+        await asyncio.to_thread(upload_manager.write_frame, session_id, frame)
+    except UploadError as e:
+        upload_id = frame[:32].decode("ascii", errors="replace") if len(frame) >= FRAME_HEADER_SIZE else None
+        await manager.send_to_connection(websocket, {
+            "type": "upload_error",
+            "upload_id": upload_id,
+            "offset": upload_manager.expected_offset(upload_id) if upload_id else None,
+            "error": str(e),
+        })
+
+
+async def run_chat_job(data: dict):
+    """执行一条聊天消息：回显用户消息并调用 process_chat；被取消时发送 cancelled 事件并清理子进程"""
+    session_id = data["session_id"]
+    run_id = data["run_id"]
+    message = data.get("message", "")
+    history = data.get("history", [])
+    # 带 thread_id 时历史从服务端线程读取；服务端还没有该线程（旧对话首次使用）时用客户端带来的历史初始化
+    thread_id = data.get("thread_id")
+    if thread_id:
+        try:
+            validate_thread_id(thread_id)
+        except ThreadError as e:
+            await manager.send_to_session(session_id, {"type": "error", "content": f"对话线程无效: {e}"})
+            return
+        if history and not await asyncio.to_thread(thread_store.exists, thread_id):
+            await asyncio.to_thread(thread_store.append, thread_id, history)
+        history = await asyncio.to_thread(thread_store.load, thread_id)
+    # 图片：优先使用图片库引用 "image:<id>"，内嵌的 data URL 会先存入图片库
+    try:
+        images = await asyncio.to_thread(lambda: [image_store.ingest(img) for img in data.get("images") or []])
+    except ImageStoreError as e:
+        await manager.send_to_session(session_id, {"type": "error", "content": f"图片无效: {e}"})
+        return
+    
+    # 新增JSON数据字段
+    case_data = data.get("case_data")
+    case_index = data.get("case_index")
+    total_cases = data.get("total_cases")
+
+    # 病例列表交给服务端批量引擎
+    if isinstance(case_data, list):
+        await start_batch(case_data, message, session_id)
+        return
+
+    if case_data:
+        logger.info("batch case received", extra={"session_id": session_id, "case_index": case_index, "total_cases": total_cases})
+    
+    # 构建完整消息内容（包含图片和JSON描述）
+    full_message = message
+    
+    if case_data:
+        json_info = f"\n\n[批量评估模式] - Case {case_index}/{total_cases}"
+        if isinstance(case_data, dict):
+            if "id" in case_data:
+                json_info += f" (ID: {case_data['id']})"
+            if "type" in case_data:
+                json_info += f" (类型: {case_data['type']})"
+        full_message += json_info
+    
+    # 回显用户消息到本会话
+    await manager.send_to_session(session_id, {
+        "type": "user_message",
+        "content": full_message
+    })
+    
+    # 调用process_chat处理消息
+    shell_pids = track_run_shells()
+    try:
+        result = await process_chat(
+            message,
+            history,
+            case_data,  # 传递单个case数据
+            session_id=session_id,
+            images=images,
+            use_cache=not data.get("no_cache")
+        )
+    except asyncio.CancelledError:
+        # 取消会中断 agent.astream，上游 LLM 的 HTTP 流随之关闭
+        await manager.send_to_session(session_id, {"type": "cancelled", "run_id": run_id})
+        await asyncio.to_thread(cleanup_after_cancel, shell_pids)
+        raise
+
+    # 只保存成功的一轮对话；图片在历史中只记录引用
+    if thread_id and result.get("status") == "success":
+        user_content = full_message + "".join(f"\n[图片: {img}]" for img in images if str(img).startswith(IMAGE_REF_PREFIX))
+        await asyncio.to_thread(thread_store.append, thread_id, [
+            {"role": "user", "content": user_content},
+            {"role": "assistant", "content": result["content"]},
+        ])
+
+# 批量评估任务：batch_id -> BatchRunner
+batches: Dict[str, BatchRunner] = {}
+
+
+async def run_batch_case(case: Dict, index: int, message: str = "", force_refresh: bool = False) -> Dict:
+    """
+    批量评估中的单个病例：不推送流式事件，只返回最终结果
+
+    结果记忆开启时先按病例内容查找上次的评估结果，命中则不调用模型；
+    force_refresh 时跳过查找，重新评估并覆盖记忆。返回值的 memo 字段为 hit / miss / refresh
+    """
+    query = case.get("query") or message or "请分析以下case"
+    if not config.CASE_MEMO_ENABLED:
+        return await process_chat(query, [], case, stream=False)
+    key = await asyncio.to_thread(case_memo.key, case, query)
+    if not force_refresh:
+        memoized = await asyncio.to_thread(case_memo.get, key)
+        if memoized is not None:
+            return dict(memoized, memo="hit")
+    result = await process_chat(query, [], case, stream=False)
+    await asyncio.to_thread(case_memo.put, key, result, case_id_of(case))
+    return dict(result, memo="refresh" if force_refresh else "miss")
+
+
+def launch_batch(
+    cases: List[Dict],
+    message: str,
+    session_id: Optional[str],
+    batch_id: Optional[str] = None,
+    results: Optional[Dict[int, Dict]] = None,
+    force_refresh: bool = False,
+) -> BatchRunner:
+    """启动批量评估任务（新任务或从日志恢复的任务），进度和结果推送到发起的会话"""
+    async def notify(event: dict):
+        await emit_event(event, session_id=session_id)
+
+    runner = BatchRunner(
+        cases,
+        lambda case, index: run_batch_case(case, index, message, force_refresh),
+        notify,
+        batch_id=batch_id,
+        session_id=session_id,
+        journal=batch_journal,
+        results=results,
+    )
+    # 只保留最近的已结束任务，避免登记表无限增长（持久化的记录仍可通过日志查询）
+    finished = [bid for bid, b in batches.items() if not b.active]
+    for bid in finished[:max(0, len(finished) - config.BATCH_KEEP_FINISHED)]:
+        del batches[bid]
+    batches[runner.batch_id] = runner
+    runner.start()
+    logger.info("batch started", extra={
+        "batch_id": runner.batch_id,
+        "session_id": session_id,
+        "total": len(cases),
+        "done": len(runner.results),
+        "force_refresh": force_refresh,
+    })
+    return runner
+
+
+async def start_batch(cases: List[Dict], message: str, session_id: Optional[str], force_refresh: bool = False) -> BatchRunner:
+    """创建新的批量评估任务：先写入日志再开始执行；force_refresh 时不复用记忆的病例结果"""
+    batch_id = uuid.uuid4().hex[:12]
+    # 病例中内嵌的图片先存入图片库，日志里只保存引用；无法识别的图片保持原样，由该病例自行报错
+    def ingest(case):
+        try:
+            return ingest_case_images(case)
+        except ImageStoreError as e:
+            logger.warning("batch case image not stored", extra={"batch_id": batch_id, "error": str(e)})
+            return case
+
+    cases = await asyncio.to_thread(lambda: [ingest(case) for case in cases])
+    await asyncio.to_thread(batch_journal.create_job, batch_id, cases, message, session_id)
+    return launch_batch(cases, message, session_id, batch_id=batch_id, force_refresh=force_refresh)
+
 
-async def process_chat(message: str, history: List[Dict[str, str]], case_data: Union[Dict, List] = None) -> Dict:
+async def resume_batch(batch_id: str, retry_failed: bool = False, force_refresh: bool = False) -> Optional[BatchRunner]:
+    """
+    从日志恢复批量任务，从第一个未完成的病例继续执行，已成功的病例不会重复调用模型
+
+    Args:
+        retry_failed: 是否同时重新执行失败的病例
+        force_refresh: 剩余病例是否跳过结果记忆、重新评估
+    """
+    job = await asyncio.to_thread(batch_journal.get_job, batch_id)
+    if job is None:
+        return None
+    if retry_failed:
+        await asyncio.to_thread(batch_journal.reset_cases, batch_id, ("error",))
+    cases = await asyncio.to_thread(batch_journal.load_cases, batch_id)
+    results = await asyncio.to_thread(batch_journal.load_results, batch_id)
+    return launch_batch(cases, job["message"], job["session_id"], batch_id=batch_id, results=results, force_refresh=force_refresh)
+
+
+@app.on_event("startup")
+async def resume_interrupted_batches():
+    """服务重启后继续执行上次未完成的批量任务（暂停和取消的任务不自动恢复）"""
+    try:
+        jobs = await asyncio.to_thread(batch_journal.list_jobs, RESUMABLE_STATUSES, 1000)
+    except Exception:
+        logger.exception("failed to read batch journal")
+        return
+    for job in jobs:
+        logger.info("resuming interrupted batch", extra={"batch_id": job["batch_id"], "done": job["completed"] + job["failed"], "total": job["total"]})
+        await resume_batch(job["batch_id"])
+
+
+async def emit_event(message: dict, session_id: Optional[str] = None, broadcast: bool = False):
+    """发送一条流式事件：显式广播，或只发给拥有该会话的连接"""
+    if broadcast:
+        await manager.broadcast(message)
+    elif session_id is not None:
+        await manager.send_to_session(session_id, message)
+
+
+async def process_chat(
+    message: str,
+    history: List[Dict[str, str]],
+    case_data: Dict = None,
+    session_id: Optional[str] = None,
+    broadcast: bool = False,
+    stream: bool = True,
+    images: Optional[List[str]] = None,
+    use_cache: bool = True
+) -> Dict:
     """
     处理聊天消息，支持三种输入模式：
     1. 纯文本聊天
     2. 文本+图像
-    3. 文本+JSON数据
+    3. 文本+JSON数据（单个病例；病例列表由批量引擎逐个调用）
     
     Args:
         message: 用户输入的文本消息
         history: 对话历史记录
-        images: 用户上传的图片URL列表，可选
-        case_data: JSON格式的病例数据，可选
+        case_data: JSON格式的单个病例数据，可选
+        session_id: 事件的目标会话；为空且未开启广播时不发送任何事件
+        broadcast: 是否向所有连接广播（仅外部触发等显式公告使用）
+        stream: 是否推送流式事件；批量评估时为 False，只收集最终结果
+        images: 随消息附带的图片（图片库引用或 URL）
+        use_cache: 是否使用问答缓存（仅对无图片、无病例、无历史的纯文本问题生效）
+    
+    Returns:
+        Dict: {"status": "success", "content": 模型回复全文}
+              或 {"status": "error", "message": 错误信息, "status_code": 上游HTTP状态码}
     """
+    async def emit(event: dict):
+        if stream:
+            await emit_event(event, session_id=session_id, broadcast=broadcast)
+
+    # 模型回复全文，作为返回值
+    answer_parts: List[str] = []
+
+    async def send_text(text: str):
+        answer_parts.append(text)
+        await emit({
+            "type": "assistant_message",
+            "content": text
+        })
+
+    # 文本片段先进入合并器，按时间窗口/字符数合并成帧后再发送
+    coalescer = StreamCoalescer(send_text)
+    # 每个请求结束时输出一条汇总日志
+    started = time.perf_counter()
+    summary = {"session_id": session_id, "chunks": 0, "tool_calls": 0, "tool_errors": 0, "extraction_hits": 0, "status": "success"}
+    # 回答依赖对话历史和附件，只有独立的纯文本问题才走问答缓存
+    cacheable = config.ANSWER_CACHE_ENABLED and use_cache and not history and not case_data and not images
+
     try:
-        # 处理多个case的情况
-        if isinstance(case_data, list):
-            for idx, single_case in enumerate(case_data):
-                print(f"[PROCESSING] 处理病例 {idx+1}/{len(case_data)}")
-                
-                # 为当前case发送处理进度
-                await manager.broadcast({
-                    "type": "progress",
-                    "content": f"正在处理病例 {idx+1}/{len(case_data)}",
-                    "current": idx + 1,
-                    "total": len(case_data)
-                })
-                
-                # 递归处理单个case
-                await process_chat(
-                    single_case.get("query", ""),
-                    single_case.get("history", []),
-                    single_case.get("image_url", []),
-                    single_case  # 传递单个case数据
-                )
-            return {"status": "success"}
-
-        # 构建消息上下文
-        messages = [{"role": m["role"], "content": m["content"]} for m in history]
+        if cacheable:
+            cached = await asyncio.to_thread(answer_cache.get, message)
+            if cached is not None:
+                answer, similarity = cached
+                summary["status"] = "cached"
+                for piece in split_for_stream(answer, config.STREAM_COALESCE_CHARS or len(answer)):
+                    await send_text(piece)
+                await emit({"type": "complete", "cached": True, "similarity": round(similarity, 3)})
+                return {"status": "success", "content": answer, "cached": True}
+
+        # 构建消息上下文：历史按 token 预算压缩，去掉大段病例 JSON
+        messages, history_stats = await asyncio.to_thread(compact_history, history or [])
+        if history_stats.trimmed_tokens:
+            summary["history_tokens"] = history_stats.tokens
+            summary["history_trimmed_tokens"] = history_stats.trimmed_tokens
         
         # 构建多模态消息内容
         content = [{"type": "text", "text": message}]
@@ -299,19 +645,33 @@ async def process_chat(message: str, history: List[Dict[str, str]], case_data: U
                     "text": f"\n病例信息: {', '.join(case_info)}"
                 })
         
-        # 只有在有case_data且包含image_url时才添加图片
-        if case_data and 'image_url' in case_data:
+        # 消息附带的图片和病例中的 image_url
+        image_urls = list(images or [])
+        if case_data and case_data.get('image_url'):
             if isinstance(case_data['image_url'], list):
-                for url in case_data['image_url']:  # 确保图片URL不为空
-                    content.append({
-                        "type": "image_url",
-                        "image_url": {"url": url, "detail": "auto"}
-                    })
+                image_urls.extend(url for url in case_data['image_url'] if url)
             else:
-                content.append({
-                    "type": "image_url",
-                    "image_url": {"url": case_data['image_url'], "detail": "auto"}
-                })
+                image_urls.append(case_data['image_url'])
+        # 图片库引用在这里才预处理并展开成 data URL，历史和日志中只保留引用
+        for url in image_urls:
+            image_id = parse_image_ref(url)
+            extraction = None
+            if image_id and config.REPORT_EXTRACTION_CACHE_ENABLED:
+                extraction = await asyncio.to_thread(extraction_cache.get, image_id)
+            if extraction is not None and case_data:
+                # 评估病例（含批量）时已有提取结果：注入上下文，跳过这张图片的视觉识别
+                summary["extraction_hits"] += 1
+                content.append({"type": "text", "text": format_extraction_context(image_id, extraction)})
+                continue
+            content.append({
+                "type": "image_url",
+                "image_url": await image_preprocessor.prepare(url)
+            })
+            if extraction is not None:
+                # 其他对话（如追问图片内容）照常发送图片，提取结果只作提示
+                content.append({"type": "text", "text": format_extraction_hint(image_id, extraction)})
+            elif image_id and config.REPORT_EXTRACTION_CACHE_ENABLED:
+                content.append({"type": "text", "text": f"[上图的图片ID: {image_id}]"})
         
         messages.append({"role": "user", "content": content})
         # ========== 简化版流式处理 ==========
@@ -321,7 +681,8 @@ async def process_chat(message: str, history: List[Dict[str, str]], case_data: U
             if not isinstance(chunk, dict):
                 continue
             
-            print(chunk)
+            summary["chunks"] += 1
+            logger.debug("agent chunk", extra={"sample": True, "session_id": session_id, "nodes": list(chunk)})
             
             # 跟踪工具调用
             if 'model' in chunk:
@@ -333,11 +694,8 @@ async def process_chat(message: str, history: List[Dict[str, str]], case_data: U
                                 for item in msg.content:
                                     # 处理文本内容
                                     if item.get('type') == 'text':
-                                        print(f"[DEBUG] 发送文本内容 ({len(item['text'])} 字符): {item['text'][:100]}...")        
-                                        await manager.broadcast({
-                                            "type": "assistant_message",
-                                            "content": item['text']
-                                        })
+                                        logger.debug("text fragment", extra={"sample": True, "session_id": session_id, "chars": len(item['text'])})
+                                        await coalescer.add(item['text'])
                                     
                                     # 处理工具调用
                                     elif item.get('type') == 'tool_use':
@@ -374,19 +732,18 @@ async def process_chat(message: str, history: List[Dict[str, str]], case_data: U
                                         else:
                                             tip_msg = f"\n🔧 执行工具: `{tool_name}`\n"
                                         
-                                        print(f"[TOOL] 工具调用: {tool_name}, 参数: {tool_args}")
-                                        await manager.broadcast({
+                                        summary["tool_calls"] += 1
+                                        logger.info("tool call", extra={"session_id": session_id, "tool": tool_name, "tool_call_id": tool_call_id})
+                                        await coalescer.flush()
+                                        await emit({
                                             "type": "assistant_message",
                                             "content": tip_msg
                                         })
                                         
                             # 处理纯文本内容
                             elif isinstance(msg.content, str):
-                                print(f"[DEBUG] 发送文本内容 ({len(msg.content)} 字符): {msg.content[:100]}...")        
-                                await manager.broadcast({
-                                    "type": "assistant_message",
-                                    "content": msg.content
-                                })
+                                logger.debug("text fragment", extra={"sample": True, "session_id": session_id, "chars": len(msg.content)})
+                                await coalescer.add(msg.content)
             
             # 处理工具结果
             if 'tools' in chunk:
@@ -405,9 +762,11 @@ async def process_chat(message: str, history: List[Dict[str, str]], case_data: U
                             has_error = has_error or 'Error:' in result_content
                             
                             if has_error:
-                                print(f"[TOOL] ⚠️ 工具执行错误 ({tool_name}): {result_content[:200]}")
+                                summary["tool_errors"] += 1
+                                logger.warning("tool error", extra={"session_id": session_id, "tool": tool_name, "result": result_content[:200]})
                                 error_msg = f"\n⚠️ 执行错误: {result_content[:100]}\n\n"
-                                await manager.broadcast({
+                                await coalescer.flush()
+                                await emit({
                                     "type": "assistant_message",
                                     "content": error_msg
                                 })
@@ -419,25 +778,43 @@ async def process_chat(message: str, history: List[Dict[str, str]], case_data: U
                                         output_data = json.loads(result_content)
                                         if output_data.get('errno') == 0:
                                             result_msg = f"✅ 随访通知已发送\n"
-                                            await manager.broadcast({
+                                            await coalescer.flush()
+                                            await emit({
                                                 "type": "assistant_message",
                                                 "content": result_msg
                                             })
                                     except:
                                         pass
-                                print(f"[TOOL] ✅ 工具执行成功: {tool_name}")
+                                logger.debug("tool succeeded", extra={"session_id": session_id, "tool": tool_name})
         
-        # 发送完成信号
-        await manager.broadcast({"type": "complete"})
+        # 发送完成信号（先发出合并器中剩余的文本）
+        await coalescer.flush()
+        await emit({"type": "complete", "history": history_stats.to_dict()})
+        answer = "".join(answer_parts)
+        if cacheable and not summary["tool_errors"]:
+            await asyncio.to_thread(answer_cache.put, message, answer)
+        return {"status": "success", "content": answer}
         
+    except asyncio.CancelledError:
+        summary["status"] = "cancelled"
+        raise
     except Exception as e:
-        import traceback
-        print(f"[ERROR] {e}")
-        print(traceback.format_exc())
-        await manager.broadcast({
+        summary["status"] = "error"
+        logger.exception("chat request failed", extra={"session_id": session_id})
+        await coalescer.flush()
+        await emit({
             "type": "error",
             "content": f"错误: {str(e)}"
         })
+        return {"status": "error", "message": str(e), "status_code": getattr(e, "status_code", None)}
+    finally:
+        await coalescer.aclose()
+        logger.info("chat request finished", extra=dict(
+            summary,
+            duration_ms=round((time.perf_counter() - started) * 1000),
+            fragments=coalescer.fragments_in,
+            frames=coalescer.frames_out,
+        ))
 
 @app.post("/api/external")
 async def external_trigger(request: Request):
@@ -448,14 +825,17 @@ async def external_trigger(request: Request):
     参数:
         message: 消息内容（必需）
         source: 来源标识（可选，默认 "external"）
+        session_id: 目标会话（可选）；指定时只发送给该会话，否则显式广播到所有连接
         silent: 是否静默模式（可选，默认 False）
                - False: 在聊天界面显示用户消息和 AI 回复
                - True: 只显示 AI 回复，不显示用户消息
+        no_cache: 是否跳过问答缓存（可选，默认 False）
     """
     data = await request.json()
     message = data.get("message", "")
     source = data.get("source", "external")
     silent = data.get("silent", False)
+    session_id = data.get("session_id")
     api_key = request.headers.get("X-API-Key", "")
     
     # 简单的 API Key 验证（可选）
@@ -465,18 +845,24 @@ async def external_trigger(request: Request):
     if not message:
         return {"error": "Message is required"}, 400
     
-    print(f"[EXTERNAL] 来自 {source}: {message} {'(静默)' if silent else ''}")
+    # 排队的模型调用过多时直接拒绝，避免请求堆积
+    try:
+        admission.check()
+    except Overloaded as e:
+        return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": str(e.retry_after)})
     
-    # 只有非静默消息才广播用户消息到聊天界面
+    logger.info("external trigger", extra={"source": source, "silent": silent, "session_id": session_id})
+    
+    # 只有非静默消息才发送用户消息到聊天界面
     if not silent:
-        await manager.broadcast({
+        await emit_event({
             "type": "external_trigger",
             "source": source,
             "message": message
-        })
+        }, session_id=session_id, broadcast=session_id is None)
     
-    # 处理消息（AI 回复始终会广播）
-    await process_chat(message, [])
+    # 处理消息（AI 回复会发送到目标会话，未指定会话时广播）
+    await process_chat(message, [], session_id=session_id, broadcast=session_id is None, use_cache=not data.get("no_cache"))
     
     return {
         "success": True,
@@ -491,24 +877,23 @@ async def execute_task(data):
     message = data.get("message", "")
     source = data.get("source", "external")
     silent = data.get("silent", False)
-    print('execute',data)
     
     if not message:
         return {"error": "Message is required"}, 400
     
-    print(f"[EXTERNAL] 来自 {source}: {message} {'(静默)' if silent else ''}")
+    session_id = data.get("session_id")
+    logger.info("external trigger", extra={"source": source, "silent": silent, "session_id": session_id})
     
-    # 只有非静默消息才广播用户消息到聊天界面
+    # 只有非静默消息才发送用户消息到聊天界面
     if not silent:
-        await manager.broadcast({
+        await emit_event({
             "type": "external_trigger",
             "source": source,
             "message": message
-        })
-    print("data")
+        }, session_id=session_id, broadcast=session_id is None)
     
-    # 处理消息（AI 回复始终会广播）
-    await process_chat(message, [])
+    # 处理消息（AI 回复会发送到目标会话，未指定会话时广播）
+    await process_chat(message, [], session_id=session_id, broadcast=session_id is None, use_cache=not data.get("no_cache"))
     return {"success": True, "message": "Message sent to chat" if not silent else "Message processed silently"}
 
 
@@ -516,7 +901,7 @@ async def execute_task(data):
 async def schedule_task(request: Request):
     """调度任务接口，用于创建和管理异步任务执行"""
     data = await request.json()
-    print('schedule',data)
+    logger.info("schedule task", extra={"job_id": data.get("job_id"), "task": data.get("task"), "delay_seconds": data.get("delay_seconds")})
     job_id = data.get("job_id")
     task = data.get("task")
     delay_seconds = data.get("delay_seconds")
@@ -536,9 +921,8 @@ async def schedule_task(request: Request):
 
         # 使用asyncio.create_task创建后台任务
         async def delayed_task():
-            print('delayed_task')
             await asyncio.sleep(delay_seconds)
-            print('delayed_task')
+            logger.info("delayed task fired", extra={"job_id": job_id})
             await execute_task(data)
         asyncio.create_task(delayed_task())
     else:
@@ -547,11 +931,287 @@ async def schedule_task(request: Request):
         pass
     return {'job_id': job_id}
 
+@app.post("/api/sessions/{session_id}/cancel")
+async def cancel_session_runs(session_id: str, request: Request):
+    """
+    取消会话中正在执行的 agent 运行
+    
+    参数:
+        run_id: 只取消指定运行（可选，默认取消该会话的全部运行）
+    """
+    data = await request.json() if await request.body() else {}
+    cancelled = run_registry.cancel(session_id, data.get("run_id"))
+    logger.info("cancel requested", extra={"session_id": session_id, "cancelled": cancelled})
+    return {"success": True, "session_id": session_id, "cancelled": cancelled}
+
+
+@app.on_event("startup")
+async def cleanup_local_data():
+    """启动时清理闲置过久的图片（运行期间超过总大小时在写入后清理）、遗留的上传文件、过期的对话线程和检索缓存"""
+    await asyncio.to_thread(image_store.evict)
+    await asyncio.to_thread(upload_manager.cleanup)
+    await asyncio.to_thread(thread_store.purge_expired)
+    await asyncio.to_thread(rag_cache.purge_expired)
+
+
+@app.on_event("shutdown")
+async def interrupt_batches():
+    """服务关闭（重新部署、SIGTERM）时中止正在执行的批量任务并等待日志写完，任务记为 interrupted，启动后自动恢复"""
+    runners = [runner for runner in batches.values() if runner.active]
+    for runner in runners:
+        runner.interrupt()
+    if runners:
+        await asyncio.wait([runner.task for runner in runners], timeout=config.BATCH_SHUTDOWN_TIMEOUT)
+        logger.info("batches interrupted for shutdown", extra={"batches": [runner.batch_id for runner in runners]})
+
+
+@app.on_event("shutdown")
+async def shutdown_image_preprocessor():
+    image_preprocessor.shutdown()
+
+
+@app.on_event("startup")
+async def warm_up_llm():
+    """后台预热 LLM 连接池，不阻塞启动；配置了多个端点时启动健康检查"""
+    if config.LLM_WARMUP:
+        app.state.llm_warmup = asyncio.create_task(warm_up_llm_client())
+    # 多端点时定期探测被摘除的端点
+    if custom_llm.llm_router is not None:
+        app.state.llm_health = asyncio.create_task(run_health_checks(custom_llm.llm_router, get_async_http_client()))
+
+
+@app.on_event("startup")
+async def build_local_index():
+    """后台加载（源文件变化时重建）本地检索索引，首次检索时不必等待建索引"""
+    if config.LOCAL_INDEX_MODE == "off":
+        return
+    if not local_index.available:
+        # rag_client 会因此按 off 处理，远程检索失败时不再有本地兜底
+        logger.warning("local index unavailable, install numpy to enable it", extra={"mode": config.LOCAL_INDEX_MODE})
+        return
+    app.state.local_index_build = asyncio.create_task(asyncio.to_thread(local_index.ensure))
+
+
+@app.on_event("shutdown")
+async def close_llm_clients():
+    await close_http_clients()
+    await close_rag_client()
+
+
+@app.post("/api/images")
+async def upload_image(file: UploadFile = File(...)):
+    """
+    上传图片到图片库，相同内容只保存一份
+    
+    返回:
+        id: 图片ID（内容 sha256）
+        ref: 在消息 images 字段和病例 image_url 中使用的引用 "image:<id>"
+        url: 图片访问地址
+    """
+    data = await file.read()
+    try:
+        image_id = await asyncio.to_thread(image_store.put, data)
+    except ImageStoreError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return {"id": image_id, "ref": IMAGE_REF_PREFIX + image_id, "url": f"/api/images/{image_id}", "size": len(data)}
+
+
+@app.get("/api/images/{image_id}")
+async def get_image(image_id: str, request: Request):
+    """按ID读取图片，支持 ETag 协商缓存和单段 Range 请求"""
+    located = await asyncio.to_thread(image_store.locate, image_id)
+    if located is None:
+        return JSONResponse({"error": "image not found"}, status_code=404)
+    path, mime = located
+    size = os.path.getsize(path)
+    # 内容寻址，ID 即强校验 ETag，内容永不变化
+    headers = {
+        "ETag": f'"{image_id}"',
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+    }
+    if request.headers.get("if-none-match", "").strip() in (f'"{image_id}"', f'W/"{image_id}"', "*"):
+        return Response(status_code=304, headers=headers)
+
+    start, end, status_code = 0, size - 1, 200
+    range_header = request.headers.get("range")
+    if range_header:
+        match = re.match(r"^bytes=(\d*)-(\d*)$", range_header.strip())
+        if not match or not any(match.groups()):
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        first, last = match.groups()
+        if first:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+        else:
+            # bytes=-N: 最后 N 个字节
+            start, end = max(0, size - int(last)), size - 1
+        if start > end or start >= size:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        status_code = 206
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        image_store.open_range(image_id, start, end),
+        status_code=status_code,
+        media_type=mime,
+        headers=headers,
+    )
+
+
+@app.post("/api/batch")
+async def create_batch(request: Request):
+    """
+    提交批量评估任务
+    
+    参数:
+        cases: 病例列表（必需）
+        message: 附加给每个病例的提问（可选）
+        session_id: 接收进度和结果的会话（可选）
+        force_refresh: 是否忽略记忆的病例结果、全部重新评估（可选，默认 False）
+    """
+    data = await request.json()
+    cases = data.get("cases") or []
+    if not isinstance(cases, list) or not cases:
+        return JSONResponse({"error": "cases must be a non-empty list"}, status_code=400)
+    runner = await start_batch(cases, data.get("message", ""), data.get("session_id"), force_refresh=bool(data.get("force_refresh")))
+    return {"batch_id": runner.batch_id, "total": len(cases)}
+
+
+@app.get("/api/batch")
+async def list_batches(status: Optional[str] = None, limit: int = 50):
+    """列出日志中的批量任务（status 可选，逗号分隔）"""
+    statuses = tuple(s for s in status.split(",") if s) if status else None
+    return {"batches": await asyncio.to_thread(batch_journal.list_jobs, statuses, limit)}
+
+
+@app.get("/api/batch/{batch_id}")
+async def get_batch(batch_id: str, include_results: bool = False):
+    """查询批量评估任务的进度（include_results=true 时附带各病例结果）"""
+    job = await asyncio.to_thread(batch_journal.get_job, batch_id)
+    runner = batches.get(batch_id)
+    if job is None and runner is None:
+        return JSONResponse({"error": f"Batch '{batch_id}' not found"}, status_code=404)
+    result = dict(job or {}, **(runner.summary() if runner is not None else {}))
+    if include_results:
+        results = await asyncio.to_thread(batch_journal.load_results, batch_id)
+        result["results"] = {str(index): r for index, r in sorted(results.items())}
+    return result
+
+
+async def _stop_batch(batch_id: str, status: str):
+    runner = batches.get(batch_id)
+    if runner is not None and runner.active:
+        if status == "paused":
+            runner.pause()
+        else:
+            runner.cancel()
+        return {"success": True, "batch_id": batch_id, "status": status}
+    job = await asyncio.to_thread(batch_journal.get_job, batch_id)
+    if job is None:
+        return JSONResponse({"error": f"Batch '{batch_id}' not found"}, status_code=404)
+    if job["status"] == "completed":
+        return JSONResponse({"error": f"Batch '{batch_id}' already completed"}, status_code=409)
+    await asyncio.to_thread(batch_journal.set_job_status, batch_id, status)
+    return {"success": True, "batch_id": batch_id, "status": status}
+
+
+@app.post("/api/batch/{batch_id}/cancel")
+async def cancel_batch(batch_id: str):
+    """取消批量评估任务（已完成的病例结果保留）"""
+    return await _stop_batch(batch_id, "cancelled")
+
+
+@app.post("/api/batch/{batch_id}/pause")
+async def pause_batch(batch_id: str):
+    """暂停批量评估任务，之后可通过 resume 继续"""
+    return await _stop_batch(batch_id, "paused")
+
+
+async def _restart_batch(batch_id: str, retry_failed: bool, force_refresh: bool = False):
+    runner = batches.get(batch_id)
+    if runner is not None and runner.active:
+        return JSONResponse({"error": f"Batch '{batch_id}' is already running"}, status_code=409)
+    runner = await resume_batch(batch_id, retry_failed=retry_failed, force_refresh=force_refresh)
+    if runner is None:
+        return JSONResponse({"error": f"Batch '{batch_id}' not found"}, status_code=404)
+    return {
+        "success": True,
+        "batch_id": batch_id,
+        "total": len(runner.cases),
+        "remaining": len(runner.cases) - len(runner.results),
+    }
+
+
+@app.post("/api/batch/{batch_id}/resume")
+async def resume_batch_endpoint(batch_id: str, force_refresh: bool = False):
+    """从第一个未完成的病例继续执行暂停、取消或中断的任务"""
+    return await _restart_batch(batch_id, retry_failed=False, force_refresh=force_refresh)
+
+
+@app.post("/api/batch/{batch_id}/retry-failed")
+async def retry_failed_batch(batch_id: str, force_refresh: bool = False):
+    """重新执行失败的病例，已成功的病例不会重复调用模型"""
+    return await _restart_batch(batch_id, retry_failed=True, force_refresh=force_refresh)
+
+
+@app.get("/api/threads/{thread_id}")
+async def get_thread(thread_id: str):
+    """读取服务端保存的对话线程"""
+    try:
+        validate_thread_id(thread_id)
+    except ThreadError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    if not await asyncio.to_thread(thread_store.exists, thread_id):
+        return JSONResponse({"error": f"Thread '{thread_id}' not found"}, status_code=404)
+    return {"thread_id": thread_id, "messages": await asyncio.to_thread(thread_store.load, thread_id)}
+
+
+@app.delete("/api/threads/{thread_id}")
+async def delete_thread(thread_id: str):
+    """删除服务端保存的对话线程"""
+    try:
+        validate_thread_id(thread_id)
+    except ThreadError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    if not await asyncio.to_thread(thread_store.delete, thread_id):
+        return JSONResponse({"error": f"Thread '{thread_id}' not found"}, status_code=404)
+    return {"success": True, "thread_id": thread_id}
+
+
 @app.get("/api/status")
 async def status():
     """查看当前系统状态，包括WebSocket连接数和agent状态信息"""
+    # 这些统计要查 SQLite 或遍历文件计算指纹，放到线程中并发执行，不阻塞事件循环（Render 健康检查也走这里）
+    extractions, memo, threads, rag = await asyncio.gather(
+        asyncio.to_thread(extraction_cache.stats),
+        asyncio.to_thread(case_memo.stats),
+        asyncio.to_thread(thread_store.stats),
+        asyncio.to_thread(rag_cache.stats),
+    )
     return {
         "active_connections": len(manager.active_connections),
+        "active_sessions": len(manager.sessions),
+        "connections": manager.stats(),
+        "stream": stream_stats.to_dict(),
+        "runs": run_registry.stats(),
+        "batches": {
+            "running": sum(1 for b in batches.values() if b.active),
+            "total": len(batches),
+        },
+        "images": dict(image_store.stats(), preprocess=image_preprocessor.stats()),
+        "uploads": upload_manager.stats(),
+        "report_extractions": extractions,
+        "answer_cache": answer_cache.stats(),
+        "case_memo": memo,
+        "threads": threads,
+        "rag_cache": rag,
+        "rag_client": rag_client_stats(),
+        "local_index": local_index.stats(),
+        "llm_pool": http_pool_stats(),
+        "llm_endpoints": custom_llm.llm_router.stats() if custom_llm.llm_router is not None else [],
+        "admission": admission.stats(),
+        "model_tiers": model_tier_middleware.stats(),
+        "llm_failovers": custom_llm.llm_router.failovers if custom_llm.llm_router is not None else 0,
         # "agent": "medical",
         "agent": "medical_jiedu",
         "websocket_enabled": True
@@ -630,13 +1290,13 @@ async def update_skill(skill_name: str, request: Request):
     try:
         # 写入新内容
         skill_path.write_text(content, encoding='utf-8')
-        print(f"[SKILL] 更新技能文件: {skill_name}")
+        logger.info("skill updated", extra={"skill": skill_name})
         reload_error = None
         try:
             reload_agent()
         except Exception as e:
             reload_error = str(e)
-            print(f"[SKILL] Agent reload failed: {reload_error}")
+            logger.exception("agent reload failed", extra={"skill": skill_name})
         return {
             "success": True,
             "message": f"Skill '{skill_name}' updated successfully",
@@ -645,7 +1305,7 @@ async def update_skill(skill_name: str, request: Request):
             "reload_error": reload_error
         }
     except Exception as e:
-        print(f"[SKILL] 更新失败: {e}")
+        logger.exception("skill update failed", extra={"skill": skill_name})
         return {"error": str(e)}, 500
 
 
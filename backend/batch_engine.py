@@ -0,0 +1,285 @@
+"""
+服务端批量评估引擎
+
+前端一次提交整个病例列表，服务端按可调的并发度执行：
+- 并发度采用 AIMD：成功且延迟正常时缓慢增加，遇到 429 减半，延迟超过目标时按比例回退
+- 被限流的病例按指数退避重新排队，不算失败（准入控制已负责 429 重试时不再整例重试，只降低并发度）
+- 每个病例的开始、结果和整体进度通过 notify 回调推送（通常是发给发起会话的 WebSocket）
+批量任务与 WebSocket 连接解耦，标签页关闭后任务继续执行。
+传入 journal（batch_journal.BatchJournal）时，病例状态和结果会持久化，任务可暂停、恢复和重试失败病例。
+"""
+import asyncio
+import random
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import config
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+# 被视为上游限流的 HTTP 状态码
+THROTTLE_STATUS_CODES = {429, 529}
+# 准入控制已经对 429 退避重试时，到这里的限流错误是重试用尽后的结果，不再整例重试，避免各层重试次数相乘
+DEFAULT_MAX_RETRIES = 0 if config.LLM_RATE_LIMIT_RETRIES > 0 else config.BATCH_MAX_RETRIES
+
+
+class AdaptiveConcurrency:
+    """AIMD 并发限制器"""
+
+    def __init__(
+        self,
+        initial: int = config.BATCH_CONCURRENCY_INITIAL,
+        minimum: int = config.BATCH_CONCURRENCY_MIN,
+        maximum: int = config.BATCH_CONCURRENCY_MAX,
+        latency_target: float = config.BATCH_LATENCY_TARGET,
+    ):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self._successes = 0
+        self._changed = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._changed:
+            self.in_flight -= 1
+            self._changed.notify_all()
+
+    async def _set_limit(self, limit: int, reason: str):
+        limit = min(max(limit, self.minimum), self.maximum)
+        if limit == self.limit:
+            return
+        logger.info("batch concurrency changed", extra={"from": self.limit, "to": limit, "reason": reason})
+        async with self._changed:
+            self.limit = limit
+            self._successes = 0
+            self._changed.notify_all()
+
+    async def on_success(self, latency: float):
+        if self.latency_target and latency > self.latency_target:
+            await self._set_limit(int(self.limit * 0.75), "latency")
+            return
+        # 每成功 limit 次（约一轮）加 1
+        self._successes += 1
+        if self._successes >= self.limit:
+            await self._set_limit(self.limit + 1, "success")
+
+    async def on_throttle(self):
+        await self._set_limit(self.limit // 2, "throttled")
+
+
+def is_throttled(result: Dict[str, Any]) -> bool:
+    if result.get("status_code") in THROTTLE_STATUS_CODES:
+        return True
+    message = str(result.get("message", "")).lower()
+    return "rate limit" in message or "429" in message
+
+
+class BatchRunner:
+    """一次批量评估任务"""
+
+    def __init__(
+        self,
+        cases: List[Dict],
+        run_case: Callable[[Dict, int], Awaitable[Dict[str, Any]]],
+        notify: Callable[[Dict], Awaitable[None]],
+        batch_id: Optional[str] = None,
+        session_id: Optional[str] = None,
+        concurrency: Optional[AdaptiveConcurrency] = None,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        journal=None,
+        results: Optional[Dict[int, Dict[str, Any]]] = None,
+    ):
+        """
+        Args:
+            cases: 病例列表
+            run_case: 执行单个病例的协程，返回 process_chat 的结果字典；
+                      结果中的 memo 字段（hit / miss / refresh）用于统计结果记忆的命中情况
+            notify: 推送事件的协程
+            journal: 持久化日志，可选
+            results: 已结束病例的结果（恢复任务时从日志加载），这些病例不会再执行
+        """
+        self.batch_id = batch_id or uuid.uuid4().hex[:12]
+        self.session_id = session_id
+        self.cases = cases
+        self._run_case = run_case
+        self._notify = notify
+        self.concurrency = concurrency or AdaptiveConcurrency()
+        self.max_retries = max_retries
+        self.journal = journal
+        self.status = "pending"
+        self.results: Dict[int, Dict[str, Any]] = dict(results or {})
+        # 任务被中止时的最终状态：cancel() 为 cancelled，pause() 为 paused；
+        # 其他原因的取消（服务关闭等）记为 interrupted，重启后自动恢复
+        self._stop_status: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.throttled = 0
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def completed(self) -> int:
+        return sum(1 for r in self.results.values() if r.get("status") == "success")
+
+    @property
+    def failed(self) -> int:
+        return sum(1 for r in self.results.values() if r.get("status") != "success")
+
+    def start(self) -> asyncio.Task:
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    @property
+    def active(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def cancel(self):
+        self._stop("cancelled")
+
+    def pause(self):
+        """中止执行但保留进度，之后可以从第一个未完成的病例继续"""
+        self._stop("paused")
+
+    def interrupt(self):
+        """服务关闭时中止执行，任务记为 interrupted，重启后自动恢复"""
+        if self.active:
+            self.task.cancel()
+
+    def _stop(self, status: str):
+        if self.active:
+            self._stop_status = status
+            self.task.cancel()
+
+    async def run(self):
+        self.status = "running"
+        self.started_at = time.time()
+        remaining = [i for i in range(len(self.cases)) if i not in self.results]
+        await self._journal("set_job_status", self.batch_id, "running")
+        await self._emit({
+            "type": "batch_started",
+            "total": len(self.cases),
+            "completed": self.completed,
+            "failed": self.failed,
+            "concurrency": self.concurrency.limit,
+        })
+        try:
+            await asyncio.gather(*(self._run_one(i, self.cases[i]) for i in remaining))
+            self.status = "completed"
+        except asyncio.CancelledError:
+            self.status = self._stop_status or "interrupted"
+            raise
+        finally:
+            self.finished_at = time.time()
+            if self.status != "completed":
+                # 执行到一半的病例回到 pending，恢复时重新执行
+                await self._journal("reset_cases", self.batch_id, ("running",))
+            await self._journal("set_job_status", self.batch_id, self.status)
+            await self._emit(dict(self.summary(), type="batch_complete"))
+            logger.info("batch finished", extra=self.summary())
+
+    async def _run_one(self, index: int, case: Dict):
+        attempt = 0
+        while True:
+            await self.concurrency.acquire()
+            started = time.perf_counter()
+            try:
+                await self._journal("mark_running", self.batch_id, index)
+                await self._emit({"type": "batch_case_start", "index": index, "case_id": case_id_of(case)})
+                try:
+                    result = await self._run_case(case, index)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    result = {"status": "error", "message": str(e), "status_code": getattr(e, "status_code", None)}
+                latency = time.perf_counter() - started
+            finally:
+                await self.concurrency.release()
+
+            throttled = result.get("status") != "success" and is_throttled(result)
+            if throttled:
+                # 不再重试时也降低并发度
+                self.throttled += 1
+                await self.concurrency.on_throttle()
+            if throttled and attempt < self.max_retries:
+                attempt += 1
+                delay = min(60.0, 2 ** attempt) * (0.5 + random.random())
+                logger.warning("batch case throttled", extra={"batch_id": self.batch_id, "index": index, "retry_in": round(delay, 1)})
+                await asyncio.sleep(delay)
+                continue
+
+            if result.get("memo") == "hit":
+                # 命中记忆的病例没有调用模型，延迟不参与并发度调整
+                self.memo_hits += 1
+            else:
+                if result.get("memo"):
+                    self.memo_misses += 1
+                if result.get("status") == "success":
+                    await self.concurrency.on_success(latency)
+            self.results[index] = dict(result, latency=round(latency, 2), attempts=attempt + 1)
+            await self._journal("record_result", self.batch_id, index, self.results[index])
+            await self._emit({
+                "type": "batch_case_result",
+                "index": index,
+                "case_id": case_id_of(case),
+                "status": result.get("status"),
+                "content": result.get("content", ""),
+                "error": result.get("message"),
+                "latency": round(latency, 2),
+                "memoized": result.get("memo") == "hit",
+            })
+            await self._emit(dict(self.progress(), type="batch_progress"))
+            return
+
+    def progress(self) -> dict:
+        return {
+            "total": len(self.cases),
+            "completed": self.completed,
+            "failed": self.failed,
+            "concurrency": self.concurrency.limit,
+        }
+
+    def summary(self) -> dict:
+        elapsed = (self.finished_at or time.time()) - self.started_at if self.started_at else 0
+        return dict(
+            self.progress(),
+            batch_id=self.batch_id,
+            status=self.status,
+            throttled=self.throttled,
+            memo_hits=self.memo_hits,
+            memo_misses=self.memo_misses,
+            elapsed=round(elapsed, 1),
+        )
+
+    async def _journal(self, method: str, *args):
+        """写持久化日志；写入失败只记录日志，不影响任务执行"""
+        if self.journal is None:
+            return
+        try:
+            await asyncio.to_thread(getattr(self.journal, method), *args)
+        except Exception:
+            logger.exception("batch journal write failed", extra={"batch_id": self.batch_id, "op": method})
+
+    async def _emit(self, event: Dict):
+        event["batch_id"] = self.batch_id
+        try:
+            await self._notify(event)
+        except Exception:
+            logger.exception("batch notify failed", extra={"batch_id": self.batch_id})
+
+
+def case_id_of(case: Any) -> Optional[str]:
+    if isinstance(case, dict):
+        for key in ("id", "case_id", "report_id"):
+            if key in case:
+                return str(case[key])
+    return None
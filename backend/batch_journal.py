@@ -0,0 +1,203 @@
+"""
+批量评估任务的本地日志（SQLite）
+
+记录每个批量任务的元数据和每个病例的状态，病例结果以 JSON 文件存放在 BATCH_RESULTS_DIR，
+数据库里只保存文件路径。服务重启后从日志恢复未完成的任务，已成功的病例不会重复调用模型。
+
+病例状态: pending -> running -> success / error
+任务状态: running / paused / cancelled / interrupted / completed（interrupted: 服务关闭或任务被意外取消）
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import config
+from batch_engine import case_id_of
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    batch_id   TEXT PRIMARY KEY,
+    session_id TEXT,
+    message    TEXT NOT NULL DEFAULT '',
+    status     TEXT NOT NULL,
+    total      INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cases (
+    batch_id    TEXT NOT NULL,
+    idx         INTEGER NOT NULL,
+    case_id     TEXT,
+    payload     TEXT NOT NULL,
+    status      TEXT NOT NULL DEFAULT 'pending',
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    result_path TEXT,
+    error       TEXT,
+    latency     REAL,
+    updated_at  REAL NOT NULL,
+    PRIMARY KEY (batch_id, idx)
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+"""
+
+# 重启后需要继续执行的任务状态
+RESUMABLE_STATUSES = ("running", "interrupted")
+
+
+class BatchJournal:
+    """批量任务日志；所有方法都是同步的，在事件循环中通过 asyncio.to_thread 调用"""
+
+    def __init__(self, path: str = config.BATCH_JOURNAL_PATH, results_dir: str = config.BATCH_RESULTS_DIR):
+        self.path = path
+        self.results_dir = results_dir
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    # ---------- 任务 ----------
+
+    def create_job(self, batch_id: str, cases: List[Dict], message: str = "", session_id: Optional[str] = None):
+        now = time.time()
+        with self._lock, self._db() as db:
+            db.execute(
+                "INSERT INTO jobs (batch_id, session_id, message, status, total, created_at, updated_at)"
+                " VALUES (?, ?, ?, 'running', ?, ?, ?)",
+                (batch_id, session_id, message, len(cases), now, now),
+            )
+            db.executemany(
+                "INSERT INTO cases (batch_id, idx, case_id, payload, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (batch_id, index, case_id_of(case), json.dumps(case, ensure_ascii=False), now)
+                    for index, case in enumerate(cases)
+                ],
+            )
+
+    def set_job_status(self, batch_id: str, status: str):
+        with self._lock, self._db() as db:
+            db.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE batch_id = ?", (status, time.time(), batch_id))
+
+    def get_job(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """任务元数据及各状态的病例数"""
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT * FROM jobs WHERE batch_id = ?", (batch_id,)).fetchone()
+            if row is None:
+                return None
+            counts = dict(db.execute(
+                "SELECT status, COUNT(*) FROM cases WHERE batch_id = ? GROUP BY status", (batch_id,)
+            ).fetchall())
+        job = dict(row)
+        job["completed"] = counts.get("success", 0)
+        job["failed"] = counts.get("error", 0)
+        return job
+
+    def list_jobs(self, statuses: Optional[tuple] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        query = "SELECT batch_id FROM jobs"
+        params: tuple = ()
+        if statuses:
+            query += f" WHERE status IN ({','.join('?' * len(statuses))})"
+            params = tuple(statuses)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        with self._lock:
+            ids = [row[0] for row in self._db().execute(query, params + (limit,)).fetchall()]
+        return [job for job in (self.get_job(batch_id) for batch_id in ids) if job]
+
+    # ---------- 病例 ----------
+
+    def load_cases(self, batch_id: str) -> List[Dict]:
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT payload FROM cases WHERE batch_id = ? ORDER BY idx", (batch_id,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def load_results(self, batch_id: str, statuses: tuple = ("success", "error")) -> Dict[int, Dict[str, Any]]:
+        """已结束病例的结果（index -> 结果字典），用于恢复任务时跳过这些病例"""
+        with self._lock:
+            rows = self._db().execute(
+                f"SELECT * FROM cases WHERE batch_id = ? AND status IN ({','.join('?' * len(statuses))})",
+                (batch_id,) + tuple(statuses),
+            ).fetchall()
+        results = {}
+        for row in rows:
+            result = {
+                "status": row["status"],
+                "message": row["error"],
+                "latency": row["latency"],
+                "attempts": row["attempts"],
+            }
+            if row["result_path"]:
+                result["content"] = self._read_result(row["result_path"])
+            results[row["idx"]] = result
+        return results
+
+    def mark_running(self, batch_id: str, index: int):
+        with self._lock, self._db() as db:
+            db.execute(
+                "UPDATE cases SET status = 'running', attempts = attempts + 1, updated_at = ?"
+                " WHERE batch_id = ? AND idx = ?",
+                (time.time(), batch_id, index),
+            )
+
+    def record_result(self, batch_id: str, index: int, result: Dict[str, Any]):
+        """保存病例结果：内容写入结果文件，数据库记录状态和文件路径"""
+        result_path = None
+        if result.get("status") == "success":
+            result_path = os.path.join(batch_id, f"{index}.json")
+            full_path = os.path.join(self.results_dir, result_path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            tmp_path = full_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"content": result.get("content", "")}, f, ensure_ascii=False)
+            os.replace(tmp_path, full_path)
+        with self._lock, self._db() as db:
+            db.execute(
+                "UPDATE cases SET status = ?, result_path = ?, error = ?, latency = ?, updated_at = ?"
+                " WHERE batch_id = ? AND idx = ?",
+                (
+                    "success" if result.get("status") == "success" else "error",
+                    result_path,
+                    None if result.get("status") == "success" else result.get("message"),
+                    result.get("latency"),
+                    time.time(),
+                    batch_id,
+                    index,
+                ),
+            )
+
+    def reset_cases(self, batch_id: str, statuses: tuple = ("running",)) -> int:
+        """把指定状态的病例重新置为 pending，返回受影响的数量"""
+        with self._lock, self._db() as db:
+            cursor = db.execute(
+                f"UPDATE cases SET status = 'pending', error = NULL, updated_at = ?"
+                f" WHERE batch_id = ? AND status IN ({','.join('?' * len(statuses))})",
+                (time.time(), batch_id) + tuple(statuses),
+            )
+            return cursor.rowcount
+
+    def _read_result(self, result_path: str) -> str:
+        try:
+            with open(os.path.join(self.results_dir, result_path), encoding="utf-8") as f:
+                return json.load(f).get("content", "")
+        except (OSError, ValueError):
+            logger.warning("batch result file unreadable", extra={"path": result_path})
+            return ""
+
+
+batch_journal = BatchJournal()
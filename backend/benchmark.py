@@ -0,0 +1,466 @@
+"""
+端到端压测 - 启动真实服务（app_websocket，使用 fake_llm.py 模拟的流式模型），用并发 WebSocket 客户端和 /api/external 请求施压
+
+用法:
+    python benchmark.py --clients 20 --messages 3 --external 10 --save baseline
+    python benchmark.py --clients 20 --messages 3 --external 10 --compare baseline
+    python benchmark.py --url http://127.0.0.1:8001 --pid 12345      # 压测已在运行的服务（模型由该服务的配置决定）
+
+分两个阶段：
+1. 聊天：--clients 个连接各自顺序发送 --messages 条消息，记录首帧时间（TTFT）、帧间隔（ITL）、端到端耗时
+2. 广播：所有连接保持在线，逐条发送 --external 个 /api/external 请求（不指定会话，广播给所有连接），
+   记录接口耗时，以及每次广播第一个和最后一个连接收到首帧、收到 complete 的时间差（扩散成本）
+结果包括各项的 p50 / p95 / p99、服务进程内存（RSS）和 /api/status 中的流式、准入统计。
+--save NAME 把结果保存到 DATA_DIR/benchmarks/NAME.json（或指定的 .json 路径），--compare NAME 与之对比，
+关键指标变差超过 --threshold 时标记为退化（--fail-on-regression 时以退出码 1 结束）。
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+import websockets
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MESSAGE = "我的甲状腺超声报告显示右叶有一个低回声结节，TI-RADS 3 类，需要怎么处理？"
+
+# 对比基线时检查的指标（路径, 越小越好）
+COMPARE_METRICS = [
+    ("chat.ttft_ms.p50", True),
+    ("chat.ttft_ms.p95", True),
+    ("chat.itl_ms.p95", True),
+    ("chat.e2e_ms.p50", True),
+    ("chat.e2e_ms.p95", True),
+    ("chat.e2e_ms.p99", True),
+    ("chat.throughput_rps", False),
+    ("external.http_ms.p95", True),
+    ("external.fanout_first_frame_ms.p95", True),
+    ("external.fanout_complete_ms.p95", True),
+    ("memory.rss_peak_mb", True),
+]
+# 绝对变化小于该值（毫秒 / MB / 条每秒）时不视为退化，避免亚毫秒级指标的噪声
+MIN_ABSOLUTE_CHANGE = 1.0
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"count": 0, "mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(values)
+
+    def rank(p):
+        return round(ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))], 1)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 1),
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "max": round(ordered[-1], 1),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_mb(pid: Optional[int]) -> Optional[float]:
+    """进程常驻内存（MB），读取 /proc；不支持的平台返回 None"""
+    if pid is None:
+        return None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+
+class MemorySampler:
+    def __init__(self, pid: Optional[int], interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            value = rss_mb(self.pid)
+            if value is not None:
+                self.samples.append(value)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> Dict[str, Optional[float]]:
+        if self._task is not None:
+            self._task.cancel()
+        end = rss_mb(self.pid)
+        samples = self.samples + ([end] if end is not None else [])
+        return {
+            "rss_start_mb": samples[0] if samples else None,
+            "rss_peak_mb": max(samples) if samples else None,
+            "rss_end_mb": end,
+        }
+
+
+class Client:
+    """一个 WebSocket 连接；聊天阶段等待自己的回复，广播阶段记录每次广播的到达时间"""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.broadcasts: List[Dict[str, Any]] = []
+        self.frames = 0
+        self.bytes = 0
+
+    async def recv(self) -> dict:
+        raw = await self.ws.recv()
+        self.frames += 1
+        self.bytes += len(raw)
+        return json.loads(raw)
+
+    async def chat(self, message: str, thread_id: str, timeout: float) -> Dict[str, Any]:
+        sent = time.perf_counter()
+        await self.ws.send(json.dumps({"message": message, "thread_id": thread_id}, ensure_ascii=False))
+        chunk_times: List[float] = []
+        status, error = "timeout", None
+        deadline = sent + timeout
+        while time.perf_counter() < deadline:
+            try:
+                event = await asyncio.wait_for(self.recv(), deadline - time.perf_counter())
+            except asyncio.TimeoutError:
+                break
+            kind = event.get("type")
+            if kind == "assistant_message":
+                chunk_times.append(time.perf_counter())
+            elif kind == "complete":
+                status = "success"
+                break
+            elif kind in ("error", "cancelled"):
+                status, error = "error", event.get("content") or kind
+                break
+        end = time.perf_counter()
+        return {
+            "status": status,
+            "error": error,
+            "ttft_ms": (chunk_times[0] - sent) * 1000 if chunk_times else None,
+            "itl_ms": [(b - a) * 1000 for a, b in zip(chunk_times, chunk_times[1:])],
+            "e2e_ms": (end - sent) * 1000,
+            "frames": len(chunk_times),
+        }
+
+    async def listen(self):
+        """广播阶段：按 external_trigger 划分每次广播，记录首帧和 complete 的到达时间"""
+        current = None
+        while True:
+            event = await self.recv()
+            kind = event.get("type")
+            now = time.perf_counter()
+            if kind == "external_trigger":
+                current = {"trigger": now, "first_frame": None, "complete": None, "frames": 0}
+                self.broadcasts.append(current)
+            elif current is not None and kind == "assistant_message":
+                current["frames"] += 1
+                if current["first_frame"] is None:
+                    current["first_frame"] = now
+            elif current is not None and kind in ("complete", "error"):
+                current["complete"] = now
+                current = None
+
+
+async def connect_clients(ws_url: str, count: int) -> List[Client]:
+    async def connect():
+        ws = await websockets.connect(ws_url, max_size=None, open_timeout=30)
+        client = Client(ws)
+        event = await client.recv()  # {"type": "session", ...}
+        assert event.get("type") == "session", event
+        return client
+
+    return list(await asyncio.gather(*(connect() for _ in range(count))))
+
+
+async def run_chat_phase(clients: List[Client], messages: int, message: str, timeout: float) -> Dict[str, Any]:
+    results: List[Dict[str, Any]] = []
+
+    async def drive(index: int, client: Client):
+        thread_id = f"bench-{os.getpid()}-{index}-{int(time.time())}"
+        for _ in range(messages):
+            results.append(await client.chat(message, thread_id, timeout))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(drive(i, c) for i, c in enumerate(clients)))
+    elapsed = time.perf_counter() - started
+    ok = [r for r in results if r["status"] == "success"]
+    return {
+        "requests": len(results),
+        "errors": sum(1 for r in results if r["status"] == "error"),
+        "timeouts": sum(1 for r in results if r["status"] == "timeout"),
+        "error_samples": sorted({str(r["error"])[:200] for r in results if r["error"]})[:3],
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else None,
+        "ttft_ms": percentiles([r["ttft_ms"] for r in ok if r["ttft_ms"] is not None]),
+        "itl_ms": percentiles([gap for r in ok for gap in r["itl_ms"]]),
+        "e2e_ms": percentiles([r["e2e_ms"] for r in ok]),
+        "frames_per_response": round(sum(r["frames"] for r in ok) / len(ok), 1) if ok else None,
+    }
+
+
+async def run_external_phase(http: httpx.AsyncClient, base_url: str, clients: List[Client],
+                             count: int, message: str, timeout: float) -> Dict[str, Any]:
+    listeners = [asyncio.create_task(client.listen()) for client in clients]
+    frames_before = sum(client.frames for client in clients)
+    bytes_before = sum(client.bytes for client in clients)
+    http_ms, statuses = [], {}
+    try:
+        for i in range(count):
+            started = time.perf_counter()
+            try:
+                response = await http.post(f"{base_url}/api/external", timeout=timeout, json={
+                    "message": f"{message}（广播 {i + 1}）", "source": "benchmark", "no_cache": True,
+                })
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            http_ms.append((time.perf_counter() - started) * 1000)
+            statuses[status] = statuses.get(status, 0) + 1
+        # 接口返回时回复已发送完毕，留一点时间给最后几帧到达
+        await asyncio.sleep(0.5)
+    finally:
+        for task in listeners:
+            task.cancel()
+        await asyncio.gather(*listeners, return_exceptions=True)
+
+    first_spread, complete_spread, delivered = [], [], 0
+    for i in range(count):
+        rounds = [client.broadcasts[i] for client in clients if len(client.broadcasts) > i]
+        firsts = [r["first_frame"] for r in rounds if r["first_frame"] is not None]
+        completes = [r["complete"] for r in rounds if r["complete"] is not None]
+        delivered += len(completes)
+        if len(firsts) > 1:
+            first_spread.append((max(firsts) - min(firsts)) * 1000)
+        if len(completes) > 1:
+            complete_spread.append((max(completes) - min(completes)) * 1000)
+    return {
+        "requests": count,
+        "status_codes": statuses,
+        "http_ms": percentiles(http_ms),
+        "fanout_first_frame_ms": percentiles(first_spread),
+        "fanout_complete_ms": percentiles(complete_spread),
+        "deliveries": delivered,
+        "expected_deliveries": count * len(clients),
+        "frames_received": sum(client.frames for client in clients) - frames_before,
+        "bytes_received": sum(client.bytes for client in clients) - bytes_before,
+    }
+
+
+def start_servers(args, workdir: str):
+    """启动模拟模型和真实服务，返回 (进程列表, 服务地址, 服务进程 PID, 模拟模型地址)；两者的输出写入 workdir/server.log"""
+    llm_port, app_port = free_port(), free_port()
+    fake_cmd = [sys.executable, os.path.join(BACKEND_DIR, "fake_llm.py"), "--port", str(llm_port),
+                "--ttft", str(args.ttft), "--tokens-per-sec", str(args.tokens_per_sec), "--tokens", str(args.tokens)]
+    for spec in args.tool_call:
+        fake_cmd += ["--tool-call", spec]
+    env = dict(
+        os.environ,
+        ANTHROPIC_API_BASE=f"http://127.0.0.1:{llm_port}/v1",
+        ANTHROPIC_API_KEY="benchmark",
+        ANTHROPIC_MODEL="fake",
+        DATA_DIR=os.path.join(workdir, "data"),
+        LOG_LEVEL="WARNING",
+        ANSWER_CACHE_ENABLED="false",
+        LLM_LIGHT_MODEL="",
+        PYTHONUNBUFFERED="1",
+    )
+    env.pop("LLM_ENDPOINTS", None)
+    log = open(os.path.join(workdir, "server.log"), "w")
+    fake = subprocess.Popen(fake_cmd, cwd=BACKEND_DIR, stdout=log, stderr=subprocess.STDOUT)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app_websocket:app", "--host", "127.0.0.1", "--port", str(app_port),
+         "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    return [server, fake], f"http://127.0.0.1:{app_port}", server.pid, f"http://127.0.0.1:{llm_port}"
+
+
+async def wait_ready(http: httpx.AsyncClient, base_url: str, processes: List[subprocess.Popen], log_path: str,
+                     timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for process in processes:
+            if process.poll() is not None:
+                raise RuntimeError(f"进程提前退出（退出码 {process.returncode}），见 {log_path}")
+        try:
+            if (await http.get(f"{base_url}/api/status", timeout=2)).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError("服务启动超时")
+
+
+async def server_status(http: httpx.AsyncClient, base_url: str) -> Dict[str, Any]:
+    try:
+        status = (await http.get(f"{base_url}/api/status", timeout=5)).json()
+    except (httpx.HTTPError, ValueError):
+        return {}
+    return {key: status.get(key) for key in ("stream", "admission", "connections", "llm_pool", "runs")}
+
+
+async def run(args) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    processes: List[subprocess.Popen] = []
+    base_url, pid, fake_url = args.url, args.pid, None
+    async with httpx.AsyncClient() as http:
+        try:
+            if base_url is None:
+                processes, base_url, pid, fake_url = start_servers(args, workdir)
+                await wait_ready(http, base_url, processes, os.path.join(workdir, "server.log"))
+            base_url = base_url.rstrip("/")
+            ws_url = base_url.replace("http", "ws", 1) + "/ws"
+            sampler = MemorySampler(pid)
+            sampler.start()
+            clients = await connect_clients(ws_url, args.clients)
+            try:
+                chat = await run_chat_phase(clients, args.messages, args.message, args.timeout)
+                external = await run_external_phase(http, base_url, clients, args.external, args.message, args.timeout)
+            finally:
+                await asyncio.gather(*(client.ws.close() for client in clients), return_exceptions=True)
+            memory = await sampler.stop()
+            status = await server_status(http, base_url)
+            fake_stats = None
+            if fake_url is not None:
+                try:
+                    fake_stats = (await http.get(f"{fake_url}/stats", timeout=5)).json()
+                except (httpx.HTTPError, ValueError):
+                    pass
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+    return {
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {
+            "url": args.url, "clients": args.clients, "messages": args.messages, "external": args.external,
+            "ttft": args.ttft, "tokens_per_sec": args.tokens_per_sec, "tokens": args.tokens,
+            "tool_calls": args.tool_call,
+        },
+        "chat": chat,
+        "external": external,
+        "memory": memory,
+        "fake_llm": fake_stats,
+        "server": status,
+        "workdir": workdir,
+    }
+
+
+def lookup(report: Dict[str, Any], path: str):
+    value: Any = report
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """逐项打印与基线的差异，返回退化的指标"""
+    regressions = []
+    print(f"\n与基线对比（{baseline.get('created_at')}，阈值 {threshold:.0%}）:")
+    if baseline.get("config") != report["config"]:
+        print("  ⚠️ 压测参数与基线不同，结果不能直接比较")
+    for path, lower_is_better in COMPARE_METRICS:
+        current, previous = lookup(report, path), lookup(baseline, path)
+        if current is None or previous is None:
+            continue
+        change = (current - previous) / previous if previous else 0.0
+        worse = abs(current - previous) >= MIN_ABSOLUTE_CHANGE and (
+            change > threshold if lower_is_better else change < -threshold
+        )
+        if worse:
+            regressions.append(path)
+        print(f"  {'❌' if worse else '  '} {path:<38} {previous:>10} -> {current:<10} ({change:+.1%})")
+    return regressions
+
+
+def baseline_path(name: str) -> str:
+    if name.endswith(".json") or os.sep in name:
+        return name
+    sys.path.insert(0, BACKEND_DIR)
+    import config
+    return os.path.join(config.DATA_DIR, "benchmarks", f"{name}.json")
+
+
+def print_report(report: Dict[str, Any]):
+    chat, external, memory = report["chat"], report["external"], report["memory"]
+    print(f"\n聊天: {chat['requests']} 条（错误 {chat['errors']}，超时 {chat['timeouts']}），"
+          f"耗时 {chat['elapsed_s']}s，吞吐 {chat['throughput_rps']} 条/s，平均 {chat['frames_per_response']} 帧/条")
+    for sample in chat["error_samples"]:
+        print(f"  错误示例: {sample}")
+    for name in ("ttft_ms", "itl_ms", "e2e_ms"):
+        p = chat[name]
+        print(f"  {name:<8} p50 {p['p50']}  p95 {p['p95']}  p99 {p['p99']}  max {p['max']}  (n={p['count']})")
+    print(f"广播: {external['requests']} 次，状态 {external['status_codes']}，"
+          f"送达 {external['deliveries']}/{external['expected_deliveries']}，共 {external['frames_received']} 帧 / "
+          f"{external['bytes_received']} 字节")
+    for name in ("http_ms", "fanout_first_frame_ms", "fanout_complete_ms"):
+        p = external[name]
+        print(f"  {name:<22} p50 {p['p50']}  p95 {p['p95']}  p99 {p['p99']}  max {p['max']}")
+    print(f"内存: 开始 {memory['rss_start_mb']} MB，峰值 {memory['rss_peak_mb']} MB，结束 {memory['rss_end_mb']} MB")
+    if report.get("fake_llm"):
+        print(f"模拟模型: {report['fake_llm']['requests']} 次调用，最大并发 {report['fake_llm']['max_active']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端压测：并发 WebSocket 聊天 + /api/external 广播")
+    parser.add_argument("--url", help="压测已在运行的服务，不启动模拟模型和服务")
+    parser.add_argument("--pid", type=int, help="配合 --url：服务进程 PID，用于采样内存")
+    parser.add_argument("--clients", type=int, default=10, help="并发 WebSocket 连接数")
+    parser.add_argument("--messages", type=int, default=3, help="每个连接顺序发送的消息数")
+    parser.add_argument("--external", type=int, default=5, help="/api/external 广播次数，0 表示跳过")
+    parser.add_argument("--message", default=DEFAULT_MESSAGE, help="发送的消息内容")
+    parser.add_argument("--timeout", type=float, default=300, help="单条消息的超时（秒）")
+    parser.add_argument("--ttft", type=float, default=0.5, help="模拟模型首 token 等待（秒）")
+    parser.add_argument("--tokens-per-sec", type=float, default=40, help="模拟模型输出速度")
+    parser.add_argument("--tokens", type=int, default=300, help="模拟模型每次回复的 token 数")
+    parser.add_argument("--tool-call", action="append", default=[], help="模拟模型每轮先发出的工具调用 NAME=JSON，可重复")
+    parser.add_argument("--save", help="保存结果为基线：名称（保存到 DATA_DIR/benchmarks/）或 .json 路径")
+    parser.add_argument("--compare", help="与指定基线对比")
+    parser.add_argument("--threshold", type=float, default=0.1, help="判定退化的相对变化 (默认: 0.1)")
+    parser.add_argument("--fail-on-regression", action="store_true", help="有指标退化时以退出码 1 结束")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+
+    regressions = []
+    if args.compare:
+        with open(baseline_path(args.compare), encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+    if args.save:
+        path = baseline_path(args.save)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存: {path}")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+批量评估的整例结果记忆
+
+重新跑同一个评估数据集时，病例内容、提示词/技能文件、模型和温度都没变的病例直接返回上次的评估结果，
+只有真正变化的病例才调用模型。键为以下内容的哈希：
+- 规范化后的病例 JSON（键排序；图片已存入图片库，引用即内容哈希）和附加提问
+- system.md、agent.md 和技能目录的文件指纹
+- 模型名和温度
+只记忆成功的结果；force_refresh 时跳过查询并覆盖旧结果。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import config
+from fingerprint import files_fingerprint
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS case_results (
+    memo_key   TEXT PRIMARY KEY,
+    case_id    TEXT,
+    model      TEXT NOT NULL,
+    result     TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    hits       INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def normalize_case(case: Any) -> str:
+    """病例的规范化 JSON：键排序、去掉多余空白，字段顺序和格式不同的同一病例得到相同结果"""
+    return json.dumps(case, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+class CaseMemo:
+    def __init__(
+        self,
+        path: str = config.CASE_MEMO_DB,
+        prompt_paths: Optional[List[str]] = None,
+        model: str = config.MODEL,
+        temperature: float = config.LLM_TEMPERATURE,
+    ):
+        self.path = path
+        # 影响评估结果的提示词和技能文件
+        self.prompt_paths = prompt_paths or []
+        self.model = model
+        self.temperature = temperature
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saves = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    @property
+    def prompt_version(self) -> str:
+        return files_fingerprint(self.prompt_paths)
+
+    def key(self, case: Any, message: str = "") -> str:
+        digest = hashlib.sha256()
+        for part in (normalize_case(case), message, self.prompt_version, self.model, repr(self.temperature)):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT result FROM case_results WHERE memo_key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            with db:
+                db.execute("UPDATE case_results SET hits = hits + 1 WHERE memo_key = ?", (key,))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, result: Dict[str, Any], case_id: Optional[str] = None):
+        if result.get("status") != "success":
+            return
+        stored = {"status": "success", "content": result.get("content", "")}
+        with self._lock, self._db() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO case_results (memo_key, case_id, model, result, created_at) VALUES (?, ?, ?, ?, ?)",
+                (key, case_id, self.model, json.dumps(stored, ensure_ascii=False), time.time()),
+            )
+        self.saves += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": config.CASE_MEMO_ENABLED,
+            "hits": self.hits,
+            "misses": self.misses,
+            "saves": self.saves,
+            "prompt_version": self.prompt_version,
+        }
@@ -1,3 +1,4 @@
+import json
 import os
 
 API_KEY = os.getenv("ANTHROPIC_API_KEY", "")
@@ -58,6 +59,101 @@ CUSTOM_HEADERS = {
 #     "X-API-Key": API_KEY,
 # }
 
+# ========== 模型参数 ==========
+LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.35"))
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "16000"))
+
+# ========== LLM HTTP 连接池 ==========
+# 所有 LLM 请求共享一个 HTTP 客户端
+LLM_POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "100"))
+LLM_POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "20"))
+# 空闲连接保留时间（秒）
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+# 是否启用 HTTP/2（需要安装 h2）
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "false").lower() == "true"
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+# 读取超时（秒），流式输出时为两个数据块之间的最长间隔
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "300"))
+# 等待连接池空闲连接的超时（秒）
+LLM_POOL_TIMEOUT = float(os.getenv("LLM_POOL_TIMEOUT", "30"))
+# 启动时预热连接池
+LLM_WARMUP = os.getenv("LLM_WARMUP", "true").lower() == "true"
+
+
+# ========== 多端点路由 ==========
+def _parse_llm_endpoints() -> list:
+    """
+    LLM_ENDPOINTS 为 JSON 数组，每项: {"name", "base_url", "api_key", "model", "weight", "headers"}，
+    缺省字段取 API_BASE / API_KEY / MODEL；未配置时只有默认端点
+    """
+    raw = os.getenv("LLM_ENDPOINTS", "").strip()
+    items = json.loads(raw) if raw else []
+    endpoints = []
+    for i, item in enumerate(items):
+        api_key = item.get("api_key", API_KEY)
+        endpoints.append({
+            "name": item.get("name") or f"endpoint-{i}",
+            "base_url": item.get("base_url", API_BASE),
+            "api_key": api_key,
+            "model": item.get("model", MODEL),
+            "weight": float(item.get("weight", 1)),
+            "headers": dict({"Authorization": f"Bearer {api_key}"}, **item.get("headers", {})),
+        })
+    if not endpoints:
+        endpoints.append({
+            "name": "default",
+            "base_url": API_BASE,
+            "api_key": API_KEY,
+            "model": MODEL,
+            "weight": 1.0,
+            "headers": CUSTOM_HEADERS,
+        })
+    return endpoints
+
+
+LLM_ENDPOINTS = _parse_llm_endpoints()
+# 连续失败多少次后摘除端点
+LLM_EJECT_FAILURES = int(os.getenv("LLM_EJECT_FAILURES", "3"))
+# 首次摘除时长（秒），再次摘除时翻倍
+LLM_EJECT_SECONDS = float(os.getenv("LLM_EJECT_SECONDS", "30"))
+# 延迟和错误率 EWMA 的平滑系数
+LLM_LATENCY_EWMA_ALPHA = float(os.getenv("LLM_LATENCY_EWMA_ALPHA", "0.3"))
+# 摘除端点的健康检查间隔（秒）
+LLM_HEALTH_INTERVAL = float(os.getenv("LLM_HEALTH_INTERVAL", "15"))
+
+# ========== 准入控制与限流 ==========
+# 同时进行的模型调用上限
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "16"))
+# 排队等待的模型调用超过该数量时，新的聊天请求返回 503，0 表示不拒绝
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+# 每秒请求数和每分钟 token 数上限，0 表示不限制
+LLM_RPS = float(os.getenv("LLM_RPS", "0"))
+LLM_TPM = float(os.getenv("LLM_TPM", "0"))
+# 429 后的重试次数和指数退避参数（秒）；上游返回 Retry-After 时以其为准
+# 大于 0 时由准入控制统一处理 429：ChatOpenAI 不再自行重试，批量任务也不再整例重试
+LLM_RATE_LIMIT_RETRIES = int(os.getenv("LLM_RATE_LIMIT_RETRIES", "4"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "60"))
+
+# ========== 模型分级 ==========
+# light 级模型用于闲聊和技能选择，为空时不分级，全部使用 MODEL
+LLM_LIGHT_MODEL = os.getenv("LLM_LIGHT_MODEL", "")
+LLM_LIGHT_API_BASE = os.getenv("LLM_LIGHT_API_BASE", API_BASE)
+LLM_LIGHT_API_KEY = os.getenv("LLM_LIGHT_API_KEY", API_KEY)
+LLM_LIGHT_TEMPERATURE = float(os.getenv("LLM_LIGHT_TEMPERATURE", "0.5"))
+LLM_LIGHT_MAX_TOKENS = int(os.getenv("LLM_LIGHT_MAX_TOKENS", "2000"))
+# 输入超过该 token 数时使用 heavy
+LLM_LIGHT_MAX_INPUT_TOKENS = int(os.getenv("LLM_LIGHT_MAX_INPUT_TOKENS", "12000"))
+# 本轮读取了这些技能（逗号分隔）时使用 heavy
+LLM_HEAVY_SKILLS = [s.strip() for s in os.getenv("LLM_HEAVY_SKILLS", "evaluate-record").split(",") if s.strip()]
+# 本轮工具调用达到该次数时使用 heavy，0 表示不按次数切换
+LLM_HEAVY_TOOL_CALLS = int(os.getenv("LLM_HEAVY_TOOL_CALLS", "3"))
+# 每百万 token 的价格，用于估算各级费用
+LLM_HEAVY_PRICE_IN = float(os.getenv("LLM_HEAVY_PRICE_IN", "0"))
+LLM_HEAVY_PRICE_OUT = float(os.getenv("LLM_HEAVY_PRICE_OUT", "0"))
+LLM_LIGHT_PRICE_IN = float(os.getenv("LLM_LIGHT_PRICE_IN", "0"))
+LLM_LIGHT_PRICE_OUT = float(os.getenv("LLM_LIGHT_PRICE_OUT", "0"))
+
 def _parse_cors_origins() -> list:
     env_value = os.getenv("CORS_ORIGINS", "").strip()
     origins = []
@@ -81,4 +177,155 @@ def _parse_cors_origins() -> list:
     return list(dict.fromkeys([origin for origin in origins if origin]))
 
 
-CORS_ORIGINS = _parse_cors_origins()
\ No newline at end of file
+CORS_ORIGINS = _parse_cors_origins()
+
+# ========== WebSocket 发送队列 ==========
+# 每个连接的发送队列上限（事件条数）
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# 队列满时的慢消费者策略: drop_oldest / coalesce / disconnect
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "coalesce").strip().lower()
+# 单帧发送超时（秒），超时视为连接失效
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+
+# ========== 流式文本合并 ==========
+# 文本片段合并窗口（毫秒）与字符上限，先到为准；均为 0 时逐片段发送
+STREAM_COALESCE_MS = int(os.getenv("STREAM_COALESCE_MS", "50"))
+STREAM_COALESCE_CHARS = int(os.getenv("STREAM_COALESCE_CHARS", "256"))
+
+# ========== 日志 ==========
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+# 输出格式: text / json
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip().lower()
+# 逐 chunk 日志的采样率（0 关闭，1 全量），需同时把 LOG_LEVEL 设为 DEBUG
+LOG_CHUNK_SAMPLE_RATE = float(os.getenv("LOG_CHUNK_SAMPLE_RATE", "0"))
+
+# ========== WebSocket 任务队列 ==========
+# 每个连接排队等待执行的任务上限，超过时回复繁忙
+WS_MAX_PENDING_JOBS = int(os.getenv("WS_MAX_PENDING_JOBS", "8"))
+# 每个连接可同时执行的 agent 运行数（同一会话内仍按顺序执行）
+WS_MAX_PARALLEL_RUNS = int(os.getenv("WS_MAX_PARALLEL_RUNS", "1"))
+
+# ========== 批量评估 ==========
+# 自适应并发（AIMD）的初始值、下限、上限
+BATCH_CONCURRENCY_INITIAL = int(os.getenv("BATCH_CONCURRENCY_INITIAL", "2"))
+BATCH_CONCURRENCY_MIN = int(os.getenv("BATCH_CONCURRENCY_MIN", "1"))
+BATCH_CONCURRENCY_MAX = int(os.getenv("BATCH_CONCURRENCY_MAX", "8"))
+# 单个病例的目标耗时（秒），超过时降低并发；0 表示不按耗时调整
+BATCH_LATENCY_TARGET = float(os.getenv("BATCH_LATENCY_TARGET", "120"))
+# 病例被上游限流（429）后的最大整例重试次数；LLM_RATE_LIMIT_RETRIES > 0 时 429 由准入控制重试，此项不生效
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "5"))
+# 内存中保留的已结束批量任务数
+BATCH_KEEP_FINISHED = int(os.getenv("BATCH_KEEP_FINISHED", "50"))
+# 服务关闭时等待批量任务写完日志的秒数
+BATCH_SHUTDOWN_TIMEOUT = float(os.getenv("BATCH_SHUTDOWN_TIMEOUT", "5"))
+
+# ========== 本地数据目录 ==========
+DATA_DIR = os.getenv("DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+# 批量任务日志（SQLite）和病例结果文件
+BATCH_JOURNAL_PATH = os.getenv("BATCH_JOURNAL_PATH", os.path.join(DATA_DIR, "batch_journal.db"))
+BATCH_RESULTS_DIR = os.getenv("BATCH_RESULTS_DIR", os.path.join(DATA_DIR, "batch_results"))
+# 图片库：按内容哈希存储，超过总大小或闲置天数后淘汰
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", os.path.join(DATA_DIR, "images"))
+IMAGE_STORE_MAX_MB = int(os.getenv("IMAGE_STORE_MAX_MB", "1024"))
+IMAGE_STORE_MAX_AGE_DAYS = float(os.getenv("IMAGE_STORE_MAX_AGE_DAYS", "30"))
+# 单张图片大小上限
+IMAGE_MAX_UPLOAD_MB = int(os.getenv("IMAGE_MAX_UPLOAD_MB", "20"))
+# 图片预处理（需要 Pillow）：旋正、缩放、重新压缩并选择 detail
+IMAGE_PREPROCESS_ENABLED = os.getenv("IMAGE_PREPROCESS_ENABLED", "true").lower() == "true"
+# 预处理配置: report（检查报告照片） / photo（普通照片）
+IMAGE_PREPROCESS_PROFILE = os.getenv("IMAGE_PREPROCESS_PROFILE", "report")
+# 输出格式: jpeg / webp
+IMAGE_PREPROCESS_FORMAT = os.getenv("IMAGE_PREPROCESS_FORMAT", "jpeg").strip().lower()
+# 进程池大小，0 表示 CPU 核数
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", "2"))
+# 预处理结果映射（原图哈希 + 配置 -> 处理后的图片）
+IMAGE_VARIANT_DIR = os.getenv("IMAGE_VARIANT_DIR", os.path.join(DATA_DIR, "image_variants"))
+
+# ========== 二进制分块上传 ==========
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(DATA_DIR, "uploads"))
+# 病例文件大小上限（图片使用 IMAGE_MAX_UPLOAD_MB）
+UPLOAD_MAX_MB = int(os.getenv("UPLOAD_MAX_MB", "50"))
+# 建议客户端使用的分块大小（字节）
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(256 * 1024)))
+# 未完成的上传保留多久（秒），期间可以续传
+UPLOAD_PARTIAL_TTL = float(os.getenv("UPLOAD_PARTIAL_TTL", "3600"))
+# 每个会话同时保留的未完成上传数，超出时丢弃最久没有写入的那个
+UPLOAD_MAX_PARTIAL_PER_SESSION = int(os.getenv("UPLOAD_MAX_PARTIAL_PER_SESSION", "8"))
+# 上传的病例文件保留小时数
+UPLOAD_RETENTION_HOURS = float(os.getenv("UPLOAD_RETENTION_HOURS", "24"))
+# 超过该长度的文本帧在线程中解析 JSON，避免阻塞其他连接
+WS_JSON_THREAD_THRESHOLD = int(os.getenv("WS_JSON_THREAD_THRESHOLD", str(64 * 1024)))
+
+# ========== 报告提取结果缓存 ==========
+# 按 (图片哈希, 模型) 缓存报告图片的结构化提取结果，技能修改后自动失效
+REPORT_EXTRACTION_CACHE_ENABLED = os.getenv("REPORT_EXTRACTION_CACHE_ENABLED", "true").lower() == "true"
+REPORT_EXTRACTION_DB = os.getenv("REPORT_EXTRACTION_DB", os.path.join(DATA_DIR, "report_extractions.db"))
+
+# ========== 问答缓存 ==========
+# 纯文本独立问题的相似度缓存，默认关闭
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+# 条目有效期（秒），0 表示不过期
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+# 字符 n-gram TF-IDF 余弦相似度阈值，1 表示只做精确匹配
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.92"))
+
+# ========== 病例结果记忆 ==========
+# 病例内容、提示词/技能文件、模型和温度都未变化时，批量评估直接复用上次的结果
+CASE_MEMO_ENABLED = os.getenv("CASE_MEMO_ENABLED", "true").lower() == "true"
+CASE_MEMO_DB = os.getenv("CASE_MEMO_DB", os.path.join(DATA_DIR, "case_memo.db"))
+
+# ========== 对话历史压缩 ==========
+# 发送给模型的历史消息 token 上限，0 表示不限制（仍会清理病例 JSON 和内嵌图片）
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "8000"))
+# 原样保留的最近消息条数
+HISTORY_KEEP_RECENT = int(os.getenv("HISTORY_KEEP_RECENT", "6"))
+# 较早消息摘要占用的 token 上限，0 表示直接丢弃
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "600"))
+# 历史中超过该字符数的 JSON 替换为占位
+HISTORY_STRIP_JSON_CHARS = int(os.getenv("HISTORY_STRIP_JSON_CHARS", "2000"))
+
+# ========== 对话线程 ==========
+# 服务端保存的对话历史，客户端只发送新消息和 thread_id
+THREAD_DB = os.getenv("THREAD_DB", os.path.join(DATA_DIR, "threads.db"))
+# 每个线程保留的消息条数上限，0 表示不限制
+THREAD_MAX_MESSAGES = int(os.getenv("THREAD_MAX_MESSAGES", "200"))
+# 单条消息保存的字符上限，0 表示不限制
+THREAD_MAX_MESSAGE_CHARS = int(os.getenv("THREAD_MAX_MESSAGE_CHARS", "20000"))
+# 超过该天数未更新的线程在启动时删除，0 表示不清理
+THREAD_RETENTION_DAYS = float(os.getenv("THREAD_RETENTION_DAYS", "30"))
+
+# ========== RAG 检索服务 ==========
+# 各检索源的服务地址可用 RAG_HOST 或 RAG_<SOURCE>_HOST（BOOK / GUIDELINE / TABOO）覆盖，见 rag_client.SOURCES
+RAG_TIMEOUT = float(os.getenv("RAG_TIMEOUT", "10"))
+RAG_POOL_MAX_CONNECTIONS = int(os.getenv("RAG_POOL_MAX_CONNECTIONS", "32"))
+RAG_POOL_MAX_KEEPALIVE = int(os.getenv("RAG_POOL_MAX_KEEPALIVE", "16"))
+# 检索工具返回给模型的每条内容最多保留的字符数
+RAG_RESULT_MAX_CHARS = int(os.getenv("RAG_RESULT_MAX_CHARS", "400"))
+
+# ========== RAG 检索缓存 ==========
+# 按 (appid, 归一化查询, top_k) 缓存检索结果：内存 LRU + 本地 SQLite
+RAG_CACHE_ENABLED = os.getenv("RAG_CACHE_ENABLED", "true").lower() == "true"
+RAG_CACHE_DB = os.getenv("RAG_CACHE_DB", os.path.join(DATA_DIR, "rag_cache.db"))
+RAG_CACHE_MAX_ENTRIES = int(os.getenv("RAG_CACHE_MAX_ENTRIES", "2000"))
+# 有结果的条目有效期（秒）
+RAG_CACHE_TTL = float(os.getenv("RAG_CACHE_TTL", str(7 * 86400)))
+# 没有结果的查询的有效期（秒），0 表示不缓存空结果
+RAG_CACHE_NEGATIVE_TTL = float(os.getenv("RAG_CACHE_NEGATIVE_TTL", "3600"))
+
+# ========== 本地检索索引 ==========
+# 对 skills/*/reference/*.md 和 LOCAL_INDEX_DOC_DIR 下的 .md/.txt 建立 BM25 索引，作为远程检索的补充：
+# off 不使用；fallback 远程检索失败时使用本地结果；first 先查本地，本地没有结果的查询才请求远程
+LOCAL_INDEX_MODE = os.getenv("LOCAL_INDEX_MODE", "fallback").lower()
+LOCAL_INDEX_DOC_DIR = os.getenv("LOCAL_INDEX_DOC_DIR", "")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", os.path.join(DATA_DIR, "local_index"))
+LOCAL_INDEX_BM25_K1 = float(os.getenv("LOCAL_INDEX_BM25_K1", "1.5"))
+LOCAL_INDEX_BM25_B = float(os.getenv("LOCAL_INDEX_BM25_B", "0.75"))
+# 每个文本块的最大字符数
+LOCAL_INDEX_CHUNK_CHARS = int(os.getenv("LOCAL_INDEX_CHUNK_CHARS", "600"))
+# BM25 分数低于该值的本地结果丢弃（first 模式下据此判断本地是否已有结果），0 表示不过滤
+LOCAL_INDEX_MIN_SCORE = float(os.getenv("LOCAL_INDEX_MIN_SCORE", "0"))
+# 两次检查源文件是否变化的最小间隔（秒）
+LOCAL_INDEX_CHECK_INTERVAL = float(os.getenv("LOCAL_INDEX_CHECK_INTERVAL", "60"))
+# 远程检索服务连接失败或超时后，在该秒数内不再请求，直接使用本地结果
+RAG_HOST_COOLDOWN = float(os.getenv("RAG_HOST_COOLDOWN", "30"))
@@ -0,0 +1,156 @@
+"""
+单个 WebSocket 连接的任务队列
+
+读协程只负责收帧并投递任务，agent 运行在独立的任务中执行：
+- 队列有界，满了由调用方回复繁忙
+- 每个连接最多同时执行 max_parallel 个任务
+- 相同 ordering_key（默认是会话ID）的任务严格按到达顺序执行，不同 key 之间互不阻塞
+"""
+import asyncio
+import uuid
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+import config
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class RunRegistry:
+    """全局运行登记表：session_id -> {run_id: task}，供 WebSocket 和 HTTP 接口按会话取消运行"""
+
+    def __init__(self):
+        self._runs: Dict[str, Dict[str, asyncio.Task]] = {}
+
+    def add(self, session_id: str, run_id: str, task: asyncio.Task):
+        self._runs.setdefault(session_id, {})[run_id] = task
+        task.add_done_callback(lambda _: self._remove(session_id, run_id))
+
+    def _remove(self, session_id: str, run_id: str):
+        runs = self._runs.get(session_id)
+        if runs is None:
+            return
+        runs.pop(run_id, None)
+        if not runs:
+            del self._runs[session_id]
+
+    def cancel(self, session_id: str, run_id: Optional[str] = None) -> List[str]:
+        """取消会话下的指定运行（run_id 为空时取消全部），返回被取消的 run_id"""
+        runs = self._runs.get(session_id, {})
+        cancelled = []
+        for rid, task in list(runs.items()):
+            if run_id is not None and rid != run_id:
+                continue
+            if not task.done():
+                task.cancel()
+                cancelled.append(rid)
+        return cancelled
+
+    def active_count(self) -> int:
+        return sum(len(runs) for runs in self._runs.values())
+
+    def stats(self) -> dict:
+        return {
+            "active_runs": self.active_count(),
+            "sessions_with_runs": len(self._runs),
+        }
+
+
+run_registry = RunRegistry()
+
+
+class ConnectionJobQueue:
+    """有界任务队列：每个 ordering_key 一条顺序执行链，全局共享 max_parallel 个执行槽位"""
+
+    def __init__(
+        self,
+        handler: Callable[[dict], Awaitable[None]],
+        max_pending: int = config.WS_MAX_PENDING_JOBS,
+        max_parallel: int = config.WS_MAX_PARALLEL_RUNS,
+    ):
+        self._handler = handler
+        self.max_pending = max_pending
+        self.max_parallel = max(1, max_parallel)
+        self._slots = asyncio.Semaphore(self.max_parallel)
+        # ordering_key -> 排队中的任务
+        self._queues: Dict[str, Deque[dict]] = {}
+        # ordering_key -> 负责按序执行该 key 任务的协程
+        self._drainers: Dict[str, asyncio.Task] = {}
+        self._pending = 0
+        self._closed = False
+        # run_id -> 正在执行的任务
+        self.running: Dict[str, asyncio.Task] = {}
+
+    def submit(self, job: dict) -> Optional[str]:
+        """
+        投递任务
+
+        Returns:
+            Optional[str]: 任务的 run_id；队列已满或已关闭时返回 None
+        """
+        if self._closed or self._pending >= self.max_pending:
+            return None
+        job.setdefault("run_id", uuid.uuid4().hex[:12])
+        key = job.get("ordering_key") or ""
+        self._queues.setdefault(key, deque()).append(job)
+        self._pending += 1
+        if key not in self._drainers:
+            self._drainers[key] = asyncio.create_task(self._drain(key))
+        return job["run_id"]
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def _drain(self, key: str):
+        queue = self._queues[key]
+        try:
+            while queue:
+                async with self._slots:
+                    # 等待槽位期间排队的任务可能已被 clear_pending 丢弃
+                    if not queue:
+                        break
+                    job = queue.popleft()
+                    self._pending -= 1
+                    await self._run(job)
+        finally:
+            self._drainers.pop(key, None)
+            if not queue:
+                self._queues.pop(key, None)
+
+    async def _run(self, job: dict):
+        run_id = job["run_id"]
+        task = asyncio.create_task(self._handler(job))
+        self.running[run_id] = task
+        task.add_done_callback(lambda _: self.running.pop(run_id, None))
+        run_registry.add(job.get("session_id") or "", run_id, task)
+        try:
+            # shield: 执行链被停止时由 close() 决定是否取消正在执行的运行
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # 只有执行链自身被取消时才向上抛，单个运行被取消不影响后续任务
+            if asyncio.current_task().cancelling():
+                raise
+        except Exception:
+            logger.exception("job failed", extra={"run_id": run_id})
+
+    def clear_pending(self) -> List[dict]:
+        """丢弃所有排队中（尚未开始）的任务，返回被丢弃的任务"""
+        dropped: List[dict] = []
+        for queue in self._queues.values():
+            dropped.extend(queue)
+            queue.clear()
+        self._pending = 0
+        return dropped
+
+    async def close(self, cancel_running: bool = True):
+        """停止接收新任务并丢弃排队中的任务；cancel_running 时同时取消正在执行的运行"""
+        self._closed = True
+        for drainer in list(self._drainers.values()):
+            drainer.cancel()
+        self._queues.clear()
+        self._pending = 0
+        if cancel_running:
+            for task in list(self.running.values()):
+                task.cancel()
@@ -0,0 +1,241 @@
+"""
+WebSocket 连接管理
+
+每个连接拥有一个有界的发送队列和独立的写协程：
+- 事件只做一次 JSON 编码，再投递到各个连接的队列
+- 慢客户端只会堆积自己的队列，不会拖慢其他连接
+- 队列满时按配置的慢消费者策略处理（drop_oldest / coalesce / disconnect）
+"""
+import asyncio
+import json
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import WebSocket
+
+import config
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+# 可以被丢弃或合并的流式事件类型；其余控制事件（complete / error 等）始终保留
+DROPPABLE_TYPES = {"assistant_message"}
+
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# 慢消费者被断开时使用的关闭码（1013: Try Again Later）
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+def encode_event(message: dict) -> str:
+    """与 starlette 的 send_json 保持一致的紧凑编码"""
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+class ClientConnection:
+    """单个 WebSocket 连接及其发送队列"""
+
+    def __init__(self, websocket: WebSocket, session_id: str, max_queue: int, policy: str, send_timeout: float):
+        self.websocket = websocket
+        self.session_id = session_id
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.closed = False
+        self.writer_task: Optional[asyncio.Task] = None
+        self._queue: Deque[Tuple[dict, str]] = deque()
+        self._wakeup = asyncio.Event()
+        # 统计
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def start(self, on_dead):
+        """启动写协程；发送失败或超时时调用 on_dead(websocket)"""
+        self.writer_task = asyncio.create_task(self._writer(on_dead))
+
+    def enqueue(self, message: dict, text: str) -> bool:
+        """
+        投递一条已编码的事件
+
+        Returns:
+            bool: False 表示该连接按策略应被断开
+        """
+        if self.closed:
+            return False
+        if len(self._queue) >= self.max_queue:
+            if self.policy == "disconnect":
+                return False
+            if self.policy == "coalesce" and self._coalesce_tail(message):
+                return True
+            # 为新事件腾出位置；队列里全是不可丢弃的控制事件时按慢消费者断开，避免队列无限增长
+            if not self._drop_oldest():
+                return False
+        self._queue.append((message, text))
+        self._wakeup.set()
+        return True
+
+    def _coalesce_tail(self, message: dict) -> bool:
+        """把新的文本片段合并进队尾的同类事件，避免丢字"""
+        if message.get("type") != "assistant_message" or not self._queue:
+            return False
+        last, _ = self._queue[-1]
+        if last.get("type") != "assistant_message" or set(last) != set(message):
+            return False
+        merged = dict(last, content=last.get("content", "") + message.get("content", ""))
+        self._queue[-1] = (merged, encode_event(merged))
+        self.coalesced += 1
+        return True
+
+    def _drop_oldest(self) -> bool:
+        for i, (queued, _) in enumerate(self._queue):
+            if queued.get("type") in DROPPABLE_TYPES:
+                del self._queue[i]
+                self.dropped += 1
+                return True
+        return False
+
+    async def _writer(self, on_dead):
+        try:
+            while not self.closed:
+                if not self._queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                _, text = self._queue.popleft()
+                await asyncio.wait_for(self.websocket.send_text(text), timeout=self.send_timeout)
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("websocket send failed", extra={"session_id": self.session_id, "error": str(e)})
+            on_dead(self.websocket)
+
+    async def close(self, code: int = 1000):
+        self.shutdown()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def shutdown(self):
+        """停止写协程并丢弃未发送的事件"""
+        self.closed = True
+        self._queue.clear()
+        self._wakeup.set()
+        task = self.writer_task
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+
+class ConnectionManager:
+    """WebSocket连接管理器，负责连接的生命周期管理、按会话路由和显式广播"""
+
+    def __init__(
+        self,
+        max_queue: int = config.WS_SEND_QUEUE_SIZE,
+        policy: str = config.WS_SLOW_CONSUMER_POLICY,
+        send_timeout: float = config.WS_SEND_TIMEOUT,
+    ):
+        """初始化连接管理器"""
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"未知的慢消费者策略: {policy}，可选: {', '.join(SLOW_CONSUMER_POLICIES)}")
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.active_connections: Dict[WebSocket, ClientConnection] = {}
+        # session_id -> 该会话下的连接（同一会话可能在重连期间短暂存在多个连接）
+        self.sessions: Dict[str, Set[WebSocket]] = {}
+        # 添加对话长度监控
+        self.conversation_stats = {}
+        self.slow_consumer_disconnects = 0
+        # 正在关闭慢消费者连接的任务，保留引用以免被回收
+        self._close_tasks: Set[asyncio.Task] = set()
+        # 累计统计：事件数（编码次数）、投递帧数、编码字节数
+        self.events_encoded = 0
+        self.frames_enqueued = 0
+        self.bytes_encoded = 0
+
+    async def connect(self, websocket: WebSocket, session_id: str) -> ClientConnection:
+        """接受连接并绑定会话ID，启动该连接的写协程"""
+        await websocket.accept()
+        connection = ClientConnection(websocket, session_id, self.max_queue, self.policy, self.send_timeout)
+        connection.start(self.disconnect)
+        self.active_connections[websocket] = connection
+        self.sessions.setdefault(session_id, set()).add(websocket)
+        logger.info("websocket connected", extra={"session_id": session_id, "connections": len(self.active_connections)})
+        return connection
+
+    def disconnect(self, websocket: WebSocket):
+        connection = self.active_connections.pop(websocket, None)
+        if connection is None:
+            return
+        connection.shutdown()
+        connections = self.sessions.get(connection.session_id)
+        if connections is not None:
+            connections.discard(websocket)
+            if not connections:
+                del self.sessions[connection.session_id]
+        logger.info("websocket disconnected", extra={"session_id": connection.session_id, "connections": len(self.active_connections)})
+
+    def session_of(self, websocket: WebSocket) -> Optional[str]:
+        connection = self.active_connections.get(websocket)
+        return connection.session_id if connection else None
+
+    def _enqueue(self, websockets: Iterable[WebSocket], message: dict):
+        """编码一次，投递到每个目标连接的队列"""
+        text = None
+        slow: List[ClientConnection] = []
+        for websocket in websockets:
+            connection = self.active_connections.get(websocket)
+            if connection is None:
+                continue
+            if text is None:
+                text = encode_event(message)
+                self.events_encoded += 1
+                self.bytes_encoded += len(text)
+            self.frames_enqueued += 1
+            if not connection.enqueue(message, text):
+                slow.append(connection)
+
+        for connection in slow:
+            self.slow_consumer_disconnects += 1
+            logger.warning("slow consumer disconnected", extra={"session_id": connection.session_id, "queued": connection.queued})
+            self.disconnect(connection.websocket)
+            task = asyncio.create_task(connection.close(SLOW_CONSUMER_CLOSE_CODE))
+            self._close_tasks.add(task)
+            task.add_done_callback(self._close_tasks.discard)
+
+    async def send_to_connection(self, websocket: WebSocket, message: dict):
+        """只发送给指定连接"""
+        self._enqueue([websocket], message)
+
+    async def send_to_session(self, session_id: str, message: dict):
+        """只发送给拥有该会话的连接"""
+        connections = self.sessions.get(session_id)
+        if connections:
+            self._enqueue(list(connections), message)
+
+    async def broadcast(self, message: dict):
+        """广播消息到所有连接的客户端（仅用于外部触发等显式公告）"""
+        self._enqueue(list(self.active_connections), message)
+
+    def stats(self) -> dict:
+        connections = list(self.active_connections.values())
+        return {
+            "policy": self.policy,
+            "max_queue": self.max_queue,
+            "queued": sum(c.queued for c in connections),
+            "max_queued": max((c.queued for c in connections), default=0),
+            "sent": sum(c.sent for c in connections),
+            "dropped": sum(c.dropped for c in connections),
+            "coalesced": sum(c.coalesced for c in connections),
+            "slow_consumer_disconnects": self.slow_consumer_disconnects,
+            "events_encoded": self.events_encoded,
+            "frames_enqueued": self.frames_enqueued,
+            "bytes_encoded": self.bytes_encoded,
+        }
@@ -3,19 +3,189 @@ from langchain_openai import ChatOpenAI
 import config
 import base64
 import httpx
+import time
 from typing import Dict, List, Optional
 from langchain_community.chat_models import QianfanChatEndpoint
 from langchain.chat_models import init_chat_model
+from llm_router import Endpoint, LLMRouter, RoutedChatModel
+from log_config import get_logger
 
-def create_custom_llm():
+logger = get_logger(__name__)
+
+# 所有 LLM 实例共享的 HTTP 客户端（连接池），首次使用时创建
+_async_client: Optional[httpx.AsyncClient] = None
+_sync_client: Optional[httpx.Client] = None
+# 配置了多个端点时的路由器，create_custom_llm 时创建
+llm_router: Optional[LLMRouter] = None
+# 连接池指标：请求数、失败数、最近一次预热结果
+_pool_metrics = {"requests": 0, "errors": 0, "http2": False, "warmup": None}
+
+
+def _http2_enabled() -> bool:
+    if not config.LLM_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("LLM_HTTP2 enabled but h2 is not installed, falling back to HTTP/1.1")
+        return False
+    return True
+
+
+def _client_settings() -> dict:
+    return dict(
+        http2=_http2_enabled(),
+        limits=httpx.Limits(
+            max_connections=config.LLM_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=config.LLM_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=config.LLM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            config.LLM_READ_TIMEOUT,
+            connect=config.LLM_CONNECT_TIMEOUT,
+            pool=config.LLM_POOL_TIMEOUT,
+        ),
+    )
+
+
+async def _count_request(request: httpx.Request):
+    _pool_metrics["requests"] += 1
+
+
+async def _count_response(response: httpx.Response):
+    if response.status_code >= 500 or response.status_code == 429:
+        _pool_metrics["errors"] += 1
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """共享的异步 HTTP 客户端：复用连接，避免每个请求重新建立 TLS 连接"""
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        settings = _client_settings()
+        _pool_metrics["http2"] = settings["http2"]
+        _async_client = httpx.AsyncClient(
+            event_hooks={"request": [_count_request], "response": [_count_response]},
+            **settings,
+        )
+    return _async_client
+
+
+def get_sync_http_client() -> httpx.Client:
+    global _sync_client
+    if _sync_client is None or _sync_client.is_closed:
+        _sync_client = httpx.Client(**_client_settings())
+    return _sync_client
+
+
+async def warm_up_llm_client() -> bool:
+    """
+    预热连接池：向每个端点的 /models 发一个轻量请求，提前完成 DNS、TLS 握手
+    任何 HTTP 响应（包括 401/404）都说明连接已建立；只有网络错误视为失败
+    """
+    client = get_async_http_client()
+    results = {}
+    for endpoint in config.LLM_ENDPOINTS:
+        started = time.perf_counter()
+        try:
+            response = await client.get(endpoint["base_url"].rstrip("/") + "/models", headers=endpoint["headers"])
+        except httpx.HTTPError as e:
+            results[endpoint["name"]] = {"ok": False, "error": str(e)}
+            logger.warning("llm client warm-up failed", extra={"endpoint": endpoint["name"], "error": str(e)})
+            continue
+        elapsed_ms = round((time.perf_counter() - started) * 1000)
+        results[endpoint["name"]] = {"ok": True, "status_code": response.status_code, "ms": elapsed_ms}
+        logger.info("llm client warmed up", extra={"endpoint": endpoint["name"], "status_code": response.status_code, "duration_ms": elapsed_ms})
+    _pool_metrics["warmup"] = results
+    return all(r["ok"] for r in results.values())
+
+
+def http_pool_stats() -> dict:
+    """连接池使用情况；连接明细读取 httpcore 连接池的内部状态，版本不兼容时只返回计数"""
+    stats = dict(
+        _pool_metrics,
+        max_connections=config.LLM_POOL_MAX_CONNECTIONS,
+        max_keepalive=config.LLM_POOL_MAX_KEEPALIVE,
+    )
+    pool = getattr(getattr(_async_client, "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if connections is not None:
+        try:
+            idle = sum(1 for c in connections if c.is_idle())
+            stats.update(connections=len(connections), idle=idle, active=len(connections) - idle)
+        except Exception:
+            pass
+    return stats
+
+
+async def close_http_clients():
+    global _async_client, _sync_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+    if _sync_client is not None:
+        _sync_client.close()
+        _sync_client = None
+
+
+# SDK 内部的重试次数：准入控制负责 429 重试时关闭（SDK 的重试不会让其他调用一起退让，次数还会相乘），
+# 多端点时重试由路由器换端点完成
+SDK_MAX_RETRIES = 0 if config.LLM_RATE_LIMIT_RETRIES > 0 or len(config.LLM_ENDPOINTS) > 1 else 2
+
+
+def _create_chat_openai(
+    endpoint: dict,
+    temperature: float = config.LLM_TEMPERATURE,
+    max_tokens: int = config.LLM_MAX_TOKENS,
+    max_retries: int = SDK_MAX_RETRIES,
+) -> ChatOpenAI:
     return ChatOpenAI(
-        api_key=config.API_KEY,
-        base_url=config.API_BASE,
-        model=config.MODEL,
-        temperature=0.35,
-        max_tokens=16000,
+        api_key=endpoint["api_key"],
+        base_url=endpoint["base_url"],
+        model=endpoint["model"],
+        temperature=temperature,
+        max_tokens=max_tokens,
         streaming=True,
-        default_headers=config.CUSTOM_HEADERS
+        max_retries=max_retries,
+        default_headers=endpoint["headers"],
+        http_async_client=get_async_http_client(),
+        http_client=get_sync_http_client(),
+    )
+
+
+def create_custom_llm():
+    """只有一个端点时直接返回 ChatOpenAI；多个端点（LLM_ENDPOINTS）时返回按延迟和健康状况路由的模型"""
+    global llm_router
+    if len(config.LLM_ENDPOINTS) == 1:
+        return _create_chat_openai(config.LLM_ENDPOINTS[0])
+    llm_router = LLMRouter([
+        Endpoint(
+            name=endpoint["name"],
+            llm=_create_chat_openai(endpoint),
+            base_url=endpoint["base_url"],
+            model=endpoint["model"],
+            weight=endpoint["weight"],
+            headers=endpoint["headers"],
+        )
+        for endpoint in config.LLM_ENDPOINTS
+    ])
+    logger.info("llm router configured", extra={"endpoints": [e["name"] for e in config.LLM_ENDPOINTS]})
+    return RoutedChatModel(router=llm_router)
+
+
+def create_light_llm() -> Optional[ChatOpenAI]:
+    """light 级模型（闲聊、技能选择），有自己的端点和参数；未配置 LLM_LIGHT_MODEL 时返回 None"""
+    if not config.LLM_LIGHT_MODEL:
+        return None
+    return _create_chat_openai(
+        {
+            "api_key": config.LLM_LIGHT_API_KEY,
+            "base_url": config.LLM_LIGHT_API_BASE,
+            "model": config.LLM_LIGHT_MODEL,
+            "headers": {"Authorization": f"Bearer {config.LLM_LIGHT_API_KEY}"},
+        },
+        temperature=config.LLM_LIGHT_TEMPERATURE,
+        max_tokens=config.LLM_LIGHT_MAX_TOKENS,
+        max_retries=0 if config.LLM_RATE_LIMIT_RETRIES > 0 else 2,
     )
     # return QianfanChatEndpoint(
     #     model=config.MODEL,  # 或其他文心模型
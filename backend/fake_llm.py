@@ -0,0 +1,181 @@
+"""
+模拟流式大模型 - OpenAI 兼容的 /v1/chat/completions，用于压测真实服务（见 benchmark.py）
+
+用法:
+    python fake_llm.py --port 8200 --ttft 0.5 --tokens-per-sec 40 --tokens 300
+    ANTHROPIC_API_BASE=http://127.0.0.1:8200/v1 python app_websocket.py
+
+- --ttft: 首个 token 之前的等待（秒）；--tokens-per-sec / --tokens: 之后的输出速度和长度
+- --tool-call NAME=JSON（可重复）：每一轮对话按顺序先发出这些工具调用，工具结果返回后才输出文本；
+  当前轮已完成的工具调用数按最后一条 user 消息之后带 tool_calls 的 assistant 消息计算
+- 同时支持 stream=true（SSE，stream_options.include_usage 时最后附带 usage）和非流式请求
+- GET /stats 返回请求数和最大并发数
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_TEXT = (
+    "根据您提供的检查结果，甲状腺右叶可见一低回声结节，边界清晰，TI-RADS 3 类，多数为良性病变。"
+    "建议 6 到 12 个月复查甲状腺超声，观察结节大小和形态变化；如出现颈部不适、声音嘶哑等症状应及时就诊。"
+    "日常饮食保持碘摄入均衡，不必刻意忌口，保持规律作息。"
+)
+
+
+class FakeModel:
+    def __init__(self, ttft: float, tokens_per_sec: float, tokens: int, tool_calls: list):
+        self.ttft = ttft
+        self.interval = 1.0 / tokens_per_sec if tokens_per_sec > 0 else 0.0
+        self.tokens = tokens
+        self.tool_calls = tool_calls
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+
+    def pieces(self):
+        """每个 token 取示例文本中的两个字"""
+        for i in range(self.tokens):
+            start = (i * 2) % len(SAMPLE_TEXT)
+            yield SAMPLE_TEXT[start:start + 2]
+
+    def next_tool_call(self, messages: list):
+        """当前轮还未发出的脚本工具调用；全部发出后返回 None"""
+        done = 0
+        for message in reversed(messages):
+            if message.get("role") == "user":
+                break
+            if message.get("role") == "assistant" and message.get("tool_calls"):
+                done += 1
+        if done >= len(self.tool_calls):
+            return None
+        name, args = self.tool_calls[done]
+        return {"id": f"call_{uuid.uuid4().hex[:12]}", "type": "function",
+                "function": {"name": name, "arguments": json.dumps(args, ensure_ascii=False)}}
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    model: FakeModel = None
+    protocol_version = "HTTP/1.1"
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            model = self.model
+            self._send_json(200, {"requests": model.requests, "active": model.active, "max_active": model.max_active})
+        elif self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "fake", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        model = self.model
+        with model.lock:
+            model.requests += 1
+            model.active += 1
+            model.max_active = max(model.max_active, model.active)
+        try:
+            tool_call = model.next_tool_call(body.get("messages") or [])
+            if body.get("stream"):
+                self._stream(body, tool_call)
+            else:
+                self._complete(body, tool_call)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with model.lock:
+                model.active -= 1
+
+    def _usage(self, body: dict, completion_tokens: int) -> dict:
+        prompt_tokens = len(json.dumps(body.get("messages") or [], ensure_ascii=False)) // 2
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+    def _complete(self, body: dict, tool_call):
+        time.sleep(self.model.ttft)
+        if tool_call is not None:
+            message = {"role": "assistant", "content": None, "tool_calls": [tool_call]}
+            finish, tokens = "tool_calls", 1
+        else:
+            time.sleep(self.model.interval * self.model.tokens)
+            message = {"role": "assistant", "content": "".join(self.model.pieces())}
+            finish, tokens = "stop", self.model.tokens
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": message, "finish_reason": finish}],
+            "usage": self._usage(body, tokens),
+        })
+
+    def _stream(self, body: dict, tool_call):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def send(delta: dict, finish=None, usage=None):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body.get("model", "fake"),
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish}] if delta is not None else []}
+            if usage is not None:
+                chunk["usage"] = usage
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        time.sleep(self.model.ttft)
+        if tool_call is not None:
+            send({"role": "assistant", "tool_calls": [dict(tool_call, index=0)]})
+            send({}, finish="tool_calls")
+            tokens = 1
+        else:
+            send({"role": "assistant", "content": ""})
+            for piece in self.model.pieces():
+                send({"content": piece})
+                time.sleep(self.model.interval)
+            send({}, finish="stop")
+            tokens = self.model.tokens
+        if (body.get("stream_options") or {}).get("include_usage"):
+            send(None, usage=self._usage(body, tokens))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_tool_call(spec: str):
+    name, _, args = spec.partition("=")
+    return name.strip(), json.loads(args) if args else {}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="模拟流式大模型（OpenAI 兼容接口）")
+    parser.add_argument("--port", type=int, default=8200)
+    parser.add_argument("--ttft", type=float, default=0.5, help="首个 token 前的等待（秒）")
+    parser.add_argument("--tokens-per-sec", type=float, default=40, help="输出速度，0 表示不限速")
+    parser.add_argument("--tokens", type=int, default=300, help="每次回复的 token 数")
+    parser.add_argument("--tool-call", action="append", default=[], type=parse_tool_call,
+                        help='每轮先发出的工具调用，格式 NAME=JSON，可重复，如 ls=\'{"path": "/"}\'')
+    args = parser.parse_args()
+    FakeLLMHandler.model = FakeModel(args.ttft, args.tokens_per_sec, args.tokens, args.tool_call)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeLLMHandler)
+    server.daemon_threads = True
+    print(f"🎯 模拟大模型已启动 (端口 {args.port})，TTFT {args.ttft}s，{args.tokens_per_sec} token/s，{args.tokens} token")
+    server.serve_forever()
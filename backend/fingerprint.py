@@ -0,0 +1,64 @@
+"""
+文件内容指纹
+
+用于判断技能、系统提示词等文件是否变化，从而让依赖它们的缓存自动失效。
+按 (路径, 修改时间, 大小) 记忆上次结果，文件未变化时不重复读取内容。
+"""
+import hashlib
+import os
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+# 计算指纹时忽略的目录
+_SKIP_DIRS = {"__pycache__", "outputs", ".git"}
+
+_memo: Dict[Tuple, str] = {}
+_memo_lock = threading.Lock()
+
+
+def _expand(paths: Iterable[str]) -> List[Tuple[str, str]]:
+    """(用于计算指纹的相对名称, 实际路径)；相对名称与部署目录无关"""
+    files = []
+    for path in paths:
+        path = os.path.normpath(str(path))
+        if os.path.isdir(path):
+            for directory, dirs, names in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if d not in _SKIP_DIRS)
+                for name in sorted(names):
+                    full_path = os.path.join(directory, name)
+                    files.append((os.path.relpath(full_path, os.path.dirname(path)), full_path))
+        elif os.path.exists(path):
+            files.append((os.path.basename(path), path))
+    return files
+
+
+def files_fingerprint(paths: Iterable[str]) -> str:
+    """一组文件或目录的内容指纹（sha256 前 16 位）；不存在的路径忽略"""
+    files = _expand(paths)
+    signature = []
+    for name, path in files:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        signature.append((name, path, st.st_mtime_ns, st.st_size))
+    key = tuple(signature)
+    with _memo_lock:
+        cached = _memo.get(key)
+    if cached is not None:
+        return cached
+
+    digest = hashlib.sha256()
+    for name, path, _, _ in signature:
+        digest.update(name.encode())
+        try:
+            with open(path, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        except OSError:
+            continue
+    result = digest.hexdigest()[:16]
+    with _memo_lock:
+        if len(_memo) > 256:
+            _memo.clear()
+        _memo[key] = result
+    return result
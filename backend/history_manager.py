@@ -0,0 +1,228 @@
+"""
+对话历史压缩
+
+前端每轮都会带上完整的 history，提示词长度随对话轮数无限增长。发送给模型前在这里按 token 预算压缩：
+1. 历史中大段的病例 JSON 和内嵌的 data URL 替换为简短占位（当前病例另由 case_data 传入）
+2. 最近 HISTORY_KEEP_RECENT 条消息原样保留；它们本身超出预算时从最早的一条起移入摘要，只剩一条仍超出则截断
+3. 更早的消息从新到旧放入剩余预算，放不下的合并成一条摘要（每条只保留开头），摘要也超出时直接丢弃
+token 数优先用 tiktoken 计算，未安装时按字符估算（中日韩字符约 1 token，其他字符约 4 个 1 token）。
+"""
+import contextvars
+import json
+import re
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import config
+
+try:
+    import tiktoken
+except ImportError:  # 未安装 tiktoken 时按字符估算
+    tiktoken = None
+
+# 每条消息的固定开销（角色、分隔符）
+MESSAGE_OVERHEAD = 4
+# 摘要中每条旧消息保留的字符数
+SUMMARY_SNIPPET_CHARS = 80
+
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯＀-￯]")
+_DATA_URL_RE = re.compile(r"data:[\w/+.-]+;base64,[A-Za-z0-9+/=]+")
+_JSON_FENCE_RE = re.compile(r"```(?:json)?\s*([\[{].*?[\]}])\s*```", re.S)
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(config.MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # 编码表需要联网下载，失败时退回估算
+        return None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_text(content: Any) -> str:
+    """消息内容转为纯文本；多模态内容只保留文本部分，图片记为占位"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        parts = []
+        for item in content:
+            if isinstance(item, dict) and item.get("type") == "text":
+                parts.append(item.get("text", ""))
+            elif isinstance(item, dict):
+                parts.append("[图片]")
+            else:
+                parts.append(str(item))
+        return "\n".join(parts)
+    return "" if content is None else str(content)
+
+
+# 最近一次估算的 (消息列表, 系统提示词, token 数)；同一次模型调用经过多个中间件时只计算一次
+_request_estimate: contextvars.ContextVar[Optional[Tuple[Any, Any, int]]] = contextvars.ContextVar(
+    "request_estimate", default=None
+)
+
+
+def request_tokens(request) -> int:
+    """
+    模型调用的输入 token 估算：系统提示词 + 每条消息的 token 数 + 固定开销
+
+    按消息分别计数，count_tokens 的缓存在多步调用之间可以复用（整段拼接的提示词每次都不同，缓存永远不会命中）
+    """
+    system_prompt = getattr(request, "system_prompt", None) or ""
+    messages = getattr(request, "messages", None) or []
+    cached = _request_estimate.get()
+    if cached is not None and cached[0] is messages and cached[1] == system_prompt:
+        return cached[2]
+    total = count_tokens(system_prompt) + sum(
+        count_tokens(message_text(getattr(m, "content", ""))) + MESSAGE_OVERHEAD for m in messages
+    )
+    _request_estimate.set((messages, system_prompt, total))
+    return total
+
+
+def _json_placeholder(raw: str) -> str:
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return raw
+    count = f"{len(data)} 条记录" if isinstance(data, list) else f"{len(data)} 个字段"
+    return f"[病例JSON已省略，{count}，{len(raw)} 字符]"
+
+
+def strip_bulky(text: str, max_json_chars: int = config.HISTORY_STRIP_JSON_CHARS) -> str:
+    """把 data URL 和超过 max_json_chars 的 JSON 替换为占位"""
+    text = _DATA_URL_RE.sub("[图片]", text)
+    if not max_json_chars or len(text) <= max_json_chars:
+        return text
+    text = _JSON_FENCE_RE.sub(
+        lambda m: _json_placeholder(m.group(1)) if len(m.group(1)) > max_json_chars else m.group(0), text
+    )
+    stripped = text.strip()
+    if len(stripped) > max_json_chars and stripped[:1] in "[{":
+        return _json_placeholder(stripped)
+    return text
+
+
+@dataclass
+class HistoryStats:
+    messages: int = 0
+    kept_messages: int = 0
+    summarized_messages: int = 0
+    dropped_messages: int = 0
+    original_tokens: int = 0
+    tokens: int = 0
+
+    @property
+    def trimmed_tokens(self) -> int:
+        return max(0, self.original_tokens - self.tokens)
+
+    def to_dict(self) -> Dict[str, int]:
+        return dict(asdict(self), trimmed_tokens=self.trimmed_tokens)
+
+
+def _summarize(messages: List[Dict[str, str]], budget: int) -> Tuple[Optional[Dict[str, str]], int]:
+    """较早消息的摘要：按时间顺序，每条保留开头，超出预算时从最早的开始舍弃；返回 (摘要消息, 摘要的消息数)"""
+    lines = []
+    used = count_tokens("[较早的对话摘要]") + MESSAGE_OVERHEAD
+    for m in reversed(messages):
+        snippet = " ".join(m["content"].split())
+        if len(snippet) > SUMMARY_SNIPPET_CHARS:
+            snippet = snippet[:SUMMARY_SNIPPET_CHARS] + "…"
+        line = f"{'用户' if m['role'] == 'user' else '助手'}: {snippet}"
+        cost = count_tokens(line) + 1
+        if used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+    if not lines:
+        return None, 0
+    return {"role": "user", "content": "[较早的对话摘要]\n" + "\n".join(reversed(lines))}, len(lines)
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """截断到 max_tokens 以内，保留开头"""
+    suffix = "…[已截断]"
+    if count_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid] + suffix) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + suffix
+
+
+def compact_history(
+    history: List[Dict[str, Any]],
+    budget: int = config.HISTORY_TOKEN_BUDGET,
+    keep_recent: int = config.HISTORY_KEEP_RECENT,
+    summary_budget: int = config.HISTORY_SUMMARY_TOKENS,
+) -> Tuple[List[Dict[str, str]], HistoryStats]:
+    """
+    按 token 预算压缩对话历史
+
+    Returns:
+        (发送给模型的历史消息, 压缩统计)；budget 为 0 时只做 JSON/图片清理
+    """
+    stats = HistoryStats(messages=len(history))
+    messages = []
+    for m in history:
+        if not isinstance(m, dict) or not m.get("role"):
+            continue
+        text = message_text(m.get("content"))
+        stats.original_tokens += count_tokens(text) + MESSAGE_OVERHEAD
+        messages.append({"role": m["role"], "content": strip_bulky(text)})
+
+    costs = [count_tokens(m["content"]) + MESSAGE_OVERHEAD for m in messages]
+    # 最近的消息原样保留；其余按从新到旧放入剩余预算
+    split = max(0, len(messages) - keep_recent)
+    used = sum(costs[split:])
+    if budget:
+        # 最近的消息本身超出预算：从最早的一条起移入摘要，至少留下最后一条
+        recent_budget = max(budget - summary_budget, 0)
+        while used > recent_budget and split < len(messages) - 1:
+            used -= costs[split]
+            split += 1
+        if used > recent_budget and messages:
+            last = messages[-1]
+            last["content"] = _truncate(last["content"], max(recent_budget - MESSAGE_OVERHEAD, 0))
+            used = costs[-1] = count_tokens(last["content"]) + MESSAGE_OVERHEAD
+    kept_from = split
+    if budget:
+        for i in range(split - 1, -1, -1):
+            if used + costs[i] > budget - summary_budget:
+                break
+            used += costs[i]
+            kept_from = i
+    else:
+        kept_from = 0
+
+    kept = messages[kept_from:]
+    older = messages[:kept_from]
+    summary, summarized = _summarize(older, summary_budget) if older and summary_budget else (None, 0)
+    if summary is not None:
+        kept.insert(0, summary)
+    stats.summarized_messages = summarized
+    stats.dropped_messages = len(older) - summarized
+    stats.kept_messages = len(messages) - len(older)
+    stats.tokens = sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD for m in kept)
+    return kept, stats
@@ -0,0 +1,256 @@
+"""
+视觉输入预处理
+
+图片发给模型前在进程池中处理：
+- 按 EXIF 方向旋正
+- 长边超过 max_side 时等比缩小
+- 重新压缩为 JPEG / WebP
+- 根据文字密度选择 detail：报告单等文字密集的图片用 high，小尺寸且文字稀疏的用 low，其余 auto
+
+结果按 (原图哈希, 预处理配置) 缓存：处理后的图片存入图片库，映射关系写在 IMAGE_VARIANT_DIR，
+同一份报告重复评估时既不重复计算，也不会重复消耗视觉 token。
+Pillow 为可选依赖，未安装时图片原样发送，detail 为 auto。
+"""
+import asyncio
+import hashlib
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Optional
+
+import config
+from image_store import IMAGE_REF_PREFIX, ImageStore, ImageStoreError, image_store, parse_image_ref
+from log_config import get_logger
+
+try:
+    from PIL import Image, ImageFilter, ImageOps
+except ImportError:  # Pillow 未安装
+    Image = None
+
+logger = get_logger(__name__)
+
+# 预处理配置：max_side 长边像素上限，quality 压缩质量，low_side 低于该尺寸且文字稀疏时用 low detail
+PROFILES: Dict[str, Dict[str, Any]] = {
+    # 检查报告照片：保留足够分辨率以识别小字
+    "report": {"max_side": 2048, "quality": 85, "low_side": 768, "text_edge_threshold": 12.0},
+    # 普通照片：缩到 low detail 的尺寸
+    "photo": {"max_side": 1024, "quality": 80, "low_side": 1024, "text_edge_threshold": 30.0},
+}
+
+def profile_key(name: str, fmt: str = config.IMAGE_PREPROCESS_FORMAT) -> str:
+    """配置名加参数指纹，参数改动后旧缓存自动失效"""
+    params = dict(PROFILES[name], format=fmt)
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:8]
+    return f"{name}-{digest}"
+
+
+def _text_density(img) -> float:
+    """边缘强度均值，文字越密集越高（在 256px 灰度缩略图上计算，开销很小）"""
+    gray = img.convert("L")
+    gray.thumbnail((256, 256))
+    edges = gray.filter(ImageFilter.FIND_EDGES)
+    histogram = edges.histogram()
+    total = sum(histogram) or 1
+    return sum(value * count for value, count in enumerate(histogram)) / total
+
+
+def process_image_bytes(data: bytes, profile: Dict[str, Any], fmt: str) -> Dict[str, Any]:
+    """
+    在子进程中执行的预处理（必须是模块级函数以便序列化）
+
+    Returns:
+        Dict: data 处理后的图片, detail, width, height, edge_density
+    """
+    img = Image.open(io.BytesIO(data))
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ("RGB", "L"):
+        # 透明背景铺白，避免转 JPEG 后变黑
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        rgba = img.convert("RGBA")
+        background.paste(rgba, mask=rgba.split()[-1])
+        img = background
+
+    resized = max(img.size) > profile["max_side"]
+    if resized:
+        img.thumbnail((profile["max_side"], profile["max_side"]), Image.LANCZOS)
+
+    density = _text_density(img)
+    if density >= profile["text_edge_threshold"]:
+        detail = "high"
+    elif max(img.size) <= profile["low_side"]:
+        detail = "low"
+    else:
+        detail = "auto"
+
+    out = io.BytesIO()
+    if fmt == "WEBP":
+        img.save(out, "WEBP", quality=profile["quality"], method=4)
+    else:
+        img.convert("RGB").save(out, "JPEG", quality=profile["quality"], optimize=True, progressive=True)
+    output = out.getvalue()
+
+    # 没有缩小且重新压缩后反而更大时保留原图
+    if not resized and len(output) >= len(data):
+        output = data
+    return {
+        "data": output,
+        "detail": detail,
+        "width": img.size[0],
+        "height": img.size[1],
+        "edge_density": round(density, 2),
+    }
+
+
+class ImagePreprocessor:
+    def __init__(
+        self,
+        store: ImageStore = image_store,
+        variant_dir: str = config.IMAGE_VARIANT_DIR,
+        profile: str = config.IMAGE_PREPROCESS_PROFILE,
+        fmt: str = config.IMAGE_PREPROCESS_FORMAT,
+        workers: int = config.IMAGE_PREPROCESS_WORKERS,
+        enabled: bool = config.IMAGE_PREPROCESS_ENABLED,
+    ):
+        self.store = store
+        self.variant_dir = variant_dir
+        self.profile = profile if profile in PROFILES else "report"
+        self.fmt = fmt
+        self.workers = workers
+        self.enabled = enabled and Image is not None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.processed = 0
+        self.cache_hits = 0
+        self.failures = 0
+        self.pool_restarts = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.process_seconds = 0.0
+        if enabled and Image is None:
+            logger.warning("Pillow not installed, image preprocessing disabled")
+
+    async def prepare(self, value: str, profile: Optional[str] = None) -> Dict[str, str]:
+        """
+        把消息中的图片（图片库引用或 data URL）转换成发给模型的 image_url 内容
+
+        Returns:
+            Dict: {"url": data URL 或外部 URL, "detail": low / high / auto}
+        """
+        if isinstance(value, str) and value.startswith("data:"):
+            value = IMAGE_REF_PREFIX + await asyncio.to_thread(self.store.put_data_url, value)
+        image_id = parse_image_ref(value)
+        if image_id is None:
+            # 外部 URL 由模型服务自行下载
+            return {"url": value, "detail": "auto"}
+        if not self.enabled:
+            return {"url": await asyncio.to_thread(self.store.resolve, value), "detail": "auto"}
+
+        key = profile_key(profile or self.profile, self.fmt)
+        variant = await asyncio.to_thread(self._load_variant, image_id, key)
+        if variant is not None:
+            self.cache_hits += 1
+            return variant
+
+        found = await asyncio.to_thread(self.store.read, image_id)
+        if found is None:
+            raise ImageStoreError(f"image '{image_id}' not found")
+        data, _ = found
+        started = time.perf_counter()
+        pool = self._executor()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                pool, process_image_bytes, data, PROFILES[profile or self.profile], self.fmt.upper()
+            )
+        except BrokenProcessPool:
+            # 工作进程异常退出（如 OOM）后进程池不再可用，丢弃后下次重新创建
+            self.failures += 1
+            self._reset_pool(pool)
+            logger.warning("image preprocessing pool broken, restarting", extra={"image_id": image_id})
+            return {"url": await asyncio.to_thread(self.store.resolve, value), "detail": "auto"}
+        except Exception:
+            # 无法解码等情况下退回原图
+            self.failures += 1
+            logger.exception("image preprocessing failed", extra={"image_id": image_id})
+            return {"url": await asyncio.to_thread(self.store.resolve, value), "detail": "auto"}
+        elapsed = time.perf_counter() - started
+
+        self.processed += 1
+        self.process_seconds += elapsed
+        self.bytes_in += len(data)
+        self.bytes_out += len(result["data"])
+        output_id = await asyncio.to_thread(self.store.put, result["data"])
+        meta = {
+            "source_id": image_id,
+            "image_id": output_id,
+            "detail": result["detail"],
+            "width": result["width"],
+            "height": result["height"],
+            "edge_density": result["edge_density"],
+        }
+        await asyncio.to_thread(self._save_variant, image_id, key, meta)
+        logger.info("image preprocessed", extra=dict(
+            meta,
+            bytes_in=len(data),
+            bytes_out=len(result["data"]),
+            duration_ms=round(elapsed * 1000),
+        ))
+        return {"url": await asyncio.to_thread(self.store.resolve, IMAGE_REF_PREFIX + output_id), "detail": result["detail"]}
+
+    def _variant_path(self, image_id: str, key: str) -> str:
+        return os.path.join(self.variant_dir, image_id[:2], f"{image_id}.{key}.json")
+
+    def _load_variant(self, image_id: str, key: str) -> Optional[Dict[str, str]]:
+        try:
+            with open(self._variant_path(image_id, key), encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # 处理后的图片可能已被图片库淘汰，此时重新处理
+        data_url = self.store.to_data_url(meta["image_id"])
+        if data_url is None:
+            return None
+        return {"url": data_url, "detail": meta["detail"]}
+
+    def _save_variant(self, image_id: str, key: str, meta: Dict[str, Any]):
+        path = self._variant_path(image_id, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path)
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers or None)
+        return self._pool
+
+    def _reset_pool(self, pool: ProcessPoolExecutor):
+        """关闭损坏的进程池；并发请求可能已经替换过，只重置仍是当前的那个"""
+        pool.shutdown(wait=False, cancel_futures=True)
+        if self._pool is pool:
+            self._pool = None
+            self.pool_restarts += 1
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "profile": self.profile,
+            "format": self.fmt,
+            "processed": self.processed,
+            "cache_hits": self.cache_hits,
+            "failures": self.failures,
+            "pool_restarts": self.pool_restarts,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "avg_process_ms": round(self.process_seconds * 1000 / self.processed, 1) if self.processed else 0,
+        }
+
+
+image_preprocessor = ImagePreprocessor()
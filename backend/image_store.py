@@ -0,0 +1,266 @@
+"""
+按内容寻址的图片存储
+
+- 图片以 sha256 作为 ID，相同内容只存一份：{IMAGE_STORE_DIR}/{id[:2]}/{id}.{ext}
+- 消息和病例中用 "image:<id>" 引用图片，不再反复内嵌 base64；调用模型前再解析成 data URL
+- 文件修改时间记录最后一次访问，按总大小（LRU）和最长闲置时间淘汰
+所有方法都是同步的文件操作，在事件循环中通过 asyncio.to_thread 调用。
+"""
+import base64
+import hashlib
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import config
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+IMAGE_REF_PREFIX = "image:"
+
+_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+_DATA_URL_RE = re.compile(r"^data:(image/[\w.+-]+);base64,(.*)$", re.S)
+# 本服务自己的图片地址也视为引用（模型访问不到内网地址，需要转成 data URL）
+_SERVED_URL_RE = re.compile(r"^(?:https?://[^/]+)?/api/images/([0-9a-f]{64})$")
+
+# 文件头 -> (扩展名, MIME)
+_SIGNATURES = [
+    (b"\xff\xd8\xff", ("jpg", "image/jpeg")),
+    (b"\x89PNG\r\n\x1a\n", ("png", "image/png")),
+    (b"GIF87a", ("gif", "image/gif")),
+    (b"GIF89a", ("gif", "image/gif")),
+]
+MIME_TYPES = {ext: mime for _, (ext, mime) in _SIGNATURES}
+MIME_TYPES["webp"] = "image/webp"
+
+
+class ImageStoreError(ValueError):
+    """图片数据无法识别或超过大小限制"""
+
+
+def sniff_image_type(data: bytes) -> Tuple[str, str]:
+    """根据文件头判断图片类型，返回 (扩展名, MIME)"""
+    for signature, kind in _SIGNATURES:
+        if data.startswith(signature):
+            return kind
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp", "image/webp"
+    raise ImageStoreError("unsupported image format")
+
+
+def parse_image_ref(value: Any) -> Optional[str]:
+    """从 "image:<id>" 或 /api/images/<id> 中取出图片ID，不是引用时返回 None"""
+    if not isinstance(value, str):
+        return None
+    if value.startswith(IMAGE_REF_PREFIX):
+        image_id = value[len(IMAGE_REF_PREFIX):]
+        return image_id if _ID_RE.match(image_id) else None
+    match = _SERVED_URL_RE.match(value)
+    return match.group(1) if match else None
+
+
+class ImageStore:
+    def __init__(
+        self,
+        root: str = config.IMAGE_STORE_DIR,
+        max_bytes: int = config.IMAGE_STORE_MAX_MB * 1024 * 1024,
+        max_age: float = config.IMAGE_STORE_MAX_AGE_DAYS * 86400,
+        max_image_bytes: int = config.IMAGE_MAX_UPLOAD_MB * 1024 * 1024,
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_image_bytes = max_image_bytes
+        self._lock = threading.Lock()
+        # 当前总大小，首次使用时扫描目录得到
+        self._total_bytes: Optional[int] = None
+        self.hits = 0
+        self.writes = 0
+        self.evicted = 0
+
+    # ---------- 写入 ----------
+
+    def put(self, data: bytes) -> str:
+        """保存图片并返回ID；内容已存在时只刷新访问时间"""
+        if not data:
+            raise ImageStoreError("empty image")
+        if self.max_image_bytes and len(data) > self.max_image_bytes:
+            raise ImageStoreError(f"image exceeds {self.max_image_bytes} bytes")
+        ext, _ = sniff_image_type(data)
+        image_id = hashlib.sha256(data).hexdigest()
+        path = self._path(image_id, ext)
+        with self._lock:
+            if os.path.exists(path):
+                self.hits += 1
+                _touch(path)
+                return image_id
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self.writes += 1
+            self._total_bytes = self._scan_total() if self._total_bytes is None else self._total_bytes + len(data)
+            over_limit = self.max_bytes and self._total_bytes > self.max_bytes
+        if over_limit:
+            self.evict()
+        return image_id
+
+    def put_data_url(self, data_url: str) -> str:
+        match = _DATA_URL_RE.match(data_url)
+        if not match:
+            raise ImageStoreError("not a base64 image data URL")
+        try:
+            data = base64.b64decode(match.group(2), validate=False)
+        except ValueError as e:
+            raise ImageStoreError(f"invalid base64 data: {e}") from e
+        return self.put(data)
+
+    def ingest(self, value: str) -> str:
+        """把 data URL 存入图片库并返回 "image:<id>" 引用；其他值（已是引用或外部 URL）原样返回"""
+        if isinstance(value, str) and value.startswith("data:"):
+            return IMAGE_REF_PREFIX + self.put_data_url(value)
+        return value
+
+    # ---------- 读取 ----------
+
+    def locate(self, image_id: str) -> Optional[Tuple[str, str]]:
+        """返回 (文件路径, MIME)，不存在时返回 None"""
+        if not _ID_RE.match(image_id or ""):
+            return None
+        directory = os.path.join(self.root, image_id[:2])
+        for ext, mime in MIME_TYPES.items():
+            path = os.path.join(directory, f"{image_id}.{ext}")
+            if os.path.exists(path):
+                return path, mime
+        return None
+
+    def open_range(self, image_id: str, start: int = 0, end: Optional[int] = None, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        """按块读取 [start, end] 字节区间，用于流式响应"""
+        located = self.locate(image_id)
+        if located is None:
+            return
+        path, _ = located
+        _touch(path)
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def read(self, image_id: str) -> Optional[Tuple[bytes, str]]:
+        """返回 (图片内容, MIME)，不存在时返回 None"""
+        located = self.locate(image_id)
+        if located is None:
+            return None
+        path, mime = located
+        _touch(path)
+        with open(path, "rb") as f:
+            return f.read(), mime
+
+    def to_data_url(self, image_id: str) -> Optional[str]:
+        found = self.read(image_id)
+        if found is None:
+            return None
+        data, mime = found
+        return to_data_url(data, mime)
+
+    def resolve(self, value: str) -> str:
+        """把图片引用解析成模型可用的 data URL；不是引用时原样返回"""
+        image_id = parse_image_ref(value)
+        if image_id is None:
+            return value
+        data_url = self.to_data_url(image_id)
+        if data_url is None:
+            raise ImageStoreError(f"image '{image_id}' not found")
+        return data_url
+
+    # ---------- 淘汰 ----------
+
+    def _files(self) -> List[Tuple[float, int, str]]:
+        """(最后访问时间, 大小, 路径) 列表"""
+        files = []
+        if not os.path.isdir(self.root):
+            return files
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def _scan_total(self) -> int:
+        return sum(size for _, size, _ in self._files())
+
+    def evict(self) -> int:
+        """删除闲置超过 max_age 的图片，再按最久未访问的顺序删除直到总大小不超过 max_bytes"""
+        with self._lock:
+            files = sorted(self._files())
+            total = sum(size for _, size, _ in files)
+            now = time.time()
+            removed = 0
+            for mtime, size, path in files:
+                expired = self.max_age and now - mtime > self.max_age
+                if not expired and not (self.max_bytes and total > self.max_bytes):
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            self._total_bytes = total
+            self.evicted += removed
+        if removed:
+            logger.info("image store evicted", extra={"removed": removed, "total_bytes": total})
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "total_bytes": self._total_bytes,
+            "max_bytes": self.max_bytes,
+            "writes": self.writes,
+            "dedup_hits": self.hits,
+            "evicted": self.evicted,
+        }
+
+    def _path(self, image_id: str, ext: str) -> str:
+        return os.path.join(self.root, image_id[:2], f"{image_id}.{ext}")
+
+
+def to_data_url(data: bytes, mime: str) -> str:
+    return f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def ingest_case_images(case: Any, store: "ImageStore" = None) -> Any:
+    """把病例 image_url 中内嵌的 data URL 存入图片库并替换为引用，返回新的病例字典"""
+    store = store or image_store
+    if not isinstance(case, dict) or not case.get("image_url"):
+        return case
+    urls = case["image_url"]
+    if isinstance(urls, list):
+        return dict(case, image_url=[store.ingest(url) for url in urls])
+    return dict(case, image_url=store.ingest(urls))
+
+
+def _touch(path: str):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+image_store = ImageStore()
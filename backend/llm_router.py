@@ -0,0 +1,237 @@
+"""
+多端点 LLM 路由
+
+config.LLM_ENDPOINTS 配置了多个代理/密钥时，create_custom_llm 返回 RoutedChatModel，每次调用按以下规则选择端点：
+- 评分 = 首包延迟 EWMA × (1 + 4 × 错误率 EWMA) / 权重，按权重随机抽两个端点取评分低的（power of two choices），
+  其余端点按评分排序作为备选
+- 连续失败 LLM_EJECT_FAILURES 次的端点被摘除，摘除时间从 LLM_EJECT_SECONDS 起逐次翻倍（最长 10 分钟）；
+  到期后放行一个请求试探，后台健康检查也会提前恢复已经可达的端点
+- 收到第一个数据块之前失败（连接错误、超时、5xx、429、401/403）时换下一个端点重试，请求本身不会丢失；
+  已经开始输出后失败则直接报错，避免重复输出
+"""
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel, agenerate_from_stream, generate_from_stream
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from pydantic import ConfigDict
+
+import config
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+# 摘除时间上限（秒）
+MAX_EJECT_SECONDS = 600
+# 不换端点重试的状态码：请求本身有问题，换端点也会失败
+NON_RETRYABLE_STATUS = {400, 404, 413, 422}
+
+
+@dataclass
+class Endpoint:
+    name: str
+    llm: Any
+    base_url: str
+    model: str
+    weight: float = 1.0
+    headers: Dict[str, str] = field(default_factory=dict)
+    latency: Optional[float] = None
+    error_rate: float = 0.0
+    requests: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    ejected_until: float = 0.0
+    ejections: int = 0
+    last_error: Optional[str] = None
+
+    @property
+    def ejected(self) -> bool:
+        return self.ejected_until > time.time()
+
+
+def is_retryable(error: BaseException) -> bool:
+    return getattr(error, "status_code", None) not in NON_RETRYABLE_STATUS
+
+
+class LLMRouter:
+    def __init__(
+        self,
+        endpoints: List[Endpoint],
+        eject_failures: int = config.LLM_EJECT_FAILURES,
+        eject_seconds: float = config.LLM_EJECT_SECONDS,
+        alpha: float = config.LLM_LATENCY_EWMA_ALPHA,
+    ):
+        if not endpoints:
+            raise ValueError("at least one LLM endpoint is required")
+        self.endpoints = endpoints
+        self.eject_failures = max(1, eject_failures)
+        self.eject_seconds = eject_seconds
+        self.alpha = alpha
+        self.failovers = 0
+
+    def _score(self, endpoint: Endpoint) -> float:
+        known = [e.latency for e in self.endpoints if e.latency is not None]
+        # 还没有延迟数据的端点按已知的最低延迟计算，保证新端点能被选中
+        latency = endpoint.latency if endpoint.latency is not None else (min(known) if known else 1.0)
+        return latency * (1 + 4 * endpoint.error_rate) / max(endpoint.weight, 1e-6)
+
+    def candidates(self) -> List[Endpoint]:
+        """本次请求依次尝试的端点；摘除中的端点排在最后，全部不可用时仍会尝试"""
+        available = [e for e in self.endpoints if not e.ejected]
+        ejected = sorted((e for e in self.endpoints if e.ejected), key=lambda e: e.ejected_until)
+        ranked = sorted(available, key=self._score)
+        if len(available) >= 2:
+            a, b = random.choices(available, weights=[max(e.weight, 1e-6) for e in available], k=2)
+            first = a if self._score(a) <= self._score(b) else b
+            ranked.remove(first)
+            ranked.insert(0, first)
+        return ranked + ejected
+
+    def record_success(self, endpoint: Endpoint, latency: float):
+        endpoint.requests += 1
+        endpoint.latency = latency if endpoint.latency is None else (
+            self.alpha * latency + (1 - self.alpha) * endpoint.latency
+        )
+        endpoint.error_rate *= 1 - self.alpha
+        if endpoint.consecutive_failures or endpoint.ejected_until:
+            logger.info("llm endpoint recovered", extra={"endpoint": endpoint.name})
+        endpoint.consecutive_failures = 0
+        endpoint.ejected_until = 0.0
+        endpoint.ejections = 0
+
+    def record_failure(self, endpoint: Endpoint, error: BaseException):
+        endpoint.requests += 1
+        endpoint.failures += 1
+        endpoint.consecutive_failures += 1
+        endpoint.error_rate = self.alpha + (1 - self.alpha) * endpoint.error_rate
+        endpoint.last_error = f"{type(error).__name__}: {error}"[:300]
+        if endpoint.consecutive_failures >= self.eject_failures and not endpoint.ejected:
+            duration = min(MAX_EJECT_SECONDS, self.eject_seconds * 2 ** endpoint.ejections)
+            endpoint.ejected_until = time.time() + duration
+            endpoint.ejections += 1
+            logger.warning("llm endpoint ejected", extra={
+                "endpoint": endpoint.name,
+                "seconds": duration,
+                "error": endpoint.last_error,
+            })
+
+    async def health_check(self, client):
+        """探测摘除中的端点：GET {base_url}/models 返回非 5xx 即提前放行一个试探请求"""
+        for endpoint in self.endpoints:
+            if not endpoint.ejected:
+                continue
+            try:
+                response = await client.get(endpoint.base_url.rstrip("/") + "/models", headers=endpoint.headers, timeout=5)
+            except Exception:
+                continue
+            if response.status_code < 500:
+                endpoint.ejected_until = 0.0
+                # 试探请求再失败一次就重新摘除
+                endpoint.consecutive_failures = self.eject_failures - 1
+                logger.info("llm endpoint re-admitted", extra={"endpoint": endpoint.name, "status_code": response.status_code})
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "name": e.name,
+                "base_url": e.base_url,
+                "model": e.model,
+                "weight": e.weight,
+                "ejected": e.ejected,
+                "latency_ms": round(e.latency * 1000) if e.latency is not None else None,
+                "error_rate": round(e.error_rate, 3),
+                "requests": e.requests,
+                "failures": e.failures,
+                "last_error": e.last_error,
+            }
+            for e in self.endpoints
+        ]
+
+
+async def run_health_checks(router: LLMRouter, client, interval: float = config.LLM_HEALTH_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await router.health_check(client)
+        except Exception:
+            logger.exception("llm health check failed")
+
+
+class RoutedChatModel(BaseChatModel):
+    """按 LLMRouter 选择端点的聊天模型；bind_tools 等参数原样转发给选中的 ChatOpenAI"""
+
+    router: Any = None
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    @property
+    def _llm_type(self) -> str:
+        return "routed-chat-openai"
+
+    @property
+    def model_name(self) -> str:
+        return self.router.endpoints[0].model
+
+    def bind_tools(self, tools, **kwargs):
+        # 工具格式转换交给第一个端点的 ChatOpenAI，绑定的参数在调用时转发给实际选中的端点
+        bound = self.router.endpoints[0].llm.bind_tools(tools, **kwargs)
+        return self.bind(**bound.kwargs)
+
+    def _failover(self, endpoint: Endpoint, error: BaseException, emitted: bool):
+        self.router.record_failure(endpoint, error)
+        if emitted or not is_retryable(error):
+            raise error
+        self.router.failovers += 1
+        logger.warning("llm endpoint failed before first chunk, failing over", extra={
+            "endpoint": endpoint.name,
+            "error": f"{type(error).__name__}: {error}"[:300],
+        })
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        # run_manager 交给实际的端点，由它按块回调 on_llm_new_token（流式 token 回调、astream_events 依赖它）
+        last_error: Optional[BaseException] = None
+        for endpoint in self.router.candidates():
+            started = time.perf_counter()
+            emitted = False
+            try:
+                async for chunk in endpoint.llm._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    if not emitted:
+                        emitted = True
+                        self.router.record_success(endpoint, time.perf_counter() - started)
+                    yield chunk
+            except Exception as e:
+                self._failover(endpoint, e, emitted)
+                last_error = e
+                continue
+            if not emitted:
+                self.router.record_success(endpoint, time.perf_counter() - started)
+            return
+        raise last_error
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        last_error: Optional[BaseException] = None
+        for endpoint in self.router.candidates():
+            started = time.perf_counter()
+            emitted = False
+            try:
+                for chunk in endpoint.llm._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    if not emitted:
+                        emitted = True
+                        self.router.record_success(endpoint, time.perf_counter() - started)
+                    yield chunk
+            except Exception as e:
+                self._failover(endpoint, e, emitted)
+                last_error = e
+                continue
+            if not emitted:
+                self.router.record_success(endpoint, time.perf_counter() - started)
+            return
+        raise last_error
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return await agenerate_from_stream(self._astream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
@@ -0,0 +1,320 @@
+"""
+本地检索索引
+
+远程检索服务变慢或不可达时，评估仍需要证据来源。这里对 skills/*/reference/*.md 和 LOCAL_INDEX_DOC_DIR 下的
+.md/.txt 文档建立 BM25 索引，返回与远程检索相同的结果结构 {score, title, content, origin, authors}：
+- 文档按 Markdown 标题切分为不超过 LOCAL_INDEX_CHUNK_CHARS 字的文本块，标题路径作为 title
+- 分词优先用 jieba（lcut_for_search），未安装时中文按字二元组、英文和数字按整词切分
+- 倒排表以 CSR 形式（indptr / doc_ids / tfs）保存为 .npy，加载时 mmap，启动不需要重新分词；
+  查询时把各查询词的倒排段拼接后一次 np.bincount 累加 BM25 分数
+- 源文件变化（fingerprint）或分词方式变化时自动重建；NumPy 未安装时不可用
+使用方式由 LOCAL_INDEX_MODE 决定，见 rag_client。
+"""
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import unicodedata
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import config
+from fingerprint import files_fingerprint
+from log_config import get_logger
+
+try:
+    import numpy as np
+except ImportError:  # NumPy 未安装时本地索引不可用
+    np = None
+
+try:
+    import jieba
+    jieba.setLogLevel(60)
+except ImportError:  # 未安装 jieba 时按字二元组切分中文
+    jieba = None
+
+logger = get_logger(__name__)
+
+TOKENIZER = "jieba" if jieba is not None else "bigram"
+DEFAULT_SKILLS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agents", "medical", "skills")
+DOC_SUFFIXES = (".md", ".txt")
+ARRAYS = ("indptr", "doc_ids", "tfs", "doc_len", "idf")
+
+_TOKEN_RE = re.compile(r"[\u4e00-\u9fff]+|[a-z0-9]+(?:\.[0-9]+)?")
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for match in _TOKEN_RE.finditer(unicodedata.normalize("NFKC", text or "").lower()):
+        chunk = match.group()
+        if chunk.isascii():
+            tokens.append(chunk)
+        elif jieba is not None:
+            tokens.extend(word for word in jieba.lcut_for_search(chunk) if word.strip())
+        elif len(chunk) == 1:
+            tokens.append(chunk)
+        else:
+            tokens.extend(chunk[i:i + 2] for i in range(len(chunk) - 1))
+    return tokens
+
+
+def _split_long(text: str, max_chars: int) -> List[str]:
+    """按段落合并为不超过 max_chars 的块，单个超长段落按字符切开"""
+    pieces, current = [], ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        while len(paragraph) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:]
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) + 1 > max_chars:
+            pieces.append(current)
+            current = ""
+        current = f"{current}\n{paragraph}" if current else paragraph
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def chunk_document(text: str, origin: str, max_chars: int) -> List[Dict[str, str]]:
+    """按 Markdown 标题切分文档，title 为标题路径（没有标题时为文件名）"""
+    chunks: List[Dict[str, str]] = []
+    headings: List[Tuple[int, str]] = []
+    lines: List[str] = []
+
+    def flush():
+        body = "\n".join(lines).strip()
+        lines.clear()
+        if not body:
+            return
+        title = " / ".join(heading for _, heading in headings) or os.path.splitext(os.path.basename(origin))[0]
+        for piece in _split_long(body, max_chars):
+            chunks.append({"title": title, "content": piece, "origin": origin})
+
+    for line in text.splitlines():
+        match = _HEADING_RE.match(line)
+        if match is None:
+            lines.append(line)
+            continue
+        flush()
+        level = len(match.group(1))
+        while headings and headings[-1][0] >= level:
+            headings.pop()
+        headings.append((level, match.group(2).strip()))
+    flush()
+    return chunks
+
+
+@dataclass
+class _Index:
+    key: str
+    docs: List[Dict[str, str]]
+    vocab: Dict[str, int]
+    indptr: Any
+    doc_ids: Any
+    tfs: Any
+    doc_len: Any
+    idf: Any
+    avg_len: float
+
+
+class LocalIndex:
+    def __init__(
+        self,
+        skills_dir: str = DEFAULT_SKILLS_DIR,
+        doc_dir: str = config.LOCAL_INDEX_DOC_DIR,
+        index_dir: str = config.LOCAL_INDEX_DIR,
+        chunk_chars: int = config.LOCAL_INDEX_CHUNK_CHARS,
+        k1: float = config.LOCAL_INDEX_BM25_K1,
+        b: float = config.LOCAL_INDEX_BM25_B,
+    ):
+        self.skills_dir = skills_dir
+        self.doc_dir = doc_dir
+        self.index_dir = index_dir
+        self.chunk_chars = max(100, chunk_chars)
+        self.k1 = k1
+        self.b = b
+        self._index: Optional[_Index] = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.searches = 0
+        self.last_build_ms: Optional[int] = None
+
+    @property
+    def available(self) -> bool:
+        return np is not None
+
+    def _source_paths(self) -> List[str]:
+        paths = []
+        if os.path.isdir(self.skills_dir):
+            for name in sorted(os.listdir(self.skills_dir)):
+                reference = os.path.join(self.skills_dir, name, "reference")
+                if os.path.isdir(reference):
+                    paths.append(reference)
+        if self.doc_dir and os.path.isdir(self.doc_dir):
+            paths.append(self.doc_dir)
+        return paths
+
+    def _source_key(self, paths: List[str]) -> str:
+        return f"{files_fingerprint(paths)}:{TOKENIZER}:{self.chunk_chars}"
+
+    def _collect(self, paths: List[str]) -> List[Dict[str, str]]:
+        docs = []
+        for root in paths:
+            for directory, dirs, names in os.walk(root):
+                dirs.sort()
+                for name in sorted(names):
+                    if not name.lower().endswith(DOC_SUFFIXES):
+                        continue
+                    path = os.path.join(directory, name)
+                    try:
+                        with open(path, encoding="utf-8") as f:
+                            text = f.read()
+                    except (OSError, UnicodeDecodeError) as e:
+                        logger.warning("local index skipped file", extra={"path": path, "error": str(e)})
+                        continue
+                    # 技能参考文档记为 <技能>/reference/<文件>，文档目录记为 <目录名>/<文件>
+                    base = self.skills_dir if root.startswith(self.skills_dir) else os.path.dirname(root)
+                    origin = os.path.relpath(path, base)
+                    docs.extend(chunk_document(text, origin, self.chunk_chars))
+        return docs
+
+    def _build(self, key: str, paths: List[str]) -> _Index:
+        started = time.perf_counter()
+        docs = self._collect(paths)
+        vocab: Dict[str, int] = {}
+        term_ids: List[int] = []
+        doc_ids: List[int] = []
+        tfs: List[float] = []
+        doc_len = np.zeros(len(docs), dtype=np.float32)
+        for doc_id, doc in enumerate(docs):
+            counts = Counter(tokenize(doc["title"] + "\n" + doc["content"]))
+            doc_len[doc_id] = sum(counts.values())
+            for term, tf in counts.items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+
+        terms = np.asarray(term_ids, dtype=np.int32)
+        order = np.argsort(terms, kind="stable")
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(vocab)), out=indptr[1:])
+        df = np.diff(indptr).astype(np.float32)
+        arrays = {
+            "indptr": indptr,
+            "doc_ids": np.asarray(doc_ids, dtype=np.int32)[order],
+            "tfs": np.asarray(tfs, dtype=np.float32)[order],
+            "doc_len": doc_len,
+            "idf": np.log1p((len(docs) - df + 0.5) / (df + 0.5)).astype(np.float32),
+        }
+        self._save(key, docs, vocab, arrays)
+        self.builds += 1
+        self.last_build_ms = round((time.perf_counter() - started) * 1000)
+        logger.info("local index built", extra={"docs": len(docs), "terms": len(vocab), "duration_ms": self.last_build_ms})
+        return self._load(key)
+
+    def _save(self, key: str, docs: List[Dict[str, str]], vocab: Dict[str, int], arrays: Dict[str, Any]):
+        """先写入临时目录再整体替换，meta.json 最后写入，加载时以它为准"""
+        tmp_dir = f"{self.index_dir}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+        with open(os.path.join(tmp_dir, "docs.json"), "w", encoding="utf-8") as f:
+            json.dump(docs, f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(vocab, f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"key": key, "built_at": time.time(), "docs": len(docs), "terms": len(vocab)}, f)
+        shutil.rmtree(self.index_dir, ignore_errors=True)
+        os.replace(tmp_dir, self.index_dir)
+
+    def _load(self, key: str) -> Optional[_Index]:
+        try:
+            with open(os.path.join(self.index_dir, "meta.json"), encoding="utf-8") as f:
+                if json.load(f).get("key") != key:
+                    return None
+            with open(os.path.join(self.index_dir, "docs.json"), encoding="utf-8") as f:
+                docs = json.load(f)
+            with open(os.path.join(self.index_dir, "vocab.json"), encoding="utf-8") as f:
+                vocab = json.load(f)
+            arrays = {name: np.load(os.path.join(self.index_dir, f"{name}.npy"), mmap_mode="r") for name in ARRAYS}
+        except (OSError, ValueError):
+            return None
+        doc_len = arrays["doc_len"]
+        avg_len = float(doc_len.mean()) if len(doc_len) else 1.0
+        return _Index(key=key, docs=docs, vocab=vocab, avg_len=avg_len or 1.0, **arrays)
+
+    def ensure(self) -> Optional[_Index]:
+        """返回当前索引；源文件变化时重建（最多每 LOCAL_INDEX_CHECK_INTERVAL 秒检查一次）"""
+        if np is None:
+            return None
+        index = self._index
+        if index is not None and time.monotonic() - self._checked < config.LOCAL_INDEX_CHECK_INTERVAL:
+            return index
+        with self._lock:
+            paths = self._source_paths()
+            key = self._source_key(paths)
+            self._checked = time.monotonic()
+            if self._index is None or self._index.key != key:
+                try:
+                    self._index = self._load(key) or self._build(key, paths)
+                except OSError as e:
+                    logger.error("local index build failed", extra={"error": str(e)})
+            return self._index
+
+    def search(self, query: str, top_k: int = 3, min_score: float = config.LOCAL_INDEX_MIN_SCORE) -> List[Dict[str, Any]]:
+        """BM25 检索，结果结构与远程检索一致；低于 min_score 的结果丢弃"""
+        index = self.ensure()
+        if index is None or not index.docs:
+            return []
+        self.searches += 1
+        term_ids = [index.vocab[t] for t in set(tokenize(query)) if t in index.vocab]
+        if not term_ids:
+            return []
+        # 各查询词的倒排段拼接后一次累加
+        spans = [(int(index.indptr[t]), int(index.indptr[t + 1])) for t in term_ids]
+        docs = np.concatenate([index.doc_ids[s:e] for s, e in spans])
+        tf = np.concatenate([index.tfs[s:e] for s, e in spans])
+        idf = np.repeat(np.asarray(index.idf)[term_ids], [e - s for s, e in spans])
+        norm = self.k1 * (1 - self.b + self.b * np.asarray(index.doc_len)[docs] / index.avg_len)
+        scores = np.bincount(docs, weights=idf * tf * (self.k1 + 1) / (tf + norm), minlength=len(index.docs))
+        hits = np.flatnonzero((scores > 0) & (scores >= min_score))
+        if len(hits) > top_k:
+            hits = hits[np.argpartition(-scores[hits], top_k - 1)[:top_k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [
+            {
+                "score": round(float(scores[i]), 4),
+                "title": index.docs[i]["title"],
+                "content": index.docs[i]["content"],
+                "origin": index.docs[i]["origin"],
+                "authors": [],
+            }
+            for i in hits
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        index = self._index
+        return {
+            "mode": config.LOCAL_INDEX_MODE,
+            "available": self.available,
+            "tokenizer": TOKENIZER,
+            "docs": len(index.docs) if index is not None else None,
+            "terms": len(index.vocab) if index is not None else None,
+            "builds": self.builds,
+            "last_build_ms": self.last_build_ms,
+            "searches": self.searches,
+        }
+
+
+local_index = LocalIndex()
@@ -0,0 +1,152 @@
+"""
+模型分级
+
+问候、闲聊和选择技能这类轻量调用交给便宜快速的 light 模型，病例评估和复杂的工具调用才使用 heavy 模型（config.MODEL）。
+ModelTierMiddleware 在每次模型调用前按当前这一轮（最后一条用户消息之后）的内容选择：
+- 消息中有图片、病例数据或缓存的报告提取结果 -> heavy
+- 本轮已经读取了重型技能（LLM_HEAVY_SKILLS，默认 evaluate-record）或调用了报告提取工具 -> heavy
+- 本轮工具调用次数达到 LLM_HEAVY_TOOL_CALLS -> heavy
+- 输入超过 LLM_LIGHT_MAX_INPUT_TOKENS -> heavy
+- 其余 -> light
+未配置 LLM_LIGHT_MODEL 时不分级，全部使用 heavy。各级的调用次数、延迟、token 用量和估算费用见 stats()。
+"""
+import time
+from typing import Any, Dict, List, Optional
+
+from langchain.agents.middleware import AgentMiddleware
+
+import config
+from history_manager import message_text, request_tokens
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+# 当前一轮中出现即切换到 heavy 的内容标记
+HEAVY_CONTENT_MARKERS = ("病例信息:", "[批量评估模式]", "[已缓存的报告图片提取结果]")
+HEAVY_TOOLS = {"get_report_extraction", "save_report_extraction"}
+
+
+class TierStats:
+    def __init__(self, name: str, model: str, price_in: float, price_out: float):
+        self.name = name
+        self.model = model
+        # 每百万 token 的价格
+        self.price_in = price_in
+        self.price_out = price_out
+        self.calls = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def record(self, latency: float, usage: Dict[str, int]):
+        self.calls += 1
+        self.latency_total += latency
+        self.input_tokens += usage.get("input_tokens", 0)
+        self.output_tokens += usage.get("output_tokens", 0)
+
+    def to_dict(self) -> Dict[str, Any]:
+        cost = (self.input_tokens * self.price_in + self.output_tokens * self.price_out) / 1_000_000
+        return {
+            "model": self.model,
+            "calls": self.calls,
+            "errors": self.errors,
+            "avg_latency_ms": round(self.latency_total / self.calls * 1000) if self.calls else None,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cost": round(cost, 4),
+        }
+
+
+def _type(message: Any) -> str:
+    return getattr(message, "type", None) or (message.get("role") if isinstance(message, dict) else "")
+
+
+def _current_turn(messages: List[Any]) -> List[Any]:
+    """最后一条用户消息及其之后的消息"""
+    for i in range(len(messages) - 1, -1, -1):
+        if _type(messages[i]) in ("human", "user"):
+            return messages[i:]
+    return messages
+
+
+def _has_image(content: Any) -> bool:
+    return isinstance(content, list) and any(
+        isinstance(item, dict) and item.get("type") in ("image_url", "image") for item in content
+    )
+
+
+def heavy_reason(messages: List[Any], heavy_skills: List[str] = config.LLM_HEAVY_SKILLS,
+                 heavy_tool_calls: int = config.LLM_HEAVY_TOOL_CALLS) -> Optional[str]:
+    """需要 heavy 模型的原因，返回 None 时使用 light"""
+    tool_calls = 0
+    for message in _current_turn(messages):
+        content = getattr(message, "content", None)
+        if _has_image(content):
+            return "image"
+        text = message_text(content)
+        if any(marker in text for marker in HEAVY_CONTENT_MARKERS):
+            return "case"
+        for call in getattr(message, "tool_calls", None) or []:
+            tool_calls += 1
+            if call.get("name") in HEAVY_TOOLS:
+                return "extraction"
+            args = str(call.get("args", ""))
+            if any(skill in args for skill in heavy_skills):
+                return "skill"
+    if heavy_tool_calls and tool_calls >= heavy_tool_calls:
+        return "tool_calls"
+    return None
+
+
+class ModelTierMiddleware(AgentMiddleware):
+    """按调用内容在 light / heavy 模型之间切换，并统计各级的延迟和用量"""
+
+    def __init__(self, light_model: Any = None, light_max_input_tokens: int = config.LLM_LIGHT_MAX_INPUT_TOKENS):
+        super().__init__()
+        self.light_model = light_model
+        self.light_max_input_tokens = light_max_input_tokens
+        self.tiers = {
+            "heavy": TierStats("heavy", config.MODEL, config.LLM_HEAVY_PRICE_IN, config.LLM_HEAVY_PRICE_OUT),
+            "light": TierStats("light", config.LLM_LIGHT_MODEL, config.LLM_LIGHT_PRICE_IN, config.LLM_LIGHT_PRICE_OUT),
+        }
+        self.reasons: Dict[str, int] = {}
+
+    def _choose(self, request) -> str:
+        if self.light_model is None:
+            return "heavy"
+        messages = getattr(request, "messages", None) or []
+        reason = heavy_reason(messages)
+        # 与 AdmissionMiddleware 共用同一次估算
+        if reason is None and self.light_max_input_tokens and request_tokens(request) > self.light_max_input_tokens:
+            reason = "input_tokens"
+        reason = reason or "light"
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        return "light" if reason == "light" else "heavy"
+
+    async def awrap_model_call(self, request, handler):
+        tier = self._choose(request)
+        if tier == "light":
+            request = request.override(model=self.light_model)
+        stats = self.tiers[tier]
+        started = time.perf_counter()
+        try:
+            response = await handler(request)
+        except Exception:
+            stats.errors += 1
+            raise
+        usage: Dict[str, int] = {}
+        for message in getattr(response, "result", None) or []:
+            for key, value in (getattr(message, "usage_metadata", None) or {}).items():
+                if isinstance(value, int):
+                    usage[key] = usage.get(key, 0) + value
+        stats.record(time.perf_counter() - started, usage)
+        logger.debug("model call", extra={"tier": tier, "duration_ms": round((time.perf_counter() - started) * 1000)})
+        return response
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.light_model is not None,
+            "tiers": {name: tier.to_dict() for name, tier in self.tiers.items()},
+            "reasons": dict(self.reasons),
+        }
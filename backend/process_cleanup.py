@@ -0,0 +1,137 @@
+"""
+agent 运行被取消后清理遗留的 shell 子进程
+
+ShellToolMiddleware 为每次运行启动一个 shell 会话。运行被取消时 after_agent 钩子不会执行，
+会话要等到状态对象被回收时才由它自己的 finalizer 关闭。这里提供两步清理：
+1. gc.collect() 触发 finalizer，让中间件自行关闭会话
+2. 终止该运行自己启动的 shell 会话（TrackedShellToolMiddleware 按运行记录会话 pid）；
+   会话在独立进程组中时整组终止，否则终止其进程树。不会触碰其他运行或进程池的子进程
+进程树的查找仅支持 Linux（读取 /proc）。
+"""
+import contextvars
+import gc
+import os
+import signal
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from langchain.agents.middleware import ShellToolMiddleware
+
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+_PROC = "/proc"
+
+
+def _parent_map() -> Dict[int, int]:
+    """pid -> ppid"""
+    parents: Dict[int, int] = {}
+    if not os.path.isdir(_PROC):
+        return parents
+    for entry in os.listdir(_PROC):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"{_PROC}/{entry}/stat", "rb") as f:
+                stat = f.read().decode(errors="replace")
+        except OSError:
+            continue
+        # 第二列是带括号的进程名，可能包含空格，从最后一个 ")" 之后解析
+        fields = stat[stat.rfind(")") + 2:].split()
+        if len(fields) > 1:
+            parents[int(entry)] = int(fields[1])
+    return parents
+
+
+# 当前运行启动的 shell 会话 pid；集合在运行开始时创建，agent 内部复制的上下文共享同一个集合
+_run_shells: contextvars.ContextVar[Optional[Set[int]]] = contextvars.ContextVar("run_shells", default=None)
+
+
+def track_run_shells() -> Set[int]:
+    """在当前运行的上下文中开始记录 shell 会话；返回会被写入 pid 的集合"""
+    shells: Set[int] = set()
+    _run_shells.set(shells)
+    return shells
+
+
+class TrackedShellToolMiddleware(ShellToolMiddleware):
+    """创建 shell 会话时把进程 pid 记入当前运行"""
+
+    def _create_resources(self):
+        resources = super()._create_resources()
+        shells = _run_shells.get()
+        process = getattr(resources.session, "_process", None)
+        if shells is not None and process is not None:
+            shells.add(process.pid)
+        return resources
+
+
+def _descendants(roots: Iterable[int]) -> List[int]:
+    parents = _parent_map()
+    result: List[int] = []
+    frontier = list(roots)
+    while frontier:
+        pid = frontier.pop()
+        result.append(pid)
+        frontier.extend(child for child, parent in parents.items() if parent == pid)
+    return result
+
+
+def terminate_tree(roots: Iterable[int], grace: float = 2.0) -> List[int]:
+    """先 SIGTERM，grace 秒后仍存活的进程 SIGKILL；返回处理过的 pid"""
+    pids = _descendants(roots)
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
+    deadline = time.monotonic() + grace
+    alive = list(pids)
+    while alive and time.monotonic() < deadline:
+        time.sleep(0.05)
+        alive = [pid for pid in alive if os.path.exists(f"{_PROC}/{pid}")]
+    for pid in alive:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+    return pids
+
+
+def _pgid(pid: int) -> Optional[int]:
+    try:
+        return os.getpgid(pid)
+    except (ProcessLookupError, PermissionError):
+        return None
+
+
+def terminate_session(pid: int) -> List[int]:
+    """终止一个 shell 会话：会话是独立进程组的组长时整组终止，否则终止其进程树"""
+    if _pgid(pid) == pid and pid != os.getpgrp():
+        members = [p for p in _parent_map() if _pgid(p) == pid] or [pid]
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        return members
+    return terminate_tree([pid])
+
+
+def cleanup_after_cancel(shell_pids: Set[int]) -> List[int]:
+    """
+    清理被取消运行遗留的子进程
+
+    Args:
+        shell_pids: 该运行启动的 shell 会话 pid（见 track_run_shells）
+    """
+    gc.collect()
+    parents = _parent_map()
+    killed: List[int] = []
+    for pid in shell_pids:
+        # 只处理仍是本进程子进程的会话；finalizer 已关闭并回收的 pid 可能已被复用
+        if parents.get(pid) == os.getpid():
+            killed.extend(terminate_session(pid))
+    if killed:
+        logger.info("terminated child processes of cancelled run", extra={"pids": killed})
+    return killed
@@ -0,0 +1,163 @@
+"""
+RAG 检索结果缓存
+
+同样的疾病关键词在不同评估中反复检索，这里按 (appid, 归一化查询, top_k) 缓存解析后的检索结果：
+- 内存 LRU（RAG_CACHE_MAX_ENTRIES 条）：服务进程内（rag_client 检索工具）的重复查询不访问磁盘
+- 本地 SQLite（RAG_CACHE_DB）：跨进程、跨重启共享，rag.py 命令行作为独立进程运行时也能命中
+- 条目按 RAG_CACHE_TTL 过期；没有结果的查询也缓存（RAG_CACHE_NEGATIVE_TTL，较短），请求失败不缓存
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import config
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rag_cache (
+    cache_key  TEXT PRIMARY KEY,
+    appid      TEXT NOT NULL,
+    query      TEXT NOT NULL,
+    top_k      INTEGER NOT NULL,
+    items      TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    hits       INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_rag_cache_expires ON rag_cache(expires_at);
+"""
+
+
+def normalize_query(query: str) -> str:
+    """全角转半角、小写、合并空白"""
+    return " ".join(unicodedata.normalize("NFKC", query or "").lower().split())
+
+
+class RagCache:
+    def __init__(
+        self,
+        path: str = config.RAG_CACHE_DB,
+        max_entries: int = config.RAG_CACHE_MAX_ENTRIES,
+        ttl: float = config.RAG_CACHE_TTL,
+        negative_ttl: float = config.RAG_CACHE_NEGATIVE_TTL,
+    ):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # cache_key -> (过期时间, 结果列表)
+        self._memory: "OrderedDict[str, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # 多个 rag.py 进程可能同时写入
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def key(appid: str, query: str, top_k: int) -> str:
+        raw = f"{appid}\0{normalize_query(query)}\0{top_k}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, expires_at: float, items: List[Dict[str, Any]]):
+        self._memory[key] = (expires_at, items)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, appid: str, query: str, top_k: int) -> Optional[List[Dict[str, Any]]]:
+        """缓存的检索结果（可能是空列表，表示上次没有结果）；未命中或已过期返回 None"""
+        key = self.key(appid, query, top_k)
+        now = time.time()
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None and cached[0] > now:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                if not cached[1]:
+                    self.negative_hits += 1
+                return cached[1]
+            try:
+                db = self._db()
+                row = db.execute(
+                    "SELECT expires_at, items FROM rag_cache WHERE cache_key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+                if row is not None:
+                    with db:
+                        db.execute("UPDATE rag_cache SET hits = hits + 1 WHERE cache_key = ?", (key,))
+            except sqlite3.Error:
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            items = json.loads(row[1])
+            self._remember(key, row[0], items)
+            self.disk_hits += 1
+            if not items:
+                self.negative_hits += 1
+            return items
+
+    def put(self, appid: str, query: str, top_k: int, items: List[Dict[str, Any]]):
+        ttl = self.ttl if items else self.negative_ttl
+        if not ttl:
+            return
+        key = self.key(appid, query, top_k)
+        now = time.time()
+        with self._lock:
+            self._remember(key, now + ttl, items)
+            try:
+                with self._db() as db:
+                    db.execute(
+                        "INSERT OR REPLACE INTO rag_cache (cache_key, appid, query, top_k, items, created_at, expires_at)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (key, appid, normalize_query(query), top_k, json.dumps(items, ensure_ascii=False), now, now + ttl),
+                    )
+            except sqlite3.Error:
+                # 磁盘缓存不可用时仍保留内存缓存
+                pass
+
+    def purge_expired(self) -> int:
+        with self._lock, self._db() as db:
+            return db.execute("DELETE FROM rag_cache WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        """本进程的命中统计；rag.py 作为独立进程运行时的命中次数只记录在磁盘的 hits 列中（stored_hits）"""
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        try:
+            with self._lock:
+                stored, stored_hits = self._db().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM rag_cache WHERE expires_at > ?", (time.time(),)
+                ).fetchone()
+        except sqlite3.Error:
+            stored, stored_hits = None, None
+        return {
+            "enabled": config.RAG_CACHE_ENABLED,
+            "memory_entries": len(self._memory),
+            "stored_entries": stored,
+            "stored_hits": stored_hits,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 3) if lookups else None,
+        }
+
+
+rag_cache = RagCache()
@@ -0,0 +1,324 @@
+"""
+医学知识检索客户端
+
+retrieval ensemble 接口（医学书籍 / 临床指南 / 禁忌症知识图谱）的异步客户端，供 agent 工具和 rag.py 命令行共用：
+- 共享一个 keep-alive 的 httpx.AsyncClient，多个查询 × 多个检索源并发请求
+- 结果经 rag_cache 缓存，解析为 {score, title, content, origin, authors}，按检索源归一化分数后去重合并
+- build_rag_tools() 返回注册到 agent 的原生异步工具 search_medical_knowledge，替代通过 shell 运行 rag.py：
+  省去解释器启动和建连的开销，返回紧凑的 JSON 而不是需要模型解析的文本
+- 本地索引（local_index，检索源 local）按 LOCAL_INDEX_MODE 参与检索：fallback 时远程请求失败的查询改用本地结果，
+  first 时先查本地，本地没有结果的查询才请求远程；服务地址连接失败或超时后 RAG_HOST_COOLDOWN 秒内不再请求
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from langchain_core.tools import tool
+
+import config
+from local_index import local_index
+from log_config import get_logger
+from rag_cache import rag_cache
+
+logger = get_logger(__name__)
+
+# 检索源: (默认服务地址, appid)
+SOURCES = {
+    "book": ("http://10.11.133.6:8100", "book_info"),
+    "guideline": ("http://10.11.133.6:8100", "guideline_info"),
+    "taboo": ("http://10.11.132.195:8520/", "report_negative_kg"),
+}
+LOCAL_SOURCE = "local"
+SOURCE_LABELS = {"book": "医学书籍", "guideline": "临床指南", "taboo": "禁忌症知识图谱", LOCAL_SOURCE: "本地知识库"}
+SEARCH_PATH = "/innerservice/retrieval/search/ensemble"
+
+_client: Optional[httpx.AsyncClient] = None
+_metrics = {"requests": 0, "errors": 0, "skipped": 0, "latency_ms_total": 0.0}
+# 服务地址 -> 暂停请求到的时间（time.monotonic）
+_down_until: Dict[str, float] = {}
+
+
+class RagUnavailable(Exception):
+    """服务地址最近连接失败，冷却期内不再请求"""
+
+
+class RagServiceError(ValueError):
+    """检索服务返回 200 但 status 非 0（或响应为空），与 HTTP 错误一样按失败处理，不写入缓存"""
+
+
+def source_host(source: str) -> str:
+    return (os.getenv(f"RAG_{source.upper()}_HOST") or os.getenv("RAG_HOST") or SOURCES[source][0]).rstrip("/")
+
+
+def get_rag_http_client() -> httpx.AsyncClient:
+    """共享的检索 HTTP 客户端，与 LLM 连接池分开，超时更短"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=config.RAG_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=config.RAG_POOL_MAX_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(config.RAG_TIMEOUT),
+        )
+    return _client
+
+
+async def close_rag_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def build_payload(query: str, appid: str, top_k: int) -> Dict[str, Any]:
+    return {
+        "appid": appid,
+        "input": [
+            {
+                "Content": query,
+                "Type": "text",
+                "ext": {
+                    "url": "",
+                    "multiModalAnalyse": {
+                        "result": None
+                    }
+                }
+            }
+        ],
+        "indexName": "",
+        "termFilters": None,
+        "inFilters": None,
+        "num": top_k
+    }
+
+
+def parse_items(results: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    把接口返回的 List 转为 [{score, title, content, origin, authors}]；item['data'] 可能是 JSON 字符串
+    响应为空或 status 非 0 时抛出 RagServiceError，只有正常响应的空列表才是真正的"无结果"
+    """
+    if not results:
+        raise RagServiceError("检索服务返回空响应")
+    if results.get("status") != 0:
+        raise RagServiceError(f"检索服务返回 status={results.get('status')}: {results.get('msg') or results.get('message') or ''}".rstrip(": "))
+    items = []
+    for item in (results.get("data") or {}).get("List") or []:
+        item_data = item.get("data", {})
+        if isinstance(item_data, str):
+            try:
+                item_data = json.loads(item_data)
+            except json.JSONDecodeError:
+                item_data = {"content": item_data}
+        items.append({
+            "score": float(item.get("score") or 0),
+            "title": item_data.get("title", ""),
+            "content": item_data.get("content", ""),
+            "origin": item_data.get("book_name") or item_data.get("source", ""),
+            "authors": item_data.get("author_list") or [],
+        })
+    return items
+
+
+def _dedup_key(item: Dict[str, Any]) -> str:
+    text = "".join((item["title"] + item["content"][:300]).split())
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+
+def merge_results(responses: Dict[Tuple[str, str], List[Dict[str, Any]]], top_k: int) -> List[Dict[str, Any]]:
+    """
+    合并多个 (query, source) 的检索结果：
+    - 分数在每个响应内做 min-max 归一化，不同检索源的分数尺度不同，不能直接比较
+    - 按标题和内容去重，保留最高分，并记录命中的查询和来源；被多个查询命中的条目每多一个加 0.05
+    """
+    merged = {}
+    for (query, source), items in responses.items():
+        if not items:
+            continue
+        scores = [item["score"] for item in items]
+        low, high = min(scores), max(scores)
+        for item in items:
+            norm = (item["score"] - low) / (high - low) if high > low else 1.0
+            key = _dedup_key(item)
+            entry = merged.get(key)
+            if entry is None:
+                entry = merged[key] = dict(item, norm_score=norm, sources=[], queries=[])
+            elif norm > entry["norm_score"]:
+                entry.update(item, norm_score=norm, sources=entry["sources"], queries=entry["queries"])
+            if source not in entry["sources"]:
+                entry["sources"].append(source)
+            if query not in entry["queries"]:
+                entry["queries"].append(query)
+    for entry in merged.values():
+        entry["fused_score"] = round(entry["norm_score"] + 0.05 * (len(entry["queries"]) - 1), 4)
+    ranked = sorted(merged.values(), key=lambda e: (e["fused_score"], e["score"]), reverse=True)
+    return ranked[:top_k] if top_k else ranked
+
+
+async def search(query: str, source: str, top_k: int = 3, host: Optional[str] = None,
+                 use_cache: bool = True) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    检索单个查询，返回 (结果列表, 是否来自缓存)；请求失败时抛出 httpx.HTTPError / ValueError
+    （服务返回非 0 status 时为 RagServiceError），服务地址处于冷却期时抛出 RagUnavailable
+    use_cache 为 False 时跳过缓存查询（结果仍会写入缓存）
+    """
+    host = (host or source_host(source)).rstrip("/")
+    appid = SOURCES[source][1]
+    # 缓存按服务地址区分，替代服务和正式服务的结果不会混用
+    namespace = f"{appid}@{host}"
+    cache = rag_cache if config.RAG_CACHE_ENABLED else None
+    if cache is not None and use_cache:
+        items = await asyncio.to_thread(cache.get, namespace, query, top_k)
+        if items is not None:
+            return items, True
+    if time.monotonic() < _down_until.get(host, 0.0):
+        _metrics["skipped"] += 1
+        raise RagUnavailable(f"{host} 暂不可用")
+    started = time.perf_counter()
+    _metrics["requests"] += 1
+    try:
+        response = await get_rag_http_client().post(host + SEARCH_PATH, json=build_payload(query, appid, top_k))
+        response.raise_for_status()
+        items = parse_items(response.json())
+    except (httpx.HTTPError, ValueError) as e:
+        _metrics["errors"] += 1
+        if isinstance(e, httpx.TransportError) and config.RAG_HOST_COOLDOWN > 0:
+            _down_until[host] = time.monotonic() + config.RAG_HOST_COOLDOWN
+            logger.warning("rag host unavailable", extra={"host": host, "error": str(e) or type(e).__name__})
+        raise
+    finally:
+        _metrics["latency_ms_total"] += (time.perf_counter() - started) * 1000
+    if cache is not None:
+        await asyncio.to_thread(cache.put, namespace, query, top_k, items)
+    return items, False
+
+
+async def multi_search(queries: List[str], sources: List[str], top_k: int = 3, merged_top_k: int = 10,
+                       host: Optional[str] = None, use_cache: bool = True) -> Dict[str, Any]:
+    """
+    多个查询 × 多个检索源并发检索，返回合并排序后的结果和每个检索源的耗时
+    sources 中显式包含 local 时总是检索本地索引，否则按 LOCAL_INDEX_MODE 决定是否使用
+    :return: {"results": [...], "sources": {source: {"latency_ms", "requests", "cached", "errors"}}, "elapsed_ms"}
+    """
+    started = time.perf_counter()
+    responses: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    stats = {source: {"latency_ms": 0, "requests": 0, "cached": 0, "errors": []} for source in sources}
+    remote_sources = [source for source in sources if source != LOCAL_SOURCE]
+    mode = "off" if LOCAL_SOURCE in sources or not local_index.available else config.LOCAL_INDEX_MODE
+
+    async def run_local(local_queries):
+        t0 = time.perf_counter()
+        results = await asyncio.to_thread(lambda: [local_index.search(query, top_k) for query in local_queries])
+        stat = stats.setdefault(LOCAL_SOURCE, {"latency_ms": 0, "requests": 0, "cached": 0, "errors": []})
+        stat["requests"] += len(local_queries)
+        stat["latency_ms"] = max(stat["latency_ms"], round((time.perf_counter() - t0) * 1000))
+        for query, items in zip(local_queries, results):
+            responses[(query, LOCAL_SOURCE)] = items
+
+    async def run(task):
+        query, source = task
+        t0 = time.perf_counter()
+        try:
+            items, cached = await search(query, source, top_k, host, use_cache)
+            error = None
+        except (httpx.HTTPError, ValueError, RagUnavailable) as e:
+            items, cached, error = [], False, str(e) or type(e).__name__
+        return task, items, (time.perf_counter() - t0) * 1000, error, cached
+
+    remote_queries = list(queries)
+    if LOCAL_SOURCE in sources:
+        await run_local(queries)
+    elif mode == "first":
+        await run_local(queries)
+        remote_queries = [query for query in queries if not responses[(query, LOCAL_SOURCE)]]
+
+    failed_queries = []
+    tasks = [(query, source) for source in remote_sources for query in remote_queries]
+    for (query, source), items, latency, error, cached in await asyncio.gather(*(run(task) for task in tasks)):
+        responses[(query, source)] = items
+        stat = stats[source]
+        stat["requests"] += 1
+        stat["cached"] += cached
+        stat["latency_ms"] = max(stat["latency_ms"], round(latency))
+        if error:
+            stat["errors"].append(f"{query}: {error}")
+            if query not in failed_queries:
+                failed_queries.append(query)
+
+    if mode == "fallback" and failed_queries:
+        await run_local(failed_queries)
+    return {
+        "results": merge_results(responses, merged_top_k),
+        "sources": stats,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000),
+    }
+
+
+def compact_results(result: Dict[str, Any], max_chars: int = config.RAG_RESULT_MAX_CHARS) -> Dict[str, Any]:
+    """给模型的紧凑结果：只保留引用需要的字段，内容截断，失败的检索源单独列出"""
+    items = []
+    for item in result["results"]:
+        content = item["content"]
+        items.append({
+            "title": item["title"],
+            "content": content[:max_chars] + ("…" if len(content) > max_chars else ""),
+            "origin": item["origin"],
+            "sources": [SOURCE_LABELS.get(s, s) for s in item["sources"]],
+            "queries": item["queries"],
+            "relevance": round(item["fused_score"], 2),
+        })
+    failed = {
+        SOURCE_LABELS.get(source, source): stat["errors"]
+        for source, stat in result["sources"].items() if stat["errors"]
+    }
+    compact: Dict[str, Any] = {"results": items}
+    if failed:
+        compact["failed"] = failed
+    return compact
+
+
+def build_rag_tools() -> list:
+    """供 agent 调用的知识检索工具"""
+
+    @tool
+    async def search_medical_knowledge(queries: List[str], sources: Optional[List[str]] = None, top_k: int = 3) -> str:
+        """
+        检索医学知识库，用于验证解读中的医学建议和生活建议。
+        queries: 检索关键词列表（疾病名称、异常指标、核心医学术语），所有关键词放在同一次调用中并发检索。
+        sources: 检索源，可选 book(医学书籍) guideline(临床指南) taboo(禁忌症知识图谱) local(本地知识库)，
+        默认三个远程检索源（远程不可用时自动补充本地知识库结果）。
+        top_k: 每个关键词每个检索源返回的结果数。
+        返回 JSON: results 为去重后按相关度排序的条目 {title, content, origin, sources, queries, relevance}；
+        failed 为检索失败的检索源及原因（没有失败时不出现）。
+        """
+        queries = [q.strip() for q in queries if q and q.strip()]
+        unknown = [s for s in sources or [] if s not in SOURCES and s != LOCAL_SOURCE]
+        if not queries:
+            return "检索失败: queries 不能为空"
+        if unknown:
+            return f"检索失败: 未知检索源 {', '.join(unknown)}，可选 {', '.join(SOURCE_LABELS)}"
+        result = await multi_search(queries, sources or list(SOURCES), top_k=max(1, min(top_k, 10)))
+        logger.info("rag search", extra={
+            "queries": len(queries),
+            "results": len(result["results"]),
+            "cached": sum(stat["cached"] for stat in result["sources"].values()),
+            "duration_ms": result["elapsed_ms"],
+        })
+        return json.dumps(compact_results(result), ensure_ascii=False)
+
+    return [search_medical_knowledge]
+
+
+def rag_client_stats() -> Dict[str, Any]:
+    requests = _metrics["requests"]
+    return {
+        "requests": requests,
+        "errors": _metrics["errors"],
+        "skipped": _metrics["skipped"],
+        "hosts_down": [host for host, until in _down_until.items() if until > time.monotonic()],
+        "avg_latency_ms": round(_metrics["latency_ms_total"] / requests) if requests else None,
+    }
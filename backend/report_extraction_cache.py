@@ -0,0 +1,164 @@
+"""
+报告图片结构化提取结果缓存
+
+evaluate-record 每次评估都要让模型重新识别报告图片（报告类型、检查部位、各项指标），
+这是最贵的一步视觉调用。这里按 (图片内容哈希, 模型) 缓存提取结果：
+- 模型完成提取后通过 save_report_extraction 工具保存
+- 再次评估同一报告（带病例数据的评估和批量病例）时，process_chat 直接把缓存的提取结果注入上下文，不再发送图片；
+  其他对话照常发送图片，提取结果只作为提示附在图片后
+- 缓存记录技能版本（技能文件指纹），技能修改后旧结果自动失效
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from langchain_core.tools import tool
+
+import config
+from fingerprint import files_fingerprint
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS extractions (
+    image_id      TEXT NOT NULL,
+    model         TEXT NOT NULL,
+    skill_version TEXT NOT NULL,
+    extraction    TEXT NOT NULL,
+    created_at    REAL NOT NULL,
+    hits          INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (image_id, model)
+);
+"""
+
+# 提取结果中至少要包含的字段
+REQUIRED_FIELDS = ("report_type",)
+
+
+class ReportExtractionCache:
+    def __init__(
+        self,
+        path: str = config.REPORT_EXTRACTION_DB,
+        skill_paths: Optional[List[str]] = None,
+        model: str = config.MODEL,
+    ):
+        self.path = path
+        # 技能版本依据的文件：SKILL.md 和 reference 目录
+        self.skill_paths = skill_paths or []
+        self.model = model
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.saves = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    @property
+    def skill_version(self) -> str:
+        return files_fingerprint(self.skill_paths)
+
+    def get(self, image_id: str, model: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """当前技能版本下的提取结果；不存在或技能已修改时返回 None"""
+        model = model or self.model
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                "SELECT skill_version, extraction FROM extractions WHERE image_id = ? AND model = ?",
+                (image_id, model),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if row[0] != self.skill_version:
+                self.stale += 1
+                return None
+            with db:
+                db.execute("UPDATE extractions SET hits = hits + 1 WHERE image_id = ? AND model = ?", (image_id, model))
+        self.hits += 1
+        return json.loads(row[1])
+
+    def save(self, image_id: str, extraction: Dict[str, Any], model: Optional[str] = None):
+        missing = [name for name in REQUIRED_FIELDS if not extraction.get(name)]
+        if missing:
+            raise ValueError(f"extraction missing fields: {', '.join(missing)}")
+        with self._lock, self._db() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO extractions (image_id, model, skill_version, extraction, created_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (image_id, model or self.model, self.skill_version, json.dumps(extraction, ensure_ascii=False), time.time()),
+            )
+        self.saves += 1
+        logger.info("report extraction cached", extra={"image_id": image_id, "model": model or self.model})
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "saves": self.saves,
+            "skill_version": self.skill_version,
+        }
+
+
+def format_extraction_context(image_id: str, extraction: Dict[str, Any]) -> str:
+    """注入到用户消息中的缓存提取结果"""
+    return (
+        f"\n[已缓存的报告图片提取结果] 图片ID: {image_id}\n"
+        "该报告图片此前已完成结构化提取，以下结果即图像数据提取记录，直接使用，无需也无法再次查看图片：\n"
+        f"```json\n{json.dumps(extraction, ensure_ascii=False, indent=2)}\n```"
+    )
+
+
+def format_extraction_hint(image_id: str, extraction: Dict[str, Any]) -> str:
+    """图片照常发送时附带的缓存提取结果，只作参考"""
+    return (
+        f"\n[上图的图片ID: {image_id}，此前的结构化提取结果仅供参考，回答以图片内容为准]\n"
+        f"```json\n{json.dumps(extraction, ensure_ascii=False, indent=2)}\n```"
+    )
+
+
+def build_extraction_tools(cache: ReportExtractionCache, image_exists: Callable[[str], bool] = lambda image_id: True) -> list:
+    """
+    供 agent 调用的查询/保存工具
+
+    Args:
+        image_exists: 校验图片ID确实存在，避免模型编造的ID写入缓存
+    """
+
+    @tool
+    def get_report_extraction(image_id: str) -> str:
+        """查询报告图片已缓存的结构化提取结果（报告类型、检查部位、指标、异常发现、诊断意见）。image_id 为消息中给出的图片ID。"""
+        extraction = cache.get(image_id)
+        if extraction is None:
+            return "未找到缓存的提取结果，请根据图片进行提取"
+        return json.dumps(extraction, ensure_ascii=False)
+
+    @tool
+    def save_report_extraction(image_id: str, extraction: Dict[str, Any]) -> str:
+        """
+        保存报告图片的结构化提取结果，之后评估同一报告时可直接复用。
+        extraction 字段: report_type 报告类型, exam_part 检查部位, exam_date 检查日期, institution 医疗机构,
+        indicators 指标列表 [{name, value, unit, range, status}], abnormal_findings 异常发现列表, diagnosis 医院诊断意见原文
+        """
+        if not image_exists(image_id):
+            return f"保存失败: 图片ID {image_id} 不存在，请使用消息中给出的图片ID"
+        try:
+            cache.save(image_id, extraction)
+        except ValueError as e:
+            return f"保存失败: {e}"
+        return "已保存"
+
+    return [get_report_extraction, save_report_extraction]
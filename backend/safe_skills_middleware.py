@@ -11,6 +11,10 @@ from typing import Optional
 from deepagents.middleware.skills import SkillsMiddleware
 from deepagents.backends.filesystem import FilesystemBackend
 
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
 
 class SafeSkillsMiddleware(SkillsMiddleware):
     """
@@ -56,11 +60,10 @@ class SafeSkillsMiddleware(SkillsMiddleware):
         super().__init__(backend=FilesystemBackend(root_dir=str(skills_dir)), sources=["."])
         
         if self.verbose:
-            print(f"\n{'='*60}")
-            print(f"[SafeSkills] ✓ 安全技能中间件已启用")
-            print(f"[SafeSkills]   清理的文件数: {len(self.cleaned_files)}")
-            print(f"[SafeSkills]   警告数: {len(self.warnings)}")
-            print(f"{'='*60}\n")
+            logger.info("safe skills middleware enabled", extra={
+                "cleaned_files": len(self.cleaned_files),
+                "warnings": len(self.warnings),
+            })
     
     def _preprocess_skills(
         self, 
@@ -75,7 +78,7 @@ class SafeSkillsMiddleware(SkillsMiddleware):
             project_skills_dir: 项目技能目录
         """
         if self.verbose:
-            print(f"\n[SafeSkills] 开始预处理技能文件...")
+            logger.info("preprocessing skill files")
         
         # 收集所有需要处理的目录
         dirs_to_process = [skills_dir]
@@ -86,15 +89,14 @@ class SafeSkillsMiddleware(SkillsMiddleware):
         for directory in dirs_to_process:
             if not directory.exists():
                 if self.verbose:
-                    print(f"[SafeSkills] ⚠️ 目录不存在: {directory}")
+                    logger.warning("skills directory missing", extra={"directory": str(directory)})
                 continue
             
             # 查找所有 SKILL.md 文件
             skill_files = list(directory.rglob("SKILL.md"))
             
             if self.verbose:
-                print(f"[SafeSkills] 处理目录: {directory}")
-                print(f"[SafeSkills]   发现 {len(skill_files)} 个技能文件")
+                logger.info("processing skills directory", extra={"directory": str(directory), "skill_files": len(skill_files)})
             
             for skill_file in skill_files:
                 self._clean_skill_file(skill_file)
@@ -133,7 +135,7 @@ class SafeSkillsMiddleware(SkillsMiddleware):
                 self.warnings.append(warning)
                 
                 if self.verbose:
-                    print(f"[SafeSkills]   ✓ {warning}")
+                    logger.info(warning)
             
             # ========== 2. 移除单独的工具列表项 ==========
             # 匹配模式：- read_file: ... 或 - write_file: ...
@@ -150,7 +152,7 @@ class SafeSkillsMiddleware(SkillsMiddleware):
                 modified = True
                 
                 if self.verbose:
-                    print(f"[SafeSkills]   ✓ 移除了 {len(tool_matches)} 个工具列表项")
+                    logger.info("removed tool list items", extra={"count": len(tool_matches)})
             
             # ========== 3. 替换嵌套调用指令 ==========
             # 匹配模式：调用技能、触发技能、调用XX skill等
@@ -168,7 +170,7 @@ class SafeSkillsMiddleware(SkillsMiddleware):
                     modified = True
                     
                     if self.verbose:
-                        print(f"[SafeSkills]   ✓ 替换了嵌套调用: {len(matches)} 处")
+                        logger.info("replaced nested skill calls", extra={"count": len(matches)})
             
             # ========== 4. 写回文件（如果有修改）==========
             if modified:
@@ -182,14 +184,13 @@ class SafeSkillsMiddleware(SkillsMiddleware):
                 self.cleaned_files.append(str(skill_file))
                 
                 if self.verbose:
-                    print(f"[SafeSkills] ✓ 已清理: {skill_file.name}")
-                    print(f"[SafeSkills]   备份: {backup_file.name}")
+                    logger.info("skill file cleaned", extra={"file": skill_file.name, "backup": backup_file.name})
         
         except Exception as e:
             error_msg = f"清理失败 {skill_file}: {e}"
             self.warnings.append(error_msg)
             if self.verbose:
-                print(f"[SafeSkills] ❌ {error_msg}")
+                logger.error(error_msg)
     
     def get_cleaning_report(self) -> dict:
         """
@@ -0,0 +1,122 @@
+"""
+流式文本合并器
+
+位于 agent 流和 WebSocket 发送之间：把细碎的文本片段按时间窗口或字符数合并成一帧，
+两者任一先到即发送；工具事件和 complete 之前由调用方显式 flush。
+"""
+import asyncio
+from typing import Awaitable, Callable, List, Optional
+
+import config
+
+
+class CoalescerStats:
+    """所有合并器共享的累计统计，用于在压测时调整窗口参数"""
+
+    def __init__(self):
+        self.fragments_in = 0
+        self.frames_out = 0
+        self.chars_out = 0
+        self.flush_by_size = 0
+        self.flush_by_time = 0
+        self.flush_by_event = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "window_ms": config.STREAM_COALESCE_MS,
+            "max_chars": config.STREAM_COALESCE_CHARS,
+            "fragments_in": self.fragments_in,
+            "frames_out": self.frames_out,
+            "chars_out": self.chars_out,
+            "fragments_per_frame": round(self.fragments_in / self.frames_out, 2) if self.frames_out else 0,
+            "flush_by_size": self.flush_by_size,
+            "flush_by_time": self.flush_by_time,
+            "flush_by_event": self.flush_by_event,
+        }
+
+
+stream_stats = CoalescerStats()
+
+
+class StreamCoalescer:
+    """
+    按 window_ms 毫秒或 max_chars 字符（先到为准）合并文本片段
+
+    window_ms 与 max_chars 均 <= 0 时不做合并，每个片段直接发送。
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[None]],
+        window_ms: int = config.STREAM_COALESCE_MS,
+        max_chars: int = config.STREAM_COALESCE_CHARS,
+        stats: CoalescerStats = stream_stats,
+    ):
+        self._send = send
+        self.window = window_ms / 1000.0 if window_ms > 0 else 0
+        self.max_chars = max_chars if max_chars > 0 else 0
+        self.stats = stats
+        self._buffer: List[str] = []
+        self._buffered_chars = 0
+        self._timer: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        # 本次流的统计
+        self.fragments_in = 0
+        self.frames_out = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.window or self.max_chars)
+
+    async def add(self, text: str):
+        if not text:
+            return
+        self.fragments_in += 1
+        self.stats.fragments_in += 1
+        self._buffer.append(text)
+        self._buffered_chars += len(text)
+
+        if not self.enabled:
+            await self._flush("event")
+        elif self.max_chars and self._buffered_chars >= self.max_chars:
+            await self._flush("size")
+        elif self.window and self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        """立即发送缓冲内容（工具事件、complete 前调用）"""
+        await self._flush("event")
+
+    async def aclose(self):
+        """发送剩余内容并停止定时器"""
+        await self.flush()
+        self._cancel_timer()
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.window)
+        except asyncio.CancelledError:
+            return
+        self._timer = None
+        await self._flush("time")
+
+    def _cancel_timer(self):
+        timer = self._timer
+        self._timer = None
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+
+    async def _flush(self, reason: str):
+        async with self._lock:
+            if reason != "time":
+                self._cancel_timer()
+            if not self._buffer:
+                return
+            text = "".join(self._buffer)
+            self._buffer.clear()
+            self._buffered_chars = 0
+            self.frames_out += 1
+            self.stats.frames_out += 1
+            self.stats.chars_out += len(text)
+            setattr(self.stats, f"flush_by_{reason}", getattr(self.stats, f"flush_by_{reason}") + 1)
+            await self._send(text)
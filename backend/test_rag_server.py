@@ -0,0 +1,94 @@
+"""
+简易检索服务 - 本地替代远程 retrieval ensemble 接口，用于在没有内网检索服务时验证 rag.py
+
+用法:
+    python test_rag_server.py --port 8100 --delay 0.5
+    RAG_HOST=http://127.0.0.1:8100 python agents/medical/skills/evaluate-record/scripts/rag.py \
+        --query 甲状腺结节 --query 肝功能异常 --source book guideline taboo
+
+接口与远程服务一致: POST /innerservice/retrieval/search/ensemble，按 appid 区分知识库，
+分数为查询与条目的字符重合度；--delay 模拟网络延迟，便于观察并发检索的效果；
+--fail APPID 让该知识库返回非 0 的 status，模拟检索源故障。backend/tests/test_rag_client.py 也用它做测试。
+"""
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# appid -> 条目列表
+CORPUS = {
+    "book_info": [
+        {"title": "甲状腺结节的诊断与处理", "content": "甲状腺结节多数为良性，TI-RADS 3 类及以下建议 6-12 个月复查超声，4 类及以上建议细针穿刺活检。", "book_name": "内分泌学", "author_list": ["示例作者"]},
+        {"title": "肝功能异常的常见原因", "content": "转氨酶轻度升高常见于脂肪肝、饮酒、药物性肝损伤，建议戒酒、控制体重并在 4-8 周后复查肝功能。", "book_name": "消化病学", "author_list": ["示例作者"]},
+        {"title": "高尿酸血症的生活方式干预", "content": "限制高嘌呤食物和含糖饮料，多饮水，每日饮水 2000ml 以上，规律运动。", "book_name": "内科学", "author_list": ["示例作者"]},
+        {"title": "颈部淋巴结肿大", "content": "颈部淋巴结短径小于 1cm、形态规则、皮髓质分界清晰多为反应性增生，可定期随访。", "book_name": "诊断学", "author_list": ["示例作者"]},
+    ],
+    "guideline_info": [
+        {"title": "甲状腺结节和分化型甲状腺癌诊治指南", "content": "超声是评估甲状腺结节的首选方法，不推荐对所有结节常规进行核素显像。", "book_name": "中华医学会指南"},
+        {"title": "非酒精性脂肪性肝病防治指南", "content": "减重 5%-10% 可显著改善肝脏脂肪变和转氨酶水平，不推荐常规使用保肝药物。", "book_name": "中华医学会指南"},
+        {"title": "高血压防治指南", "content": "血压 ≥140/90 mmHg 诊断为高血压，生活方式干预包括限盐（每日 <5g）、减重、戒烟限酒。", "book_name": "中国高血压联盟"},
+    ],
+    "report_negative_kg": [
+        {"title": "甲状腺结节 禁忌", "content": "甲状腺结节患者不宜自行服用含碘保健品，避免未经评估的碘剂补充。", "source": "禁忌症知识图谱"},
+        {"title": "肝功能异常 禁忌", "content": "肝功能异常者应避免饮酒及自行服用对乙酰氨基酚等可能加重肝损伤的药物。", "source": "禁忌症知识图谱"},
+    ],
+}
+
+
+def score(query: str, entry: dict) -> float:
+    text = entry["title"] + entry["content"]
+    chars = set(query)
+    if not chars:
+        return 0.0
+    return sum(1 for ch in chars if ch in text) / len(chars)
+
+
+class RetrievalHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+    # appid -> 单独的延迟（秒），覆盖 delay
+    appid_delays: dict = {}
+    # 返回 status 非 0 的 appid
+    failing: set = set()
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/innerservice/retrieval/search/ensemble":
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        query = "".join(item.get("Content", "") for item in body.get("input") or [])
+        appid = body.get("appid")
+        entries = CORPUS.get(appid, [])
+        ranked = sorted(((score(query, e), e) for e in entries), key=lambda pair: pair[0], reverse=True)
+        hits = [(s, e) for s, e in ranked if s > 0.3][:body.get("num") or 3]
+        time.sleep(self.appid_delays.get(appid, self.delay))
+        if appid in self.failing:
+            result = {"status": 1, "msg": f"{appid} unavailable"}
+        else:
+            result = {
+                "status": 0,
+                "data": {
+                    "Total": len(hits),
+                    "List": [{"score": round(s, 3), "data": json.dumps(e, ensure_ascii=False)} for s, e in hits],
+                },
+            }
+        payload = json.dumps(result, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        print(f"[RAG] {self.address_string()} {format % args}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地替代检索服务")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--delay", type=float, default=0.0, help="每个请求的模拟延迟（秒）")
+    parser.add_argument("--fail", action="append", default=[], help="返回非 0 status 的 appid，可重复")
+    args = parser.parse_args()
+    RetrievalHandler.delay = args.delay
+    RetrievalHandler.failing = set(args.fail)
+    print(f"🎯 启动替代检索服务 (端口 {args.port})，知识库: {', '.join(CORPUS)}")
+    ThreadingHTTPServer(("0.0.0.0", args.port), RetrievalHandler).serve_forever()
@@ -0,0 +1,157 @@
+"""
+rag_client 的并发检索与合并：启动 test_rag_server 的替代检索服务，验证排序、去重和单个检索源变慢或出错时的行为
+
+    cd backend && python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import ThreadingHTTPServer
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+# 缓存等本地数据写到临时目录，不污染 backend/data
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="rag-client-test-"))
+
+import config  # noqa: E402
+import rag_client  # noqa: E402
+from rag_client import merge_results, multi_search, parse_items, search  # noqa: E402
+from test_rag_server import RetrievalHandler  # noqa: E402
+
+
+def item(title: str, score: float, content: str = "") -> dict:
+    return {"score": score, "title": title, "content": content or f"{title}的内容", "origin": "", "authors": []}
+
+
+class QuietHandler(RetrievalHandler):
+    appid_delays = {}
+    failing = set()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MergeResultsTest(unittest.TestCase):
+    def test_scores_are_normalized_per_response(self):
+        # 两个检索源的分数尺度不同：各自归一化后，各源的最高分条目并列第一；并列时按原始分数排序
+        responses = {
+            ("甲状腺", "book"): [item("A", 0.9), item("B", 0.5)],
+            ("甲状腺", "guideline"): [item("C", 80.0), item("D", 20.0)],
+        }
+        ranked = merge_results(responses, top_k=0)
+        self.assertEqual([r["title"] for r in ranked], ["C", "A", "D", "B"])
+        self.assertEqual([r["fused_score"] for r in ranked], [1.0, 1.0, 0.0, 0.0])
+
+    def test_items_hit_by_several_queries_rank_higher(self):
+        responses = {
+            ("甲状腺结节", "book"): [item("A", 0.9), item("B", 0.5)],
+            ("超声", "book"): [item("C", 0.8), item("A", 0.8)],
+        }
+        ranked = merge_results(responses, top_k=0)
+        self.assertEqual(ranked[0]["title"], "A")
+        self.assertEqual(ranked[0]["queries"], ["甲状腺结节", "超声"])
+        self.assertEqual(ranked[0]["fused_score"], 1.05)
+
+    def test_duplicates_across_sources_are_merged(self):
+        responses = {
+            ("甲状腺", "book"): [item("A", 0.9), item("B", 0.1)],
+            ("甲状腺", "guideline"): [item("A", 0.3), item("C", 0.6)],
+        }
+        ranked = merge_results(responses, top_k=0)
+        self.assertEqual(sorted(r["title"] for r in ranked), ["A", "B", "C"])
+        merged = next(r for r in ranked if r["title"] == "A")
+        self.assertEqual(merged["sources"], ["book", "guideline"])
+        self.assertEqual(merged["score"], 0.9)
+
+    def test_top_k(self):
+        responses = {("q", "book"): [item(str(i), float(i)) for i in range(5)]}
+        self.assertEqual([r["title"] for r in merge_results(responses, top_k=2)], ["4", "3"])
+
+
+class ParseItemsTest(unittest.TestCase):
+    def test_non_zero_status_raises(self):
+        with self.assertRaises(rag_client.RagServiceError):
+            parse_items({"status": 1, "msg": "busy"})
+
+    def test_empty_list_is_a_real_empty_result(self):
+        self.assertEqual(parse_items({"status": 0, "data": {"List": []}}), [])
+
+
+class MultiSearchTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        QuietHandler.appid_delays = {}
+        QuietHandler.failing = set()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), QuietHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.host = f"http://127.0.0.1:{self.server.server_port}"
+        self._saved = {name: getattr(config, name) for name in ("LOCAL_INDEX_MODE", "RAG_TIMEOUT", "RAG_CACHE_ENABLED")}
+        config.LOCAL_INDEX_MODE = "off"
+        config.RAG_CACHE_ENABLED = False
+        rag_client._down_until.clear()
+
+    async def asyncTearDown(self):
+        await rag_client.close_rag_client()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for name, value in self._saved.items():
+            setattr(config, name, value)
+        rag_client._down_until.clear()
+
+    async def test_results_are_deduplicated_across_queries(self):
+        result = await multi_search(["甲状腺结节", "甲状腺超声"], ["book", "guideline", "taboo"], host=self.host)
+        titles = [r["title"] for r in result["results"]]
+        self.assertEqual(len(titles), len(set(titles)))
+        self.assertEqual(titles[0], "甲状腺结节的诊断与处理")
+        self.assertEqual(result["results"][0]["queries"], ["甲状腺结节", "甲状腺超声"])
+        self.assertIn("甲状腺结节 禁忌", titles)
+        for stat in result["sources"].values():
+            self.assertEqual(stat["requests"], 2)
+            self.assertEqual(stat["errors"], [])
+
+    async def test_sources_are_queried_concurrently(self):
+        QuietHandler.appid_delays = {"guideline_info": 0.4}
+        started = time.perf_counter()
+        result = await multi_search(["甲状腺结节", "肝功能异常"], ["book", "guideline", "taboo"], host=self.host)
+        elapsed = time.perf_counter() - started
+        # 逐个请求时仅临床指南就需要 0.8 秒
+        self.assertLess(elapsed, 0.75)
+        self.assertGreaterEqual(result["sources"]["guideline"]["latency_ms"], 400)
+        self.assertLess(result["sources"]["book"]["latency_ms"], 400)
+        self.assertIn("非酒精性脂肪性肝病防治指南", [r["title"] for r in result["results"]])
+
+    async def test_slow_source_times_out_without_blocking_others(self):
+        config.RAG_TIMEOUT = 0.2
+        await rag_client.close_rag_client()
+        QuietHandler.appid_delays = {"guideline_info": 1.0}
+        result = await multi_search(["甲状腺结节"], ["book", "guideline"], host=self.host)
+        self.assertEqual(len(result["sources"]["guideline"]["errors"]), 1)
+        self.assertEqual(result["sources"]["book"]["errors"], [])
+        self.assertEqual([r["sources"] for r in result["results"]], [["book"]])
+        self.assertLess(result["elapsed_ms"], 900)
+
+    async def test_erroring_source_is_reported_and_not_cached(self):
+        config.RAG_CACHE_ENABLED = True
+        QuietHandler.failing = {"report_negative_kg"}
+        result = await multi_search(["甲状腺结节"], ["book", "taboo"], host=self.host)
+        self.assertEqual(len(result["sources"]["taboo"]["errors"]), 1)
+        self.assertIn("status=1", result["sources"]["taboo"]["errors"][0])
+        self.assertTrue(result["results"])
+        self.assertTrue(all(r["sources"] == ["book"] for r in result["results"]))
+
+        # 故障恢复后立即能查到结果，没有被当作"无结果"缓存
+        QuietHandler.failing = set()
+        items, cached = await search("甲状腺结节", "taboo", host=self.host)
+        self.assertFalse(cached)
+        self.assertEqual(items[0]["title"], "甲状腺结节 禁忌")
+        items, cached = await search("甲状腺结节", "taboo", host=self.host)
+        self.assertTrue(cached)
+
+
+if __name__ == "__main__":
+    unittest.main()
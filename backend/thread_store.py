@@ -0,0 +1,147 @@
+"""
+服务端对话线程（SQLite）
+
+客户端只发送新消息和 thread_id，对话历史由服务端保存和读取，不再每轮上传完整的 history：
+- 线程以客户端生成的随机 thread_id 标识，断线重连、服务重启后可继续
+- 每个线程最多保留 THREAD_MAX_MESSAGES 条消息，单条消息超过 THREAD_MAX_MESSAGE_CHARS 时截断
+  （病例 JSON 和内嵌图片先替换为占位）
+- 超过 THREAD_RETENTION_DAYS 未更新的线程在启动时清理
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import config
+from history_manager import message_text, strip_bulky
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id  TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS thread_messages (
+    thread_id  TEXT NOT NULL,
+    seq        INTEGER NOT NULL,
+    role       TEXT NOT NULL,
+    content    TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (thread_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_threads_updated ON threads(updated_at);
+"""
+
+_THREAD_ID_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+
+class ThreadError(ValueError):
+    """thread_id 无效"""
+
+
+def validate_thread_id(thread_id: Any) -> str:
+    if not isinstance(thread_id, str) or not _THREAD_ID_RE.match(thread_id):
+        raise ThreadError("thread_id must be 8-64 characters of [A-Za-z0-9_-]")
+    return thread_id
+
+
+class ThreadStore:
+    """对话线程存储；所有方法都是同步的，在事件循环中通过 asyncio.to_thread 调用"""
+
+    def __init__(
+        self,
+        path: str = config.THREAD_DB,
+        max_messages: int = config.THREAD_MAX_MESSAGES,
+        max_message_chars: int = config.THREAD_MAX_MESSAGE_CHARS,
+        retention: float = config.THREAD_RETENTION_DAYS * 86400,
+    ):
+        self.path = path
+        self.max_messages = max_messages
+        self.max_message_chars = max_message_chars
+        self.retention = retention
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def exists(self, thread_id: str) -> bool:
+        with self._lock:
+            return self._db().execute("SELECT 1 FROM threads WHERE thread_id = ?", (thread_id,)).fetchone() is not None
+
+    def load(self, thread_id: str) -> List[Dict[str, str]]:
+        """按时间顺序返回线程中的消息，线程不存在时返回空列表"""
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT role, content FROM thread_messages WHERE thread_id = ? ORDER BY seq", (thread_id,)
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def append(self, thread_id: str, messages: List[Dict[str, Any]]):
+        """追加消息（不存在时创建线程），超出条数上限时删除最早的消息"""
+        now = time.time()
+        rows = []
+        for m in messages:
+            if not isinstance(m, dict) or not m.get("role"):
+                continue
+            content = strip_bulky(message_text(m.get("content")))
+            if self.max_message_chars and len(content) > self.max_message_chars:
+                content = content[:self.max_message_chars] + "…[已截断]"
+            rows.append((m["role"], content))
+        if not rows:
+            return
+        with self._lock, self._db() as db:
+            db.execute(
+                "INSERT INTO threads (thread_id, created_at, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(thread_id) DO UPDATE SET updated_at = excluded.updated_at",
+                (thread_id, now, now),
+            )
+            (last,) = db.execute("SELECT COALESCE(MAX(seq), 0) FROM thread_messages WHERE thread_id = ?", (thread_id,)).fetchone()
+            db.executemany(
+                "INSERT INTO thread_messages (thread_id, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(thread_id, last + i, role, content, now) for i, (role, content) in enumerate(rows, 1)],
+            )
+            if self.max_messages:
+                db.execute(
+                    "DELETE FROM thread_messages WHERE thread_id = ? AND seq <= ?",
+                    (thread_id, last + len(rows) - self.max_messages),
+                )
+
+    def delete(self, thread_id: str) -> bool:
+        with self._lock, self._db() as db:
+            db.execute("DELETE FROM thread_messages WHERE thread_id = ?", (thread_id,))
+            return db.execute("DELETE FROM threads WHERE thread_id = ?", (thread_id,)).rowcount > 0
+
+    def purge_expired(self) -> int:
+        """删除超过保留期未更新的线程，返回删除的线程数"""
+        if not self.retention:
+            return 0
+        deadline = time.time() - self.retention
+        with self._lock, self._db() as db:
+            db.execute(
+                "DELETE FROM thread_messages WHERE thread_id IN (SELECT thread_id FROM threads WHERE updated_at < ?)",
+                (deadline,),
+            )
+            return db.execute("DELETE FROM threads WHERE updated_at < ?", (deadline,)).rowcount
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            db = self._db()
+            (threads,) = db.execute("SELECT COUNT(*) FROM threads").fetchone()
+            (messages,) = db.execute("SELECT COUNT(*) FROM thread_messages").fetchone()
+        return {"threads": threads, "messages": messages}
+
+
+thread_store = ThreadStore()
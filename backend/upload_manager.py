@@ -0,0 +1,274 @@
+"""
+WebSocket 二进制分块上传
+
+图片和大的病例文件不再以 base64 / 内联 JSON 发送，而是走二进制帧：
+
+1. 客户端发送 {"type": "upload_begin", "kind": "image" | "cases", "size": 字节数,
+   "sha256": 可选, "request_id": 可选, "upload_id": 续传时填写}
+2. 服务端回复 {"type": "upload_ready", "upload_id": ..., "offset": 已收到的字节数, "chunk_size": 建议分块大小}
+3. 客户端从 offset 开始发送二进制帧：32 字节 upload_id（hex ASCII）+ 8 字节大端偏移量 + 数据
+4. 客户端发送 {"type": "upload_end", "upload_id": ...}
+5. 服务端校验大小和哈希后回复 {"type": "upload_complete", "upload_id": ..., "ref": ...}
+   图片的 ref 为图片库引用 "image:<id>"，病例文件的 ref 为 "upload:<sha256>"，之后的消息只携带 ref
+
+数据边收边写入磁盘（在线程中执行），不在事件循环上拼接或解析大字符串；连接断开后可在
+UPLOAD_PARTIAL_TTL 秒内用同一个 upload_id 续传。每个会话最多保留 UPLOAD_MAX_PARTIAL_PER_SESSION 个未完成的上传，
+过期清理在 begin 和 write_frame 中进行（最多每 EXPIRE_INTERVAL 秒一次）。
+"""
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+import config
+from image_store import IMAGE_REF_PREFIX, ImageStore, image_store
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+UPLOAD_REF_PREFIX = "upload:"
+# 二进制帧头：32 字节 upload_id + 8 字节偏移量
+FRAME_HEADER_SIZE = 40
+UPLOAD_KINDS = ("image", "cases")
+# 两次过期清理之间的最短间隔（秒）
+EXPIRE_INTERVAL = 60.0
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class UploadError(ValueError):
+    """上传请求无效：超过大小限制、偏移量不连续、校验失败等"""
+
+
+@dataclass
+class PartialUpload:
+    upload_id: str
+    session_id: str
+    kind: str
+    size: int
+    path: str
+    sha256: Optional[str] = None
+    received: int = 0
+    updated_at: float = field(default_factory=time.time)
+    # 按顺序写入时增量计算哈希，完成时无需重读文件
+    digest: Any = field(default_factory=hashlib.sha256)
+
+
+class UploadManager:
+    """所有连接共享的上传状态；方法中的磁盘操作都是同步的，在线程中调用"""
+
+    def __init__(
+        self,
+        root: str = config.UPLOAD_DIR,
+        store: ImageStore = image_store,
+        max_bytes: int = config.UPLOAD_MAX_MB * 1024 * 1024,
+        partial_ttl: float = config.UPLOAD_PARTIAL_TTL,
+        retention: float = config.UPLOAD_RETENTION_HOURS * 3600,
+        max_partial_per_session: int = config.UPLOAD_MAX_PARTIAL_PER_SESSION,
+    ):
+        self.root = root
+        self.store = store
+        self.max_bytes = max_bytes
+        self.partial_ttl = partial_ttl
+        self.retention = retention
+        self.max_partial_per_session = max_partial_per_session
+        self._uploads: Dict[str, PartialUpload] = {}
+        self._lock = threading.Lock()
+        self._next_expire = 0.0
+        self.completed = 0
+        self.bytes_received = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def begin(self, session_id: str, kind: str, size: int, sha256: Optional[str] = None, upload_id: Optional[str] = None) -> PartialUpload:
+        """开始或续传一个上传，返回的 received 即客户端应继续发送的偏移量"""
+        self._maybe_expire()
+        if upload_id:
+            upload = self._uploads.get(upload_id)
+            if upload is not None and upload.session_id == session_id and upload.size == size:
+                upload.updated_at = time.time()
+                return upload
+        if kind not in UPLOAD_KINDS:
+            raise UploadError(f"unsupported upload kind: {kind}")
+        limit = self.store.max_image_bytes if kind == "image" else self.max_bytes
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError("size must be a positive integer")
+        if limit and size > limit:
+            raise UploadError(f"upload exceeds {limit} bytes")
+        if sha256 is not None and not _SHA256_RE.match(sha256):
+            raise UploadError("sha256 must be 64 lowercase hex characters")
+
+        upload_id = uuid.uuid4().hex
+        partial_dir = os.path.join(self.root, "partial")
+        os.makedirs(partial_dir, exist_ok=True)
+        upload = PartialUpload(
+            upload_id=upload_id,
+            session_id=session_id,
+            kind=kind,
+            size=size,
+            path=os.path.join(partial_dir, f"{upload_id}.part"),
+            sha256=sha256,
+        )
+        self._evict_for_session(session_id)
+        open(upload.path, "wb").close()
+        with self._lock:
+            self._uploads[upload_id] = upload
+        return upload
+
+    def _evict_for_session(self, session_id: str):
+        """会话的未完成上传达到上限时，丢弃最久没有写入的，为新的上传腾出位置"""
+        if not self.max_partial_per_session:
+            return
+        with self._lock:
+            own = sorted((u for u in self._uploads.values() if u.session_id == session_id), key=lambda u: u.updated_at)
+        for upload in own[:max(0, len(own) - self.max_partial_per_session + 1)]:
+            logger.info("upload evicted", extra={"upload_id": upload.upload_id, "session_id": session_id, "received": upload.received})
+            self.evicted += 1
+            self.abort(upload.upload_id)
+
+    def write_frame(self, session_id: str, frame: bytes) -> PartialUpload:
+        """写入一个二进制帧；重复发送的已确认数据会被忽略，跳跃的偏移量报错"""
+        self._maybe_expire()
+        if len(frame) < FRAME_HEADER_SIZE:
+            raise UploadError("binary frame too short")
+        upload_id = frame[:32].decode("ascii", errors="replace")
+        (offset,) = struct.unpack(">Q", frame[32:FRAME_HEADER_SIZE])
+        data = memoryview(frame)[FRAME_HEADER_SIZE:]
+        upload = self._uploads.get(upload_id)
+        if upload is None or upload.session_id != session_id:
+            raise UploadError(f"unknown upload: {upload_id}")
+        if offset > upload.received:
+            raise UploadError(f"expected offset {upload.received}, got {offset}")
+        # 续传时客户端可能重发已收到的部分
+        skip = upload.received - offset
+        if skip >= len(data):
+            return upload
+        data = data[skip:]
+        if upload.received + len(data) > upload.size:
+            self.abort(upload_id)
+            raise UploadError("upload larger than declared size")
+        with open(upload.path, "r+b") as f:
+            f.seek(upload.received)
+            f.write(data)
+        upload.digest.update(data)
+        upload.received += len(data)
+        upload.updated_at = time.time()
+        self.bytes_received += len(data)
+        return upload
+
+    def expected_offset(self, upload_id: str) -> Optional[int]:
+        upload = self._uploads.get(upload_id)
+        return upload.received if upload is not None else None
+
+    def finish(self, session_id: str, upload_id: str) -> Dict[str, Any]:
+        """校验并转存已完成的上传，返回 {"ref", "size", ...}"""
+        upload = self._uploads.get(upload_id)
+        if upload is None or upload.session_id != session_id:
+            raise UploadError(f"unknown upload: {upload_id}")
+        if upload.received != upload.size:
+            raise UploadError(f"incomplete upload: {upload.received}/{upload.size} bytes")
+        digest = upload.digest.hexdigest()
+        if upload.sha256 and upload.sha256 != digest:
+            self.abort(upload_id)
+            raise UploadError("sha256 mismatch")
+        try:
+            if upload.kind == "image":
+                with open(upload.path, "rb") as f:
+                    image_id = self.store.put(f.read())
+                result = {"ref": IMAGE_REF_PREFIX + image_id, "url": f"/api/images/{image_id}"}
+            else:
+                result = self._finish_cases(upload, digest)
+        finally:
+            self.abort(upload_id)
+        self.completed += 1
+        return dict(result, size=upload.size, sha256=digest)
+
+    def _finish_cases(self, upload: PartialUpload, digest: str) -> Dict[str, Any]:
+        with open(upload.path, "rb") as f:
+            try:
+                cases = json.load(f)
+            except ValueError as e:
+                raise UploadError(f"invalid JSON: {e}") from e
+        if not isinstance(cases, list):
+            raise UploadError("case file must contain a JSON array")
+        os.replace(upload.path, self._cases_path(digest))
+        return {"ref": UPLOAD_REF_PREFIX + digest, "count": len(cases)}
+
+    def load_cases(self, ref: str) -> list:
+        """读取 "upload:<sha256>" 引用的病例列表"""
+        digest = ref[len(UPLOAD_REF_PREFIX):] if isinstance(ref, str) and ref.startswith(UPLOAD_REF_PREFIX) else ""
+        if not _SHA256_RE.match(digest):
+            raise UploadError(f"invalid upload reference: {ref}")
+        try:
+            with open(self._cases_path(digest), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise UploadError(f"upload not found: {ref}") from None
+
+    def abort(self, upload_id: str):
+        with self._lock:
+            upload = self._uploads.pop(upload_id, None)
+        if upload is not None:
+            try:
+                os.remove(upload.path)
+            except OSError:
+                pass
+
+    def _maybe_expire(self):
+        now = time.monotonic()
+        if now < self._next_expire:
+            return
+        self._next_expire = now + EXPIRE_INTERVAL
+        self.expire_stale()
+
+    def expire_stale(self):
+        now = time.time()
+        with self._lock:
+            uploads = list(self._uploads.values())
+        for upload in uploads:
+            if now - upload.updated_at > self.partial_ttl:
+                logger.info("upload expired", extra={"upload_id": upload.upload_id, "received": upload.received, "size": upload.size})
+                self.expired += 1
+                self.abort(upload.upload_id)
+
+    def cleanup(self) -> int:
+        """删除上次运行遗留的未完成上传，以及超过保留期的病例文件；返回删除的文件数"""
+        removed = 0
+        now = time.time()
+        for sub, keep in (("partial", lambda name, mtime: name[:-5] in self._uploads),
+                          ("cases", lambda name, mtime: now - mtime < self.retention)):
+            directory = os.path.join(self.root, sub)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    if keep(name, os.path.getmtime(path)):
+                        continue
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    continue
+        return removed
+
+    def _cases_path(self, digest: str) -> str:
+        os.makedirs(os.path.join(self.root, "cases"), exist_ok=True)
+        return os.path.join(self.root, "cases", f"{digest}.json")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_progress": len(self._uploads),
+            "completed": self.completed,
+            "bytes_received": self.bytes_received,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+upload_manager = UploadManager()
@@ -5,6 +5,13 @@ class ChatAppWS {
         this.messages = [];
         this.currentAssistantMessage = null;
         this.ws = null;
+        this.sessionId = null;  // 服务端分配的会话ID，重连时沿用以继续接收本会话的事件
+        this.batchId = null;  // 正在执行的服务端批量评估任务
+        this.pendingImageUploads = new Map();  // 预览中的图片 -> 上传到图片库的 Promise
+        this.socketUploads = new Map();  // request_id -> 进行中的二进制分块上传
+        this.uploadSeq = 0;
+        this.uploadStallMs = 30000;  // 上传无进展超过该时长即失败
+        this.uploadResumeMs = 15000;  // 连接断开后等待重连续传的时长，超过即失败
         this.reconnectTimeout = null;
         this.isComposing = false;
         this.typewriterQueue = '';
@@ -23,6 +30,7 @@ class ChatAppWS {
         this.messagesContainer = document.getElementById('messages');
         this.userInput = document.getElementById('userInput');
         this.sendBtn = document.getElementById('sendBtn');
+        this.stopBtn = document.getElementById('stopBtn');
         this.clearBtn = document.getElementById('clearBtn');
         this.statusIndicator = document.getElementById('statusIndicator');
         this.jsonData = null;  // 存储上传的JSON数据
@@ -88,7 +96,10 @@ class ChatAppWS {
     
     connectWebSocket() {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.host}/ws`;
+        let wsUrl = `${protocol}//${window.location.host}/ws`;
+        if (this.sessionId) {
+            wsUrl += `?session_id=${encodeURIComponent(this.sessionId)}`;
+        }
         
         console.log('Connecting to WebSocket:', wsUrl);
         this.ws = new WebSocket(wsUrl);
@@ -100,11 +111,15 @@ class ChatAppWS {
                 clearTimeout(this.reconnectTimeout);
                 this.reconnectTimeout = null;
             }
+            // 断线前未完成的上传从服务端已收到的位置续传
+            this.socketUploads.forEach((upload, requestId) => this.beginSocketUpload(requestId, upload));
         };
         
         this.ws.onclose = () => {
             console.log('WebSocket disconnected');
             this.updateStatus(false);
+            // 未完成的上传等待重连后续传，等不到时失败（图片上传会改走 HTTP）
+            this.socketUploads.forEach((upload, requestId) => this.armUploadTimer(requestId, upload, this.uploadResumeMs, '连接已断开'));
             // 5秒后自动重连
             this.reconnectTimeout = setTimeout(() => {
                 console.log('Attempting to reconnect...');
@@ -140,6 +155,11 @@ class ChatAppWS {
         }
         
         switch (data.type) {
+            case 'session':
+                // 服务端分配的会话ID
+                this.sessionId = data.session_id;
+                break;
+                
             case 'user_message':
                 // 其他客户端或外部触发的用户消息
                 // 跳过，因为本地已经显示了
@@ -164,36 +184,30 @@ class ChatAppWS {
                 this.typewriterQueue += data.content;
                 break;
                 
+            case 'run_queued':
+                // 服务端已接收消息，此时可以停止生成
+                this.updateStopButton(true);
+                break;
+                
             case 'complete':
                 // 回复完成
                 this.isGenerating = false;
+                this.updateStopButton(false);
+                this.finishAssistantMessage();
+                break;
                 
-                // 等待打字机完成
-                this.finishTypewriter().then(() => {
-                    if (this.currentAssistantMessage) {
-                        const contentDiv = this.currentAssistantMessage.querySelector('.message-content');
-                        contentDiv.classList.remove('typing');
-                        this.currentAssistantMessage.classList.remove('streaming');
-                        
-                        // 完成后进行最终渲染（Markdown 解析）
-                        this.updateMessageContent(this.currentAssistantMessage, this.displayedText, contentDiv, true);
-                        
-                        // 保存到历史
-                        this.messages.push({
-                            role: 'assistant',
-                            content: this.displayedText
-                        });
-                        
-                        this.saveChatHistories();
-                        this.currentAssistantMessage = null;
-                        this.displayedText = '';
-                    }
-                });
+            case 'cancelled':
+                // 运行已被取消：保留已生成的内容
+                this.isGenerating = false;
+                this.updateStopButton(false);
+                this.removeLoadingIndicator();
+                this.finishAssistantMessage('\n\n*（已停止生成）*');
                 break;
                 
             case 'error':
                 // 错误消息
                 this.isGenerating = false;
+                this.updateStopButton(false);
                 
                 // 移除加载提示
                 this.removeLoadingIndicator();
@@ -207,6 +221,46 @@ class ChatAppWS {
                 this.scrollToBottom();
                 break;
                 
+            case 'batch_started':
+                // 服务端批量评估开始
+                this.batchId = data.batch_id;
+                this.updateStopButton(true);
+                this.showLoadingIndicator();
+                break;
+                
+            case 'batch_case_result':
+                // 单个病例的评估结果
+                this.removeLoadingIndicator();
+                this.renderBatchCaseResult(data);
+                this.showLoadingIndicator();
+                break;
+                
+            case 'batch_complete':
+                // 批量评估结束（完成或取消）
+                this.batchId = null;
+                this.updateStopButton(false);
+                this.removeLoadingIndicator();
+                const statusText = { cancelled: '已取消', paused: '已暂停', interrupted: '已中断，服务重启后继续' }[data.status] || '分析完成';
+                const summaryText = `批量评估${statusText}：共 ${data.total} 个case，成功 ${data.completed} 个，失败 ${data.failed} 个，耗时 ${data.elapsed} 秒`
+                    + (data.memo_hits ? `（${data.memo_hits} 个复用上次结果，${data.memo_misses} 个重新评估）` : '');
+                this.addMessage('assistant', data.status === 'completed' ? `✅ ${summaryText}` : `⏹ ${summaryText}`);
+                this.messages.push({ role: 'assistant', content: summaryText });
+                this.saveChatHistories();
+                this.addMessageActions();
+                break;
+                
+            case 'upload_ready':
+                this.onUploadReady(data);
+                break;
+                
+            case 'upload_complete':
+                this.onUploadComplete(data);
+                break;
+                
+            case 'upload_error':
+                this.onUploadError(data);
+                break;
+                
             case 'external_trigger':
                 // 外部触发的消息，显示特殊标记
                 const messageDiv = this.createMessageElement('user', data.message);
@@ -222,6 +276,44 @@ class ChatAppWS {
         }
     }
     
+    finishAssistantMessage(note = '') {
+        // 等待打字机完成
+        this.finishTypewriter().then(() => {
+            if (this.currentAssistantMessage) {
+                const contentDiv = this.currentAssistantMessage.querySelector('.message-content');
+                contentDiv.classList.remove('typing');
+                this.currentAssistantMessage.classList.remove('streaming');
+                this.displayedText += note;
+                
+                // 完成后进行最终渲染（Markdown 解析）
+                this.updateMessageContent(this.currentAssistantMessage, this.displayedText, contentDiv, true);
+                
+                // 保存到历史
+                this.messages.push({
+                    role: 'assistant',
+                    content: this.displayedText
+                });
+                
+                this.saveChatHistories();
+                this.currentAssistantMessage = null;
+                this.displayedText = '';
+            }
+        });
+    }
+    
+    cancelGeneration() {
+        // 请求服务端取消本会话正在执行的运行
+        if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+            this.ws.send(JSON.stringify({ type: 'cancel', batch_id: this.batchId || undefined }));
+        }
+    }
+    
+    updateStopButton(visible) {
+        if (this.stopBtn) {
+            this.stopBtn.style.display = visible ? 'flex' : 'none';
+        }
+    }
+    
     startTypewriter() {
         if (this.isTyping) return;
         this.isTyping = true;
@@ -299,6 +391,9 @@ class ChatAppWS {
     
     initEventListeners() {
         this.sendBtn.addEventListener('click', () => this.sendMessage());
+        if (this.stopBtn) {
+            this.stopBtn.addEventListener('click', () => this.cancelGeneration());
+        }
         
         this.userInput.addEventListener('compositionstart', () => {
             this.isComposing = true;
@@ -381,6 +476,9 @@ class ChatAppWS {
     }
 
     handleImageUpload(file) {
+        // 同时上传到服务端图片库，发送消息时只携带图片引用
+        const upload = this.uploadImage(file);
+        
         const reader = new FileReader();
         reader.onload = (e) => {
             const imagePreview = document.getElementById('imagePreview');
@@ -390,11 +488,13 @@ class ChatAppWS {
             const img = document.createElement('img');
             img.src = e.target.result;
             img.className = 'preview-image';
+            this.pendingImageUploads.set(img, upload);
             
             const removeBtn = document.createElement('button');
             removeBtn.className = 'remove-image';
             removeBtn.innerHTML = '×';
             removeBtn.addEventListener('click', () => {
+                this.pendingImageUploads.delete(img);
                 previewDiv.remove();
             });
             
@@ -405,6 +505,134 @@ class ChatAppWS {
         reader.readAsDataURL(file);
     }
     
+    uploadOverSocket(blob, kind) {
+        // 二进制分块上传：upload_begin -> 二进制帧 -> upload_end，完成后得到引用（ref）
+        return new Promise((resolve, reject) => {
+            const requestId = `upload-${++this.uploadSeq}`;
+            const upload = { blob, kind, uploadId: null, retries: 0, timer: null, resolve, reject };
+            this.socketUploads.set(requestId, upload);
+            this.armUploadTimer(requestId, upload, this.uploadStallMs, '上传超时');
+            this.beginSocketUpload(requestId, upload);
+        });
+    }
+    
+    armUploadTimer(requestId, upload, ms, reason) {
+        // 每次有进展时重新计时；到期仍未完成则失败
+        clearTimeout(upload.timer);
+        upload.timer = setTimeout(() => this.failSocketUpload(requestId, new Error(reason)), ms);
+    }
+    
+    failSocketUpload(requestId, error) {
+        const upload = this.socketUploads.get(requestId);
+        if (!upload) return;
+        clearTimeout(upload.timer);
+        this.socketUploads.delete(requestId);
+        upload.reject(error);
+    }
+    
+    beginSocketUpload(requestId, upload) {
+        if (!this.ws || this.ws.readyState !== WebSocket.OPEN) {
+            return;  // 连接恢复后在 onopen 中继续
+        }
+        this.ws.send(JSON.stringify({
+            type: 'upload_begin',
+            request_id: requestId,
+            upload_id: upload.uploadId || undefined,
+            kind: upload.kind,
+            size: upload.blob.size
+        }));
+    }
+    
+    async sendUploadChunks(requestId, upload, offset, chunkSize) {
+        const ws = this.ws;
+        const header = new TextEncoder().encode(upload.uploadId);
+        for (let pos = offset; pos < upload.blob.size; pos += chunkSize) {
+            // 发送缓冲积压时等待，避免一次性把整个文件读进内存
+            while (ws.bufferedAmount > 4 * chunkSize) {
+                if (ws.readyState !== WebSocket.OPEN) return;
+                await new Promise(resolve => setTimeout(resolve, 20));
+            }
+            if (ws.readyState !== WebSocket.OPEN) return;
+            const data = new Uint8Array(await upload.blob.slice(pos, pos + chunkSize).arrayBuffer());
+            this.armUploadTimer(requestId, upload, this.uploadStallMs, '上传超时');
+            // 帧格式：32 字节 upload_id + 8 字节大端偏移量 + 数据
+            const frame = new Uint8Array(40 + data.length);
+            frame.set(header, 0);
+            new DataView(frame.buffer).setBigUint64(32, BigInt(pos));
+            frame.set(data, 40);
+            ws.send(frame);
+        }
+        ws.send(JSON.stringify({ type: 'upload_end', request_id: requestId, upload_id: upload.uploadId }));
+    }
+    
+    onUploadReady(data) {
+        const upload = this.socketUploads.get(data.request_id);
+        if (!upload) return;
+        upload.uploadId = data.upload_id;
+        this.armUploadTimer(data.request_id, upload, this.uploadStallMs, '上传超时');
+        this.sendUploadChunks(data.request_id, upload, data.offset, data.chunk_size).catch(error => {
+            this.failSocketUpload(data.request_id, error);
+        });
+    }
+    
+    onUploadComplete(data) {
+        const upload = this.socketUploads.get(data.request_id);
+        if (!upload) return;
+        clearTimeout(upload.timer);
+        this.socketUploads.delete(data.request_id);
+        upload.resolve(data);
+    }
+    
+    onUploadError(data) {
+        let requestId = data.request_id;
+        if (!requestId) {
+            // 数据帧出错时服务端只知道 upload_id
+            requestId = [...this.socketUploads.keys()].find(key => this.socketUploads.get(key).uploadId === data.upload_id);
+        }
+        const upload = this.socketUploads.get(requestId);
+        if (!upload) return;
+        if (data.offset !== null && data.offset !== undefined && upload.retries < 3) {
+            // 偏移量不连续：从服务端确认的位置重发
+            upload.retries += 1;
+            this.beginSocketUpload(requestId, upload);
+            return;
+        }
+        this.failSocketUpload(requestId, new Error(data.error));
+    }
+    
+    async uploadImage(file) {
+        if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+            try {
+                return await this.uploadOverSocket(file, 'image');
+            } catch (error) {
+                console.warn('WebSocket 上传失败，改用 HTTP 上传:', error);
+            }
+        }
+        const formData = new FormData();
+        formData.append('file', file);
+        try {
+            const response = await fetch('/api/images', { method: 'POST', body: formData });
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            return await response.json();
+        } catch (error) {
+            // 上传失败时退回到内嵌 data URL，由服务端在收到消息时入库
+            console.warn('图片上传失败，将随消息内嵌发送:', error);
+            return null;
+        }
+    }
+    
+    async resolveImageRefs(images) {
+        // 返回 [{ ref, url }]：ref 用于发送和历史记录，url 用于页面显示
+        const uploads = this.pendingImageUploads;
+        return Promise.all(Array.from(images).map(async (img) => {
+            const uploaded = uploads.has(img) ? await uploads.get(img) : null;
+            uploads.delete(img);
+            return uploaded ? { ref: uploaded.ref, url: uploaded.url } : { ref: img.src, url: img.src };
+        }));
+    }
+    
     handleJsonUpload(file) {
         const reader = new FileReader();
         reader.onload = (e) => {
@@ -499,35 +727,43 @@ class ChatAppWS {
         this.jsonData = null;
     }
     
-    sendSingleMessage(message, images) {
+    async sendSingleMessage(message, images) {
         // 立即显示用户消息
         if (message) {
             this.addMessage('user', message);
         }
         
+        // 等待图片上传完成，得到图片库引用
+        const imageRefs = await this.resolveImageRefs(images);
+        
         // 显示图片
-        if (images.length > 0) {
-            images.forEach(img => {
-                this.addMessage('user', `<img src="${img.src}" class="message-image">`);
-            });
-        }
+        imageRefs.forEach(image => {
+            this.addMessage('user', `<img src="${image.url}" class="message-image">`);
+        });
         
         // 显示加载提示
         this.showLoadingIndicator();
         
         // 准备发送的数据（始终包含message字段，即使为空）
         const data = {
-            message: message || '',  // 确保message字段存在
-            history: this.messages
+            message: message || ''  // 确保message字段存在
         };
         
-        // 如果有图片，添加图片数据
-        if (images.length > 0) {
-            data.images = Array.from(images).map(img => img.src);
+        // 对话历史由服务端线程保存，只发送新消息和 thread_id；旧对话第一次使用线程时附带本地历史用于初始化
+        const chat = this.chatHistories.find(c => c.id === this.currentChatId);
+        if (chat) {
+            if (!chat.threadId) {
+                chat.threadId = this.newThreadId();
+                data.history = this.messages;
+            }
+            data.thread_id = chat.threadId;
         } else {
-            data.images = [];  // 明确表示没有图片
+            data.history = this.messages;
         }
         
+        // 图片只发送引用（image:<id>），上传失败的才内嵌 data URL
+        data.images = imageRefs.map(image => image.ref);
+        
         // 通过 WebSocket 发送消息
         this.ws.send(JSON.stringify(data));
         
@@ -537,12 +773,12 @@ class ChatAppWS {
             content: message || ''  // 确保content字段存在
         };
         
-        if (images.length > 0) {
-            // 如果有图片，将图片URL附加到消息内容
-            images.forEach(img => {
-                userMessage.content += `\n[图片: ${img.src}]`;
-            });
-        }
+        // 历史记录中只保存图片引用，避免每轮对话重复携带图片数据
+        imageRefs.forEach(image => {
+            if (image.ref.startsWith('image:')) {
+                userMessage.content += `\n[图片: ${image.ref}]`;
+            }
+        });
         
         this.messages.push(userMessage);
         this.saveChatHistories();
@@ -588,69 +824,36 @@ class ChatAppWS {
             });
         }
         
-        // 逐个处理每个case
-        for (let i = 0; i < cases.length; i++) {
-            const caseData = cases[i];
-            const caseMessage = message || '请分析以下case';
-            
-            // 显示当前处理的case信息
-            this.addMessage('user', `\n--- Case ${i + 1}/${cases.length} ---\n${JSON.stringify(caseData, null, 2)}`);
-            
-            // 显示加载提示
-            this.showLoadingIndicator();
-            
-            // 准备发送的数据
-            const data = {
-                message: caseMessage,
-                history: this.messages,
-                case_data: caseData,  // 添加case数据
-                case_index: i,  // 添加case索引
-                total_cases: cases.length  // 添加总case数
-            };
-            
-            // 如果有图片，添加图片数据
-            if (images.length > 0) {
-                data.images = Array.from(images).map(img => img.src);
-            } else {
-                data.images = [];
-            }
-            
-            // 保存到历史记录
-            this.messages.push({
-                role: 'user',
-                content: `Case ${i + 1}/${cases.length}: ${JSON.stringify(caseData)}`
-            });
-            
-            // 通过 WebSocket 发送消息
-            this.ws.send(JSON.stringify(data));
-            
-            // 等待AI回复完成（通过监听complete事件）
-            await this.waitForCompletion();
-            
-            // 短暂延迟，避免请求过快
-            if (i < cases.length - 1) {
-                await new Promise(resolve => setTimeout(resolve, 500));
-            }
+        // 整个列表一次提交给服务端批量引擎，由服务端控制并发，结果通过 batch_* 事件推送
+        // 病例文件先走二进制分块上传，batch_start 只携带引用
+        const batchRequest = { type: 'batch_start', message: message || '' };
+        try {
+            const uploaded = await this.uploadOverSocket(new Blob([JSON.stringify(cases)], { type: 'application/json' }), 'cases');
+            batchRequest.cases_ref = uploaded.ref;
+        } catch (error) {
+            console.warn('病例文件上传失败，改为内联发送:', error);
+            batchRequest.cases = cases;
         }
+        this.ws.send(JSON.stringify(batchRequest));
         
-        // 所有case处理完成
-        this.addMessage('assistant', `\n✅ 所有 ${cases.length} 个case分析完成！`);
-        
-        // 添加消息操作按钮
-        this.addMessageActions();
+        // 历史记录里只保留摘要，不写入完整的case JSON
+        this.messages.push({
+            role: 'user',
+            content: `${message ? message + '\n' : ''}${jsonInfo}`
+        });
+        this.saveChatHistories();
     }
     
-    waitForCompletion() {
-        return new Promise((resolve) => {
-            const checkComplete = () => {
-                if (!this.isGenerating && this.typewriterQueue.length === 0) {
-                    resolve();
-                } else {
-                    setTimeout(checkComplete, 100);
-                }
-            };
-            checkComplete();
-        });
+    renderBatchCaseResult(data) {
+        const title = `Case ${data.index + 1}${data.case_id ? ` (ID: ${data.case_id})` : ''}`;
+        const body = data.status === 'success'
+            ? data.content
+            : `❌ 评估失败: ${data.error || '未知错误'}`;
+        const messageDiv = this.createMessageElement('assistant', '');
+        const contentDiv = messageDiv.querySelector('.message-content');
+        this.updateMessageContent(messageDiv, `**${title}**（${data.latency}s）\n\n${body}`, contentDiv, true);
+        this.messagesContainer.appendChild(messageDiv);
+        this.scrollToBottom();
     }
     
     addMessageActions() {
@@ -1588,6 +1791,7 @@ class ChatAppWS {
         
         const newChat = {
             id: chatId,
+            threadId: this.newThreadId(),
             title: '新对话',
             messages: [],
             timestamp: new Date().toLocaleString()
@@ -1604,6 +1808,22 @@ class ChatAppWS {
         this.renderHistoryList();
     }
     
+    newThreadId() {
+        // 服务端对话线程ID，随机生成，不可猜测
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID().replace(/-/g, '');
+        }
+        const bytes = new Uint8Array(16);
+        crypto.getRandomValues(bytes);
+        return Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+    }
+    
+    deleteServerThread(chat) {
+        if (chat && chat.threadId) {
+            fetch(`/api/threads/${chat.threadId}`, { method: 'DELETE' }).catch(() => {});
+        }
+    }
+    
     saveChatHistories() {
         try {
             // 更新当前对话的消息
@@ -1684,6 +1904,7 @@ class ChatAppWS {
     
     deleteChat(chatId) {
         if (confirm('确定要删除这个对话吗？')) {
+            this.deleteServerThread(this.chatHistories.find(c => c.id === chatId));
             this.chatHistories = this.chatHistories.filter(c => c.id !== chatId);
             this.saveChatHistories();
             
@@ -1697,6 +1918,7 @@ class ChatAppWS {
     
     clearAllHistories() {
         if (confirm('确定要清空所有历史记录吗？这个操作无法撤销。')) {
+            this.chatHistories.forEach(chat => this.deleteServerThread(chat));
             this.chatHistories = [];
             this.saveChatHistories();
             this.createNewChat();